@@ -0,0 +1,75 @@
+# Reading the reads of a gene directly from the full alignment BAM file (e.g. bowtie_gene_exon_tagged_clean.bam),
+# in place of the first stage of samtools processing of process_BAM_for_gene.sh.
+# The reads of the gene are fetched through the index of the BAM file (.bai), and the samtools filters are applied
+# while the reads are decoded:
+#   samtools view -e "ncigar==1" - only reads with one CIGAR operation (no indels and no clipping) are kept
+#   samtools calmd -e - the bases that match the reference are replaced by '=' and NM is set to the number of
+#                       mismatches, computed against the reference store
+# A BAM file that was already processed this way (X_no_indels_mm_sorted.bam) gives the same reads, so both kinds of
+# files can be used. The open BAM files are cached, so many genes are read through one file handle per process.
+# The BAM files are read with bgzf_reader.BamReader, that inflates the blocks of the file with several threads.
+
+import os
+import numpy as np
+import stage_metrics
+from bgzf_reader import BamReader
+from read_store import ReadTable, ReadTableBuilder, MATCH_CODE, BASES
+
+N_CODE = BASES.index('N')
+_bams = {}
+
+
+def open_bam(bam_file):
+    # the BAM file opened once per process. a forked process opens the file again, since the threads of the reader
+    # and the position in the file are not shared with it
+    key = (os.getpid(), os.path.abspath(bam_file))
+    if key not in _bams:
+        _bams[key] = BamReader(bam_file)
+    return _bams[key]
+
+
+def apply_calmd(table, ref_codes):
+    # the reads of the table with the bases that match the reference (ref_codes, the base codes of the gene sequence)
+    # replaced by '=', and with NM set to the number of the other bases, as samtools calmd -e does. 'N' never matches
+    starts = np.repeat(np.asarray(table.pos, dtype=np.int64) - 1 - table.offsets[:-1], table.lengths)
+    ref_pos = starts + np.arange(len(table.seq))
+    in_gene = ref_pos < len(ref_codes)
+    ref = np.full(len(table.seq), N_CODE, dtype=np.uint8)
+    ref[in_gene] = ref_codes[ref_pos[in_gene]]
+    seq = np.asarray(table.seq)
+    match = (seq == MATCH_CODE) | ((seq == ref) & (seq != N_CODE))
+    seq = np.where(match, np.uint8(MATCH_CODE), seq)
+    read_of_base = np.repeat(np.arange(len(table)), table.lengths)
+    nm = np.bincount(read_of_base[~match], minlength=len(table)).astype(np.int32)
+    return ReadTable(table.pos, nm, table.cell, table.cells, table.offsets, seq, table.qual,
+                     table.name_offsets, table.names, table.rank)
+
+
+def intern_cells(cell_tags, cell_ids):
+    # the ids of the cell tags (a bytes array) in the cells dictionary cell_ids, adding the new tags to it in the order
+    # they first appear, as the reads are read one by one
+    tags, first, inverse = np.unique(cell_tags, return_index=True, return_inverse=True)
+    ids = np.zeros(len(tags), dtype=np.int32)
+    for t in np.argsort(first):
+        ids[t] = cell_ids.setdefault(tags[t].decode(), len(cell_ids))
+    return ids[inverse.ravel()]
+
+
+def read_bam_batches(bam_file, gene_name=None, ref_codes=None, batch_size=100000):
+    # yields the reads of the gene in the BAM file as ReadTables of up to batch_size reads, that share one cells
+    # dictionary. if ref_codes (the base codes of the gene sequence) are given, the reads are compared to the reference
+    # as samtools calmd does. each batch is decoded from the records into arrays at once (see bgzf_reader.py)
+    cell_ids = {}
+    i = 0
+    for batch in open_bam(bam_file).batches(gene_name, batch_size, no_indels=True):
+        cell = intern_cells(batch.cell_tags, cell_ids)
+        # position as written in the read (1-based), the bases and qualities of the reads, the cell of each read and the
+        # number of mismatches:
+        table = ReadTable((batch.pos + 1).astype(np.int32), batch.NM, cell, list(cell_ids), batch.seq_offsets,
+                          batch.seq, batch.qual, batch.name_offsets, batch.names)
+        i += len(table)
+        stage_metrics.count(len(table))
+        yield table if ref_codes is None else apply_calmd(table, ref_codes)
+        print("{} reads were processed".format(i))
+    if i == 0:  # no reads, an empty table
+        yield ReadTableBuilder().build()
@@ -0,0 +1,189 @@
+# Benchmark of the stages of the per-gene pipeline and of the DGE functions on synthetic data (see synthetic_data.py).
+# Usage: python benchmark.py <work_dir> [reads_per_gene] [cells] [gene_len] [genes] [baseline.json]
+# The synthetic files are written to work_dir (once for each set of sizes), and every stage is run 'REPEATS' times,
+# each time in a new process, so its peak memory is measured on its own. The results are written to
+# '<work_dir>/benchmark_<commit>.json': for each stage its best time, CPU time, throughput (reads, positions or genes
+# per second) and peak memory (the maximum resident set size of the process, and its increase during the stage).
+# Given the json file of an earlier run (e.g. of another commit), the times are compared with its times.
+
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import traceback
+from queue import Empty
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # the plots are only saved
+import synthetic_data
+import sample_reads_from_BAM
+import create_mismatches_info_and_barplots
+import distribution
+import check_DGE
+from dge_matrix import load_dge
+from num_of_reads_per_cell import count_reads_per_gene_and_cell
+from reference_store import load_reference
+
+REPEATS = 3
+POLL_SECONDS = 1  # how often a running stage is checked for having died
+AMOUNT = 10  # the cap on the number of sampled reads per cell, as in sample_reads_from_BAM.py
+
+
+def current_rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def measure(func, log_file, queue):
+    # runs in a new process: the time, CPU time and memory of func(), with its output written to log_file. a result or
+    # the error of the stage is always put on the queue
+    start_rss = current_rss_mb()
+    start_cpu = resource.getrusage(resource.RUSAGE_SELF)
+    with open(log_file, "a") as log, contextlib.redirect_stdout(log):
+        try:
+            start = time.perf_counter()
+            func()
+            seconds = time.perf_counter() - start
+        except BaseException as e:
+            traceback.print_exc(file=log)
+            queue.put({'error': repr(e)})
+            return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    peak_rss = usage.ru_maxrss / 1024  # KB on linux
+    queue.put({'seconds': seconds,
+               'cpu_seconds': usage.ru_utime + usage.ru_stime - start_cpu.ru_utime - start_cpu.ru_stime,
+               'peak_rss_mb': peak_rss, 'peak_rss_increase_mb': max(peak_rss - start_rss, 0)})
+
+
+def run_stage(func, log_file):
+    context = multiprocessing.get_context('fork')  # the stage functions do not need to be importable
+    queue = context.Queue()
+    process = context.Process(target=measure, args=(func, log_file, queue))
+    process.start()
+    result = None
+    while result is None:  # the process may also be killed (e.g. out of memory) before it puts anything
+        alive = process.is_alive()  # checked first, so a result put just before the process ended is still read
+        try:
+            result = queue.get(timeout=POLL_SECONDS)
+        except Empty:
+            if not alive:
+                break
+    process.join()
+    if result is None or 'error' in result or process.exitcode != 0:
+        error = "exit code {}".format(process.exitcode) if result is None else result.get('error')
+        raise RuntimeError("The stage failed ({}), see '{}'".format(error, log_file))
+    return result
+
+
+def pipeline_stages(genes, bam_file, fasta_file, dge_file, reads_per_gene, gene_len):
+    # (name, function, setup, unit, number of units) of each stage. setup is run before each run of the stage
+    all_reads = reads_per_gene * len(genes)
+
+    def for_all_genes(func):
+        return lambda: [func(gene_name) for gene_name in genes]
+
+    def remove_dge_cache():
+        shutil.rmtree(dge_file + ".sparse", ignore_errors=True)
+
+    def all_genes_dataset():
+        with open("genes.txt", "w") as f:
+            f.write("\n".join(genes) + "\n")
+        distribution.create_mm_info_for_all_genes("genes.txt")
+
+    marker_pairs = [[a, b] for a in genes for b in genes if a < b] or [genes]
+    return [
+        ("parse_bam_into_store", for_all_genes(lambda g: sample_reads_from_BAM.parse_bam_into_store(g, bam_file, fasta_file)),
+         None, "reads", all_reads),
+        ("sample_reads", for_all_genes(lambda g: sample_reads_from_BAM.sample_reads(g, bam_file, fasta_file, [AMOUNT])),
+         None, "reads", all_reads),
+        ("count_mm_per_pos", for_all_genes(lambda g: sample_reads_from_BAM.count_mm_per_pos(g, fasta_file, AMOUNT)),
+         None, "reads", all_reads),
+        ("create_mismatches_info_file",
+         for_all_genes(lambda g: create_mismatches_info_and_barplots.create_mismatches_info_file(g, fasta_file, True)),
+         None, "positions", gene_len * len(genes)),
+        ("create_mm_info_for_all_genes", all_genes_dataset, None, "positions", gene_len * len(genes)),
+        ("count_reads_per_gene_and_cell", lambda: count_reads_per_gene_and_cell(bam_file), None, "reads", all_reads),
+        ("load_dge", lambda: load_dge(dge_file), remove_dge_cache, "genes", len(genes)),
+        ("find_expression_frequency", lambda: check_DGE.find_expression_frequency(dge_file), None, "genes", len(genes)),
+        ("screen_marker_sets", lambda: check_DGE.screen_marker_sets(dge_file, marker_pairs), None, "marker sets",
+         len(marker_pairs)),
+    ]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def run_benchmark(work_dir, reads_per_gene=20000, num_of_cells=500, gene_len=2000, genes=3, repeats=REPEATS):
+    params = {'reads_per_gene': reads_per_gene, 'cells': num_of_cells, 'gene_len': gene_len, 'genes': genes}
+    data_dir = os.path.abspath(os.path.join(work_dir, "data_{reads_per_gene}_{cells}_{gene_len}_{genes}".format(**params)))
+    if not os.path.exists(os.path.join(data_dir, "genes.txt")):
+        synthetic_data.generate(data_dir, reads_per_gene, num_of_cells, gene_len, genes)
+    gene_list = synthetic_data.gene_names(genes)
+    bam_file, fasta_file, dge_file = (os.path.join(data_dir, name) for name in ("full.bam", "ref.fasta", "dge.txt"))
+    os.chdir(data_dir)  # the gene directories are created here
+    load_reference(fasta_file)  # the reference store is built before the stages are timed
+    log_file = os.path.join(data_dir, "benchmark_log.txt")
+    open(log_file, "w").close()
+    results = {'commit': git_commit(), 'date': time.strftime("%Y-%m-%d %H:%M:%S"), 'python': platform.python_version(),
+               'numpy': np.__version__, 'cpus': os.cpu_count(), 'params': params, 'repeats': repeats, 'stages': {}}
+    for name, func, setup, unit, count in pipeline_stages(gene_list, bam_file, fasta_file, dge_file, reads_per_gene,
+                                                          gene_len):
+        runs = []
+        for _ in range(repeats):
+            if setup is not None:
+                setup()
+            runs.append(run_stage(func, log_file))
+        best = min(run['seconds'] for run in runs)
+        results['stages'][name] = {'seconds': best, 'runs': [run['seconds'] for run in runs],
+                                   'cpu_seconds': min(run['cpu_seconds'] for run in runs),
+                                   'unit': unit, 'count': count, 'per_second': count / best if best else None,
+                                   'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+                                   'peak_rss_increase_mb': max(run['peak_rss_increase_mb'] for run in runs)}
+        print("{:<32} {:>9.3f} s {:>14,.0f} {}/s {:>9.1f} MB peak (+{:.1f} MB)".format(
+            name, best, count / best if best else 0, unit, results['stages'][name]['peak_rss_mb'],
+            results['stages'][name]['peak_rss_increase_mb']))
+    results_file = os.path.join(os.path.abspath(os.path.join(data_dir, os.pardir)),
+                                "benchmark_{}.json".format(results['commit']))
+    with open(results_file, "w") as f:
+        json.dump(results, f, indent=1)
+    print("The results were saved to '{}'".format(results_file))
+    return results
+
+
+def compare(baseline, results):
+    # the time of each stage relative to its time in the baseline (a ratio above 1 is slower)
+    print("Compared with commit {} ({}):".format(baseline['commit'], baseline['date']))
+    if baseline['params'] != results['params']:
+        print("Note: the sizes of the data are different: {} and {}".format(baseline['params'], results['params']))
+    for name, stage in results['stages'].items():
+        if name not in baseline['stages']:
+            print("{:<32} new stage".format(name))
+            continue
+        before = baseline['stages'][name]
+        print("{:<32} {:>9.3f} s -> {:>9.3f} s  x{:.2f}   {:>9.1f} MB -> {:>9.1f} MB".format(
+            name, before['seconds'], stage['seconds'], stage['seconds'] / before['seconds'] if before['seconds'] else 0,
+            before['peak_rss_mb'], stage['peak_rss_mb']))
+
+
+if __name__ == '__main__':
+    args = sys.argv[2:]
+    baseline = None
+    if args and args[-1].endswith(".json"):  # optional, results to compare with (read before it may be overwritten)
+        with open(args.pop()) as f:
+            baseline = json.load(f)
+    work_dir = sys.argv[1]
+    sizes = [int(arg) for arg in args]  # optional: reads_per_gene, cells, gene_len, genes
+    results = run_benchmark(work_dir, *sizes)
+    if baseline is not None:
+        compare(baseline, results)
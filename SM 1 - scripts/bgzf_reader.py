@@ -0,0 +1,444 @@
+# Reader of BAM files that inflates the BGZF blocks of the file in parallel, in place of bamnostic.AlignmentFile.
+# A BAM file is a series of BGZF blocks, each one a separate deflate stream of up to 64KB. The compressed blocks are
+# read from the file in order and inflated by a pool of threads (zlib releases the GIL while it inflates), and at most
+# 'queue_size' blocks are inflated ahead of the block the records are parsed from.
+# The reads have the fields of the bamnostic reads that the scripts use: read_name, pos (0-based), query_sequence,
+# query_qualities, cigar, flag, reference_id, reference_name and tags (e.g. read.tags['XC'] == ('Z', 'CGCTGAAAGAGG')).
+# The reads of one reference (gene) are fetched through the index of the BAM file (.bai).
+# batches() decodes the reads in chunks of numpy arrays instead of one read object per read: the records of a chunk
+# are kept in one buffer, and each field of all the records is gathered out of it at once (see decode_records).
+
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+BGZF_HEADER = struct.Struct('<4BI2BH')  # ID1, ID2, CM, FLG, MTIME, XFL, OS, XLEN
+SEQ_CHARS = "=ACMGRSVTWYHKDBN"
+SEQ_PAIRS = [(SEQ_CHARS[b >> 4] + SEQ_CHARS[b & 15]).encode() for b in range(256)]
+CIGAR_OPS = "MIDNSHP=X"
+REF_CONSUMING_OPS = {0, 2, 3, 7, 8}  # M, D, N, =, X
+TAG_TYPES = {'c': 'b', 'C': 'B', 's': 'h', 'S': 'H', 'i': 'i', 'I': 'I', 'f': 'f'}
+META_BIN = 37450  # the pseudo bin of the index that holds the number of mapped and unmapped reads of the reference
+# the fixed size fields at the start of a record (after its block_size field):
+RECORD_DTYPE = np.dtype([('ref_id', '<i4'), ('pos', '<i4'), ('l_read_name', 'u1'), ('mapq', 'u1'), ('bin', '<u2'),
+                         ('n_cigar', '<u2'), ('flag', '<u2'), ('l_seq', '<i4'), ('next_ref_id', '<i4'),
+                         ('next_pos', '<i4'), ('tlen', '<i4')])
+TAG_SIZES = np.zeros(256, dtype=np.int64)  # size of the value of a tag by its type, 0 for the types of variable size
+for t, size in [('c', 1), ('C', 1), ('A', 1), ('s', 2), ('S', 2), ('i', 4), ('I', 4), ('f', 4)]:
+    TAG_SIZES[ord(t)] = size
+SIGNED_TAG_TYPES = [ord(t) for t in 'csi']
+
+
+class BamRead:
+    __slots__ = ['read_name', 'reference_id', 'reference_name', 'pos', 'mapq', 'flag', 'cigar', 'query_sequence',
+                 'query_qualities', 'tags']
+
+    @property
+    def cigarstring(self):
+        return "".join("{}{}".format(length, CIGAR_OPS[op]) for op, length in self.cigar)
+
+    @property
+    def reference_length(self):
+        return sum(length for op, length in self.cigar if op in REF_CONSUMING_OPS)
+
+
+def parse_tags(data, start, end):
+    tags = {}
+    while start < end:
+        tag = data[start:start + 2].decode()
+        val_type = chr(data[start + 2])
+        start += 3
+        if val_type in TAG_TYPES:
+            fmt = '<' + TAG_TYPES[val_type]
+            value = struct.unpack_from(fmt, data, start)[0]
+            start += struct.calcsize(fmt)
+            tags[tag] = ('f' if val_type == 'f' else 'i', value)
+        elif val_type == 'A':
+            tags[tag] = ('A', chr(data[start]))
+            start += 1
+        elif val_type in 'ZH':
+            null = data.index(0, start)
+            tags[tag] = (val_type, data[start:null].decode())
+            start = null + 1
+        elif val_type == 'B':
+            sub_type = chr(data[start])
+            count = struct.unpack_from('<i', data, start + 1)[0]
+            fmt = '<{}{}'.format(count, TAG_TYPES[sub_type])
+            tags[tag] = ('B', list(struct.unpack_from(fmt, data, start + 5)))
+            start += 5 + struct.calcsize(fmt)
+        else:
+            raise ValueError("Unknown type '{}' of tag '{}'".format(val_type, tag))
+    return tags
+
+
+def parse_read(data, start, end, references):
+    # the read in data[start:end], the record of the read without its block_size field
+    read = BamRead()
+    (ref_id, pos, l_read_name, mapq, _, n_cigar, flag, l_seq, _, _, _) = struct.unpack_from('<iiBBHHHiiii', data, start)
+    read.reference_id = ref_id
+    read.reference_name = references[ref_id] if ref_id >= 0 else None
+    read.pos = pos
+    read.mapq = mapq
+    read.flag = flag
+    i = start + 32
+    read.read_name = data[i:i + l_read_name - 1].decode()
+    i += l_read_name
+    cigar = struct.unpack_from('<{}I'.format(n_cigar), data, i)
+    read.cigar = [(c & 15, c >> 4) for c in cigar]
+    i += 4 * n_cigar
+    packed = (l_seq + 1) // 2
+    read.query_sequence = b"".join([SEQ_PAIRS[b] for b in data[i:i + packed]])[:l_seq].decode()
+    i += packed
+    read.query_qualities = bytes(data[i:i + l_seq])
+    i += l_seq
+    read.tags = parse_tags(data, i, end)
+    return read
+
+
+def ragged_gather(buf, starts, lengths):
+    # the items buf[starts[i]:starts[i]+lengths[i]] concatenated, and their offsets
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return buf[np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])], offsets
+
+
+def gather_uint(buf, starts, sizes):
+    # the little endian unsigned integers of 'sizes' bytes (up to 4) at 'starts'
+    value = np.zeros(len(starts), dtype=np.int64)
+    for byte in range(4):
+        has_byte = sizes > byte
+        idx = np.minimum(starts + byte, len(buf) - 1)
+        value |= np.where(has_byte, buf[idx].astype(np.int64) << (8 * byte), 0)
+    return value
+
+
+class RecordBatch:
+    # the fields of a chunk of records: numpy arrays with one item per record, and the variable length fields
+    # concatenated with their offsets (seq holds one base code of read_store.BASES per byte)
+    def __init__(self, ref_id, pos, n_cigar, flag, seq, seq_offsets, qual, names, name_offsets, cell_tags, NM):
+        self.ref_id = ref_id
+        self.pos = pos
+        self.n_cigar = n_cigar
+        self.flag = flag
+        self.seq = seq
+        self.seq_offsets = seq_offsets
+        self.qual = qual
+        self.names = names
+        self.name_offsets = name_offsets
+        self.cell_tags = cell_tags  # the XC tag of each read, as a fixed width bytes array
+        self.NM = NM
+
+    def __len__(self):
+        return len(self.pos)
+
+
+def record_fields(buf, starts):
+    # the fixed size fields of the records that start at 'starts' (after their block_size field)
+    return buf[starts[:, None] + np.arange(RECORD_DTYPE.itemsize)].view(RECORD_DTYPE).ravel()
+
+
+def find_tags(buf, tag_starts, ends, names):
+    # walks the tags of all the records together, one tag of every record at a time. returns for each tag name the
+    # position of its type byte in each record (-1 if the record has no such tag)
+    found = {name: np.full(len(tag_starts), -1, dtype=np.int64) for name in names}
+    nul = np.flatnonzero(buf == 0)
+    p = tag_starts.copy()
+    active = np.flatnonzero(p < ends)
+    while len(active):
+        q = p[active]
+        tag = buf[q].astype(np.int64) << 8 | buf[q + 1]
+        val_type = buf[q + 2]
+        for name in names:
+            is_tag = tag == (ord(name[0]) << 8 | ord(name[1]))
+            found[name][active[is_tag]] = q[is_tag] + 2
+        size = TAG_SIZES[val_type]
+        is_string = (val_type == ord('Z')) | (val_type == ord('H'))
+        size[is_string] = nul[np.searchsorted(nul, q[is_string] + 3)] - (q[is_string] + 3) + 1
+        is_array = val_type == ord('B')
+        if is_array.any():
+            count = gather_uint(buf, q[is_array] + 4, np.full(is_array.sum(), 4))
+            size[is_array] = 5 + count * TAG_SIZES[buf[q[is_array] + 3]]
+        p[active] = q + 3 + size
+        active = active[p[active] < ends[active]]
+    return found
+
+
+def decode_records(buf, starts):
+    # a RecordBatch of the records that start at 'starts' in buf. every field is gathered for all the records at once
+    fields = record_fields(buf, starts)
+    ends = starts + gather_uint(buf, starts - 4, np.full(len(starts), 4))
+    l_read_name = fields['l_read_name'].astype(np.int64)
+    l_seq = fields['l_seq'].astype(np.int64)
+    name_starts = starts + RECORD_DTYPE.itemsize
+    seq_starts = name_starts + l_read_name + 4 * fields['n_cigar'].astype(np.int64)
+    packed_lengths = (l_seq + 1) // 2
+    qual_starts = seq_starts + packed_lengths
+    names, name_offsets = ragged_gather(buf, name_starts, l_read_name - 1)
+    # the bases are packed two per byte, the high 4 bits first:
+    packed, packed_offsets = ragged_gather(buf, seq_starts, packed_lengths)
+    unpacked = np.empty(2 * len(packed), dtype=np.uint8)
+    unpacked[0::2] = packed >> 4
+    unpacked[1::2] = packed & 15
+    seq, seq_offsets = ragged_gather(unpacked, 2 * packed_offsets[:-1], l_seq)
+    qual, _ = ragged_gather(buf, qual_starts, l_seq)
+
+    tags = find_tags(buf, qual_starts + l_seq, ends, ['XC', 'NM'])
+    cell_tags = tag_strings(buf, tags['XC'], 'XC')
+    nm = tags['NM']
+    nm_types = buf[np.maximum(nm, 0)]
+    nm_sizes = np.where(nm < 0, 0, TAG_SIZES[nm_types])
+    NM = gather_uint(buf, nm + 1, nm_sizes)
+    negative = np.isin(nm_types, SIGNED_TAG_TYPES) & (nm_sizes > 0) & (NM >> np.maximum(8 * nm_sizes - 1, 0) & 1 == 1)
+    NM[negative] -= 1 << (8 * nm_sizes[negative])
+    return RecordBatch(fields['ref_id'], fields['pos'], fields['n_cigar'], fields['flag'], seq, seq_offsets, qual,
+                       names, name_offsets, cell_tags, NM.astype(np.int32))
+
+
+def tag_strings(buf, positions, name):
+    # the values of the string tags whose type bytes are at 'positions', as a fixed width bytes array
+    if (positions < 0).any():
+        raise KeyError(name)
+    nul = np.flatnonzero(buf == 0)
+    lengths = nul[np.searchsorted(nul, positions + 1)] - (positions + 1)
+    values, offsets = ragged_gather(buf, positions + 1, lengths)
+    width = max(int(lengths.max()), 1) if len(lengths) else 1
+    strings = np.zeros((len(positions), width), dtype=np.uint8)
+    strings[np.repeat(np.arange(len(positions)), lengths), np.arange(len(values)) - np.repeat(offsets[:-1], lengths)] = values
+    return strings.view('S{}'.format(width)).ravel()
+
+
+def decode_cell_tags(buf, starts):
+    # a RecordBatch of only the fixed size fields and the cell tags of the records, the tags are found by skipping
+    # over the names, bases and qualities of the records without decoding them
+    fields = record_fields(buf, starts)
+    ends = starts + gather_uint(buf, starts - 4, np.full(len(starts), 4))
+    l_seq = fields['l_seq'].astype(np.int64)
+    tag_starts = (starts + RECORD_DTYPE.itemsize + fields['l_read_name'] + 4 * fields['n_cigar'].astype(np.int64) +
+                  (l_seq + 1) // 2 + l_seq)
+    cell_tags = tag_strings(buf, find_tags(buf, tag_starts, ends, ['XC'])['XC'], 'XC')
+    return RecordBatch(fields['ref_id'], fields['pos'], fields['n_cigar'], fields['flag'], None, None, None, None,
+                       None, cell_tags, None)
+
+
+def read_index(bai_file):
+    # for each reference, the list of its chunks (pairs of virtual offsets), its linear index and its mapped and
+    # unmapped read counts
+    with open(bai_file, "rb") as f:
+        data = f.read()
+    if data[:4] != b'BAI\x01':
+        raise ValueError("'{}' is not a BAM index file".format(bai_file))
+    n_ref = struct.unpack_from('<i', data, 4)[0]
+    i = 8
+    index = []
+    for _ in range(n_ref):
+        n_bin = struct.unpack_from('<i', data, i)[0]
+        i += 4
+        chunks, stats = [], (0, 0)
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, i)
+            i += 8
+            bin_chunks = struct.unpack_from('<{}Q'.format(2 * n_chunk), data, i)
+            i += 16 * n_chunk
+            if bin_id == META_BIN:
+                stats = (bin_chunks[2], bin_chunks[3])
+            else:
+                chunks.extend(zip(bin_chunks[::2], bin_chunks[1::2]))
+        n_intv = struct.unpack_from('<i', data, i)[0]
+        linear = struct.unpack_from('<{}Q'.format(n_intv), data, i + 4)
+        i += 4 + 8 * n_intv
+        index.append((chunks, linear, stats))
+    return index
+
+
+class BamReader:
+    def __init__(self, bam_file, threads=None, queue_size=64):
+        self.bam_file = bam_file
+        self.threads = threads or min(8, os.cpu_count() or 1)
+        self.queue_size = queue_size
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.file = open(bam_file, "rb")
+        self._read_header()
+        self._index = None
+
+    def _read_header(self):
+        data = bytearray()
+        blocks = self._blocks(0)
+        while len(data) < 12:
+            data += next(blocks)
+        if data[:4] != b'BAM\x01':
+            raise ValueError("'{}' is not a BAM file".format(self.bam_file))
+        l_text = struct.unpack_from('<i', data, 4)[0]
+        need = 12 + l_text
+        while len(data) < need:
+            data += next(blocks)
+        self.text = data[8:8 + l_text].rstrip(b'\x00').decode()
+        n_ref = struct.unpack_from('<i', data, 8 + l_text)[0]
+        i = 12 + l_text
+        self.references, self.lengths = [], []
+        for _ in range(n_ref):
+            while len(data) < i + 4 or len(data) < i + 4 + struct.unpack_from('<i', data, i)[0] + 4:
+                data += next(blocks)
+            l_name = struct.unpack_from('<i', data, i)[0]
+            self.references.append(data[i + 4:i + 3 + l_name].decode())
+            self.lengths.append(struct.unpack_from('<i', data, i + 4 + l_name)[0])
+            i += 8 + l_name
+        self.references, self.lengths = tuple(self.references), tuple(self.lengths)
+        self.header_size = i  # the reads start after the header, at byte i of the inflated data
+        blocks.close()
+
+    def _compressed_blocks(self, file_offset):
+        # yields the compressed data of the BGZF blocks of the file, from the block at file_offset. the file is sought
+        # before each block, so several iterations over the file may be in progress
+        while True:
+            self.file.seek(file_offset)
+            header = self.file.read(BGZF_HEADER.size)
+            if len(header) < BGZF_HEADER.size:
+                return
+            xlen = BGZF_HEADER.unpack(header)[-1]
+            extra = self.file.read(xlen)
+            bsize = None
+            j = 0
+            while j < xlen:  # find the BC subfield that holds the size of the block
+                si1, si2, slen = extra[j], extra[j + 1], struct.unpack_from('<H', extra, j + 2)[0]
+                if si1 == 66 and si2 == 67:
+                    bsize = struct.unpack_from('<H', extra, j + 4)[0]
+                j += 4 + slen
+            if bsize is None:
+                raise ValueError("'{}' is not a BGZF file".format(self.bam_file))
+            yield self.file.read(bsize - xlen - 19)
+            file_offset += bsize + 1
+
+    def _blocks(self, file_offset):
+        # yields the inflated BGZF blocks from the block at file_offset, inflated by the threads ahead of time
+        pending = deque()
+        for cdata in self._compressed_blocks(file_offset):
+            pending.append(self.pool.submit(zlib.decompress, cdata, -15))
+            if len(pending) >= self.queue_size:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def _reads(self, file_offset, skip):
+        # yields (data, start, end) of the records of the file, the record is data[start:end] (without its size),
+        # starting from byte 'skip' of the inflated data from the block at file_offset
+        data = bytearray()
+        i = 0
+        for block in self._blocks(file_offset):
+            if skip:
+                if skip >= len(block):
+                    skip -= len(block)
+                    continue
+                block, skip = block[skip:], 0
+            data = data[i:] + block
+            i = 0
+            while len(data) - i >= 4:
+                block_size = struct.unpack_from('<i', data, i)[0]
+                if len(data) - i < 4 + block_size:
+                    break
+                yield data, i + 4, i + 4 + block_size
+                i += 4 + block_size
+
+    def _record_buffers(self, file_offset, skip, batch_size):
+        # yields (buf, starts) of chunks of up to batch_size records: buf is a uint8 array of the records and starts are
+        # the positions of the records in buf (after their block_size field)
+        data = bytearray()
+        i = 0
+        starts = []
+        for block in self._blocks(file_offset):
+            if skip:
+                if skip >= len(block):
+                    skip -= len(block)
+                    continue
+                block, skip = block[skip:], 0
+            data += block
+            while len(data) - i >= 4:
+                block_size = struct.unpack_from('<i', data, i)[0]
+                if len(data) - i < 4 + block_size:
+                    break
+                starts.append(i + 4)
+                i += 4 + block_size
+                if len(starts) == batch_size:
+                    yield np.frombuffer(bytes(data[:i]), dtype=np.uint8), np.array(starts, dtype=np.int64)
+                    data, i, starts = data[i:], 0, []
+        if starts:
+            yield np.frombuffer(bytes(data[:i]), dtype=np.uint8), np.array(starts, dtype=np.int64)
+
+    def batches(self, contig=None, batch_size=100000, no_indels=False, cell_tags_only=False):
+        # yields RecordBatches of the reads of the reference 'contig' (of all the reads if contig is None), fetched
+        # through the index if there is one. with no_indels, only the reads with one CIGAR operation are decoded.
+        # with cell_tags_only, only the fixed size fields and the cell tags are decoded
+        if contig is None:
+            tid, buffers = None, self._record_buffers(0, self.header_size, batch_size)
+        else:
+            tid = self.references.index(contig)
+            try:
+                chunks = self.index[tid][0]
+            except OSError:  # no index, all the file is read
+                chunks = None
+            if chunks == []:
+                return
+            offset = min(beg for beg, end in chunks) if chunks else None
+            buffers = (self._record_buffers(0, self.header_size, batch_size) if offset is None else
+                       self._record_buffers(offset >> 16, offset & 0xFFFF, batch_size))
+        seen = False
+        for buf, starts in buffers:
+            fields = record_fields(buf, starts)
+            keep = np.ones(len(starts), dtype=bool)
+            done = False
+            if tid is not None:
+                keep = fields['ref_id'] == tid
+                if chunks and (seen or keep.any()):  # the reads of the reference are consecutive in the file
+                    first = 0 if seen else int(np.argmax(keep))
+                    after = np.flatnonzero(~keep[first:])
+                    if len(after):
+                        keep[first + after[0]:] = False
+                        done = True
+                    seen = True
+            if no_indels:
+                keep &= fields['n_cigar'] == 1
+            yield decode_cell_tags(buf, starts[keep]) if cell_tags_only else decode_records(buf, starts[keep])
+            if done:
+                return
+
+    def __iter__(self):
+        for data, start, end in self._reads(0, self.header_size):
+            yield parse_read(data, start, end, self.references)
+
+    @property
+    def index(self):
+        # the index of the BAM file, raises FileNotFoundError if the file has no index
+        if self._index is None:
+            bai_file = self.bam_file + ".bai"
+            if not os.path.exists(bai_file):
+                bai_file = os.path.splitext(self.bam_file)[0] + ".bai"
+            self._index = read_index(bai_file)
+        return self._index
+
+    def get_index_stats(self):
+        # (mapped, unmapped, total) number of reads of each reference, as in bamnostic
+        return [(mapped, unmapped, mapped + unmapped) for _, _, (mapped, unmapped) in self.index]
+
+    def fetch(self, contig, start=0, stop=None):
+        # the reads of the reference 'contig' that overlap positions [start, stop) (0-based)
+        tid = self.references.index(contig)
+        stop = self.lengths[tid] if stop is None else stop
+        chunks, linear, _ = self.index[tid]
+        if not chunks:
+            return
+        offset = min(beg for beg, end in chunks)
+        if linear and start >> 14 < len(linear):
+            offset = max(offset, linear[start >> 14])
+        for data, begin, end in self._reads(offset >> 16, offset & 0xFFFF):
+            ref_id, pos = struct.unpack_from('<ii', data, begin)
+            if ref_id != tid or pos >= stop:
+                return
+            read = parse_read(data, begin, end, self.references)
+            if pos + max(read.reference_length, 1) > start:
+                yield read
+
+    def close(self):
+        self.file.close()
+        self.pool.shutdown()
@@ -0,0 +1,75 @@
+# Density estimation of the mismatch % of all the positions without keeping the values: the values are added chunk by
+# chunk (e.g. gene by gene) into fine bins, and the density is computed from the bins by convolving them with a
+# gaussian kernel through FFT. The memory and the time of the convolution depend only on the number of bins.
+# The estimate is the one of seaborn's kdeplot (gaussian kernel, Scott's bandwidth, the curve extended by 3 bandwidths
+# beyond the values). Each value is split between the 2 grid points around it (linear binning), and the count, sum,
+# sum of squares, minimum and maximum of the values are kept per bin, so the bandwidth and the range of the curve are
+# exact, and the density of only the values >= a cutoff is computed from the same bins (the cutoff is rounded to the
+# bin width).
+
+import numpy as np
+from scipy.signal import fftconvolve
+
+CUT = 3  # the curve is extended by CUT bandwidths beyond the smallest and the largest value, as in seaborn
+KERNEL_SIGMAS = 5  # the gaussian kernel is truncated at KERNEL_SIGMAS bandwidths
+
+
+class BinnedValues:
+    def __init__(self, low=0, high=100, bin_width=0.005):
+        self.low = low
+        self.bin_width = bin_width
+        self.num_of_bins = int(round((high - low) / bin_width)) + 1  # bin i has the values in [grid[i], grid[i+1])
+        self.count = np.zeros(self.num_of_bins, dtype=np.int64)
+        self.upper = np.zeros(self.num_of_bins)  # the part of the values of the bin that goes to the next grid point
+        self.sum = np.zeros(self.num_of_bins)
+        self.sum_sq = np.zeros(self.num_of_bins)
+        self.min = np.full(self.num_of_bins, np.inf)
+        self.max = np.full(self.num_of_bins, -np.inf)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        scaled = (values - self.low) / self.bin_width
+        bins = np.clip(np.floor(scaled).astype(np.int64), 0, self.num_of_bins - 1)
+        self.count += np.bincount(bins, minlength=self.num_of_bins)
+        self.upper += np.bincount(bins, np.clip(scaled - bins, 0, 1), minlength=self.num_of_bins)
+        self.sum += np.bincount(bins, values, minlength=self.num_of_bins)
+        self.sum_sq += np.bincount(bins, values * values, minlength=self.num_of_bins)
+        np.minimum.at(self.min, bins, values)
+        np.maximum.at(self.max, bins, values)
+
+    def first_bin(self, cutoff=0):
+        return int(np.clip(np.ceil(round((cutoff - self.low) / self.bin_width, 6)), 0, self.num_of_bins))
+
+    def num_of_values(self, cutoff=0):
+        return int(self.count[self.first_bin(cutoff):].sum())
+
+    def bandwidth(self, cutoff=0):
+        # Scott's rule, as scipy's gaussian_kde: the standard deviation (ddof=1) * n ** (-1/5)
+        first = self.first_bin(cutoff)
+        n = self.count[first:].sum()
+        if n < 2:
+            return 0.0
+        mean = self.sum[first:].sum() / n
+        var = max(self.sum_sq[first:].sum() - n * mean * mean, 0) / (n - 1)
+        return np.sqrt(var) * n ** (-1 / 5)
+
+    def kde(self, cutoff=0):
+        # the grid and the density of the values >= cutoff. empty arrays if there are less than 2 different values
+        first = self.first_bin(cutoff)
+        n = self.count[first:].sum()
+        bw = self.bandwidth(cutoff)
+        if bw == 0:
+            return np.empty(0), np.empty(0)
+        weights = np.zeros(self.num_of_bins + 1)
+        weights[first:-1] += self.count[first:] - self.upper[first:]
+        weights[first + 1:] += self.upper[first:]
+        sigma = bw / self.bin_width  # in bins
+        pad = int(np.ceil((CUT + KERNEL_SIGMAS) * sigma))
+        offsets = np.arange(-int(np.ceil(KERNEL_SIGMAS * sigma)), int(np.ceil(KERNEL_SIGMAS * sigma)) + 1)
+        kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+        kernel /= kernel.sum()
+        density = fftconvolve(np.pad(weights, pad), kernel, mode='same') / (n * self.bin_width)
+        grid = self.low + self.bin_width * np.arange(-pad, self.num_of_bins + 1 + pad)
+        support = (grid >= self.min[first:].min() - CUT * bw) & (grid <= self.max[first:].max() + CUT * bw)
+        return grid[support], np.maximum(density[support], 0)
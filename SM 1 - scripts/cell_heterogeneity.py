@@ -0,0 +1,209 @@
+# Scoring every position of every gene for heterogeneity of its mismatches between the cells, in place of choosing a
+# range of mismatch % (distribution.get_positions_by_percentage_range) and looking at single positions by hand
+# (cell_mm_variance.explore_mm_by_cells_in_position and the heatmaps).
+# Usage: python cell_heterogeneity.py <genes_file> [cap] [min_qual] [workers]
+# At each position, cell i has n_i sampled reads covering the position and k_i of them have a good quality mismatch
+# there. The statistic is the number of pairs of reads with a mismatch that are of the same cell, P = sum(k_i*(k_i-1)/2),
+# which is the part of Tarone's score test of the binomial against the beta-binomial (over-dispersion of the k_i
+# between the cells) that varies when the total number of mismatches K is given. Under homogeneity, the K reads with
+# mismatches are any K of the N = sum(n_i) reads, so the mean and variance of P are known exactly from the factorial
+# moments of the multivariate hypergeometric distribution (from the sums over the cells of n_i^(2), n_i^(3), n_i^(4)
+# and n_i^(2)^2, x^(r) is the falling factorial). The p value is the upper tail of a negative binomial (or a binomial,
+# when the variance is smaller than the mean) of the same mean and variance. With the few reads of each cell in the
+# sample (and a handful of mismatches at most positions), the normal approximations of Tarone's z and of the chi-square
+# test of the (cell x mismatch) table give p values that are far too small, while this approximation is close to the
+# exact tail.
+# The sums are computed for all the positions of a gene at once: the coverage of every cell is kept as runs of
+# constant coverage (from the starts and ends of its reads), and the (cell, position) counts of the mismatches are
+# looked up in the runs, so the work grows with the number of reads and not with the number of cells times positions.
+# The genes are scored by a pool of processes, and the p values of all the tested positions are corrected together
+# (Benjamini-Hochberg). The ranked table is saved to 'mm_heterogeneity_cap<cap>.csv'.
+# By default the reads of each gene are the sample its counts, info and barplots are of (the cap recorded in its
+# mismatch store, see mm_store.py), a cap (or 'all', all the sampled reads) can be given instead.
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import stats
+import stage_metrics
+from mm_counting import MIN_QUAL, HIST_NUCS, HIST_INDEX
+from mm_info import read_mismatch_info
+from mm_store import ALL_READS, MismatchStore
+from read_store import ReadTable
+from sample_reads_from_BAM import get_file_prefix
+
+MIN_MISMATCHES = 3  # positions with fewer mismatches are not tested
+output_file = "mm_heterogeneity.csv"
+
+
+def coverage_runs(pos, lengths, cell, gene_len):
+    # the coverage of each cell as runs: the keys (sorted) are cell * (gene_len + 2) + start position of each run, and
+    # run j has coverage levels[j] until the next run of the cell
+    ends = np.minimum(pos + lengths, gene_len + 1)
+    span = gene_len + 2
+    keys, inverse = np.unique(np.concatenate([cell * span + pos, cell * span + ends]), return_inverse=True)
+    delta = np.bincount(inverse, weights=np.repeat([1, -1], len(pos)), minlength=len(keys))
+    levels = np.cumsum(delta).astype(np.int64)  # the events of each cell sum to 0, so the levels start at 0 per cell
+    return keys, levels
+
+
+def falling(x, r):
+    # the falling factorial x * (x-1) * ... * (x-r+1)
+    result = np.ones(np.shape(x))
+    for j in range(r):
+        result = result * (x - j)
+    return result
+
+
+def cell_sums(table, mismatches, gene_len):
+    # per position sums over the cells: n, n^(2), n^(3), n^(4), n^(2)^2, (n > 0), k, k^(2) and (k > 0), and the counts
+    # of each mismatch nucleotide. mismatches are the (pos, nuc, qual, cell) arrays of the good quality mismatches
+    pos = np.asarray(table.pos, dtype=np.int64)
+    cell = np.asarray(table.cell, dtype=np.int64)
+    span = gene_len + 2
+    keys, levels = coverage_runs(pos, table.lengths.astype(np.int64), cell, gene_len)
+    run_pos = keys % span
+    covered = levels > 0  # a covered run ends at the next key, which is of the same cell
+    run_end = np.append(run_pos[1:], 0)[covered]
+    run_start, run_level = run_pos[covered], levels[covered]
+
+    def run_sum(values):
+        # sum over the cells of values at each position, values are per run
+        diff = np.bincount(run_start, values, span) - np.bincount(run_end, values, span)
+        return np.round(np.cumsum(diff)[1:gene_len + 1])
+
+    sums = {'n': run_sum(run_level), 'cells': run_sum(np.ones(len(run_level)))}
+    for r in (2, 3, 4):
+        sums['n{}'.format(r)] = run_sum(falling(run_level, r))
+    sums['n2_2'] = run_sum(falling(run_level, 2) ** 2)
+    mm_pos, mm_nuc, mm_cell = np.asarray(mismatches[0], dtype=np.int64), mismatches[1], mismatches[3]
+    mm_keys, k = np.unique(mm_cell.astype(np.int64) * span + mm_pos, return_counts=True)
+    at = mm_keys % span - 1
+    for name, values in (('k', k), ('k2', falling(k, 2)), ('mm_cells', np.ones(len(k)))):
+        sums[name] = np.bincount(at, values, gene_len)
+    nuc_counts = np.bincount((mm_pos - 1) * len(HIST_NUCS) + HIST_INDEX[mm_nuc], minlength=gene_len * len(HIST_NUCS))
+    return sums, nuc_counts.reshape(gene_len, len(HIST_NUCS))
+
+
+def pair_moments(sums):
+    # the mean and variance of the number of same cell pairs of reads with mismatches, P = sum(k^(2))/2, when the
+    # K reads with mismatches are any K of the N reads: E[k_i^(r)] = n_i^(r) * K^(r) / N^(r), and for i != j
+    # E[k_i^(2) * k_j^(2)] = n_i^(2) * n_j^(2) * K^(4) / N^(4), with (k^(2))^2 = k^(4) + 4k^(3) + 2k^(2)
+    n, k = sums['n'], sums['k']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = [np.ones(len(n))]
+        for j in range(4):  # K^(r) / N^(r), as a product of ratios so it does not overflow
+            ratio.append(ratio[-1] * (k - j) / (n - j))
+        mean = ratio[2] * sums['n2']
+        square = (ratio[4] * sums['n4'] + 4 * ratio[3] * sums['n3'] + 2 * ratio[2] * sums['n2'] +
+                  ratio[4] * (sums['n2'] ** 2 - sums['n2_2']))
+    return mean / 2, np.maximum(square - mean ** 2, 0) / 4
+
+
+def heterogeneity_tests(sums, min_mismatches=MIN_MISMATCHES):
+    # the number of same cell pairs of reads with mismatches at every position, its expected value, z score and p
+    # value. positions that are not tested (too few mismatches, or no possible variation) have NaN
+    pairs = sums['k2'] / 2
+    mean, var = pair_moments(sums)
+    tested = (sums['k'] >= min_mismatches) & (var > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(tested, (pairs - mean) / np.sqrt(var), np.nan)
+        # over-dispersed: a negative binomial of r successes, under-dispersed: a binomial of 'trials' trials, and a
+        # poisson where the variance is the mean
+        r = mean ** 2 / (var - mean)
+        nb_p = stats.nbinom.sf(pairs - 1, r, r / (r + mean))
+        trials = np.maximum(np.round(mean ** 2 / (mean - var)), np.ceil(mean))
+        binom_p = np.where(np.isfinite(trials), stats.binom.sf(pairs - 1, trials, mean / trials),
+                           stats.poisson.sf(pairs - 1, mean))
+    p_value = np.where(tested, np.where(var > mean, nb_p, binom_p), np.nan)
+    return {'same cell pairs': np.where(tested, pairs, np.nan), 'expected pairs': np.where(tested, mean, np.nan),
+            'z': z, 'p value': p_value}
+
+
+def score_gene(gene_name, cap=None, min_qual=MIN_QUAL, min_mismatches=MIN_MISMATCHES):
+    # the tested positions of the gene as a DataFrame, its length and the cap that was used (None is all the reads).
+    # the reads are of the same sample as the mismatches of the store
+    file_prefix = get_file_prefix(gene_name)
+    store = MismatchStore(file_prefix + "sample_pos_good_quality_mm", cap, min_qual)
+    table = ReadTable.load(file_prefix + "bam_sample_reads").up_to_rank(store.cap)
+    gene_len = store.gene_len
+    sums, nuc_counts = cell_sums(table, store.all_arrays(), gene_len)
+    tests = heterogeneity_tests(sums, min_mismatches)
+    rows = np.flatnonzero(~np.isnan(tests['z']))
+    df = pd.DataFrame({'gene_name': gene_name, 'position': rows + 1})
+    info_file = file_prefix + "sample_good_quality_mismatch_info"
+    if os.path.isdir(info_file) or os.path.exists(info_file + ".csv"):
+        df['reference'] = read_mismatch_info(info_file, ['reference'])['reference'].to_numpy()[rows]
+    df['coverage'] = sums['n'][rows].astype(np.int64)
+    df['mismatches'] = sums['k'][rows].astype(np.int64)
+    df['mismatch %'] = df['mismatches'] / df['coverage'] * 100
+    df['cells'] = sums['cells'][rows].astype(np.int64)
+    df['cells with mismatches'] = sums['mm_cells'][rows].astype(np.int64)
+    df['top mismatch'] = np.array(HIST_NUCS)[nuc_counts[rows].argmax(axis=1)]
+    for name, values in tests.items():
+        df[name] = values[rows]
+    return df, gene_len, store.cap
+
+
+def bh_qvalues(p_values):
+    # Benjamini-Hochberg adjusted p values (q values)
+    p_values = np.asarray(p_values, dtype=np.float64)
+    order = np.argsort(p_values)
+    ranked = p_values[order] * len(p_values) / np.arange(1, len(p_values) + 1)
+    q = np.minimum.accumulate(ranked[::-1])[::-1]
+    q_values = np.empty_like(p_values)
+    q_values[order] = np.minimum(q, 1)
+    return q_values
+
+
+def get_output_file(cap=None, min_qual=MIN_QUAL):
+    # cap is the cap that was used, None is all the sampled reads
+    name = output_file.replace(".csv", "_cap{}.csv".format('all' if cap is None else cap))
+    if min_qual != MIN_QUAL:
+        name = name.replace(".csv", "_q{}.csv".format(min_qual))
+    return name
+
+
+@stage_metrics.measured()
+def score_all_genes(genes, cap=None, min_qual=MIN_QUAL, workers=None, min_mismatches=MIN_MISMATCHES):
+    # the ranked table of the tested positions of all the genes, scored by a pool of 'workers' processes (default is
+    # the number of CPUs). the positions are ranked by p value, with the most over-dispersed first among ties.
+    # without a cap, all the genes must have been sampled with the same cap, so the table is of one sample
+    print("Scoring the heterogeneity between cells of all the positions of {} genes".format(len(genes)))
+    n = len(genes)
+    tables, caps = [], {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i, (df, gene_len, gene_cap) in enumerate(pool.map(score_gene, genes, [cap] * n, [min_qual] * n,
+                                                              [min_mismatches] * n, chunksize=8), 1):
+            tables.append(df)
+            caps.setdefault(gene_cap, genes[i - 1])
+            stage_metrics.count(gene_len, "positions")
+            if i % 100 == 0 or i == n:
+                print("{} of {} genes were scored".format(i, n))
+    if len(caps) > 1:
+        raise ValueError("The genes were sampled with different caps ({}), pass the cap to use".format(
+            ", ".join("{} in '{}'".format('all' if c is None else c, gene_name) for c, gene_name in caps.items())))
+    used_cap = next(iter(caps)) if caps else None if cap in (None, ALL_READS) else cap
+    ranked = pd.concat(tables, ignore_index=True)
+    ranked['q value'] = bh_qvalues(ranked['p value'])
+    ranked = ranked.sort_values(['p value', 'z'], ascending=[True, False], kind='stable', ignore_index=True)
+    file_name = get_output_file(used_cap, min_qual)
+    ranked.to_csv(file_name, index=False)
+    print("{} positions were tested, {} of them with q value < 0.05".format(len(ranked),
+                                                                        int((ranked['q value'] < 0.05).sum())))
+    print("The most heterogeneous positions:")
+    print(ranked.head(20))
+    print("The results were saved to '{}'".format(file_name))
+    return ranked
+
+
+if __name__ == '__main__':
+    genes_file = sys.argv[1]  # "genes_to_use.txt"
+    # optional, reads per cell (or 'all'), default is the sample of the counts of the genes:
+    cap = None if len(sys.argv) <= 2 else ALL_READS if sys.argv[2] == 'all' else int(sys.argv[2])
+    min_qual = int(sys.argv[3]) if len(sys.argv) > 3 else MIN_QUAL  # optional, quality cutoff of the mismatches
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else None  # optional, number of processes
+    with open(genes_file) as f:
+        score_all_genes([line.strip() for line in f if line.strip()], cap, min_qual, workers)
@@ -1,25 +1,29 @@
-import pickle
+import json
+import os
+import sys
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import seaborn as sns
+from scipy import sparse
+from bam_reader import intern_cells
+from mm_counting import MIN_QUAL, HIST_NUCS, HIST_INDEX
+from mm_store import ALL_READS, load_mm_dict, MismatchStore
+from sample_reads_from_BAM import get_file_prefix
 
 def see(pos):
-    file = open("pos_good_quality_mm_dict.pkl", "rb")
-    "sample_pos_good_quality_mm_dict.pkl"
-    good_dict = pickle.load(file)
+    good_dict = load_mm_dict("pos_good_quality_mm")
     print(f"looking at position {pos} in the gene:")
     print(good_dict[pos][:10])
     print(len(good_dict[pos]))
-    file = open("sample_pos_good_quality_mm_dict.pkl", "rb")
-    good_dict = pickle.load(file)
+    good_dict = load_mm_dict("sample_pos_good_quality_mm")
     print(f"looking at position {pos} in the gene:")
     print(good_dict[pos][:10])
     print(len(good_dict[pos]))
 
 
 def explore_mm_by_cells_in_position(pos_mm_dict_file, pos):
-    file = open(pos_mm_dict_file, "rb")
-    good_dict = pickle.load(file)
+    good_dict = load_mm_dict(pos_mm_dict_file)  # only the requested position is read from a mismatch store
     print("looking at position {} in the gene:".format(pos))
     print("first 10 items in the dictionary {}:\n".format(pos_mm_dict_file), good_dict[pos][:10])
     print("number of mismatches found at this position: ", len(good_dict[pos]))
@@ -60,6 +64,92 @@ def explore_mm_by_cells_in_position(pos_mm_dict_file, pos):
           "for each cell separately".format(res_file))
 
 
+class CellMismatchMatrices:
+    # the cell x nucleotide count matrices of the mismatches at many (gene, position) pairs, stacked side by side in one
+    # sparse matrix: row c is the cell cells[c], and columns i*5:(i+1)*5 are the counts of A, T, C, G and N at pairs[i].
+    # the cells with mismatches at pairs[i] are cell_order[pair_offsets[i]:pair_offsets[i+1]], in the order they first
+    # appear in the mismatches of the position
+    def __init__(self, pairs, cells, counts, cell_order, pair_offsets):
+        self.pairs = pairs
+        self.cells = cells
+        self.counts = counts
+        self.cell_order = cell_order
+        self.pair_offsets = pair_offsets
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def position_matrix(self, i, nucs=HIST_NUCS[:4]):
+        # the counts at pairs[i] of the cells with mismatches there, as in explore_mm_by_cells_in_position
+        cells = self.cell_order[self.pair_offsets[i]:self.pair_offsets[i + 1]]
+        columns = [i * len(HIST_NUCS) + HIST_NUCS.index(nuc) for nuc in nucs]
+        values = self.counts[cells][:, columns].toarray()
+        return pd.DataFrame(values, index=[self.cells[c] for c in cells], columns=list(nucs))
+
+    def export_csv(self):
+        # one csv file for each pair, in the directory of its gene
+        for i, (gene_name, pos) in enumerate(self.pairs):
+            self.position_matrix(i).to_csv(get_file_prefix(gene_name) + "position_{}-mm_count_per_cell.csv".format(pos))
+        print("Created {} files of the count of each nucleotide that appeared as mismatch at the position, for each "
+              "cell separately".format(len(self.pairs)))
+
+    def save(self, out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+        sparse.save_npz(os.path.join(out_dir, "counts.npz"), self.counts)
+        np.save(os.path.join(out_dir, "cells.npy"), np.array([c.encode() for c in self.cells], dtype='S'))
+        np.save(os.path.join(out_dir, "cell_order.npy"), self.cell_order)
+        np.save(os.path.join(out_dir, "pair_offsets.npy"), self.pair_offsets)
+        with open(os.path.join(out_dir, "pairs.json"), "w") as f:
+            json.dump([[gene_name, int(pos)] for gene_name, pos in self.pairs], f)
+
+
+def load_cell_mm_matrices(out_dir):
+    with open(os.path.join(out_dir, "pairs.json")) as f:
+        pairs = [tuple(pair) for pair in json.load(f)]
+    return CellMismatchMatrices(pairs, [c.decode() for c in np.load(os.path.join(out_dir, "cells.npy"))],
+                                sparse.load_npz(os.path.join(out_dir, "counts.npz")).tocsr(),
+                                np.load(os.path.join(out_dir, "cell_order.npy")),
+                                np.load(os.path.join(out_dir, "pair_offsets.npy")))
+
+
+def cell_mm_matrices(pairs, store_name="sample_pos_good_quality_mm", cap=None, min_qual=MIN_QUAL):
+    # the per cell mismatch counts at all the (gene, position) pairs. the mismatches of all the positions of a gene are
+    # read from its mismatch store at once, and the cells of all the genes share one cells dictionary. without a cap,
+    # the mismatches of each gene are of the sample its info and barplots are of (see mm_store.py), ALL_READS is all
+    # the sampled reads
+    pairs = [(gene_name, int(pos)) for gene_name, pos in pairs]
+    by_gene = {}
+    for i, (gene_name, pos) in enumerate(pairs):
+        by_gene.setdefault(gene_name, []).append(i)
+    cell_ids = {}
+    pair_of, nuc_of, cell_of = [], [], []
+    for gene_name, indices in by_gene.items():
+        store = MismatchStore(get_file_prefix(gene_name) + store_name, cap, min_qual)
+        pair_idx, nuc, cell = store.gather([pairs[i][1] for i in indices])
+        pair_of.append(np.asarray(indices, dtype=np.int64)[pair_idx])
+        nuc_of.append(HIST_INDEX[nuc])
+        cell_of.append(intern_cells(store.cell_tags_of(cell), cell_ids) if len(cell) else np.zeros(0, np.int32))
+    pair_of, nuc_of, cell_of = (np.concatenate(a) if a else np.zeros(0, np.int64) for a in (pair_of, nuc_of, cell_of))
+    shape = (len(cell_ids), len(pairs) * len(HIST_NUCS))
+    counts = sparse.csr_matrix((np.ones(len(cell_of), dtype=np.int32), (cell_of, pair_of * len(HIST_NUCS) + nuc_of)),
+                               shape=shape)
+    # the cells of each pair, in the order they first appear:
+    num_of_cells = max(len(cell_ids), 1)
+    keys, first = np.unique(pair_of * num_of_cells + cell_of, return_index=True)
+    keys = keys[np.lexsort((first, keys // num_of_cells))]
+    cell_order = (keys % num_of_cells).astype(np.int32)
+    pair_offsets = np.searchsorted(keys // num_of_cells, np.arange(len(pairs) + 1))
+    print("Counted the mismatches of {} cells at {} positions of {} genes".format(len(cell_ids), len(pairs),
+                                                                                  len(by_gene)))
+    return CellMismatchMatrices(pairs, list(cell_ids), counts, cell_order, pair_offsets)
+
+
+def read_pairs_file(pairs_file):
+    # a csv file with 'gene_name' and 'position' columns, e.g. the results of distribution.get_positions_by_percentage_range
+    df = pd.read_csv(pairs_file, usecols=['gene_name', 'position'])
+    return list(zip(df['gene_name'], df['position']))
+
+
 def plot_heatmap(pos):
     file = "position_{}-mm_count_per_cell.csv".format(pos)
     print("Using the previously created file {} for generating a heatmap".format(file))
@@ -97,7 +187,19 @@ def plot_heatmap(pos):
 
 
 if __name__ == '__main__':
-    position = 808
-    pos_mm_dict = "sample_pos_good_quality_mm_dict.pkl"
-    explore_mm_by_cells_in_position(pos_mm_dict, position)
-    plot_heatmap(position)
\ No newline at end of file
+    if len(sys.argv) > 1:  # batch mode: cell_mm_variance.py <pairs_file> [export_csv] [cap]
+        pairs_file = sys.argv[1]  # csv file of (gene_name, position) pairs
+        export_csv = len(sys.argv) > 2 and sys.argv[2] == '1'  # optional, binary: a csv file for each pair
+        # optional, reads per cell (or 'all'), default is the sample of the counts of each gene:
+        cap = None if len(sys.argv) <= 3 else ALL_READS if sys.argv[3] == 'all' else int(sys.argv[3])
+        matrices = cell_mm_matrices(read_pairs_file(pairs_file), cap=cap)
+        out_dir = os.path.splitext(pairs_file)[0] + "-mm_count_per_cell"
+        matrices.save(out_dir)
+        print("The count matrices were saved in '{}'".format(out_dir))
+        if export_csv:
+            matrices.export_csv()
+    else:
+        position = 808
+        pos_mm_dict = "sample_pos_good_quality_mm"  # a mismatch store directory, or a position dictionary pkl file
+        explore_mm_by_cells_in_position(pos_mm_dict, position)
+        plot_heatmap(position)
\ No newline at end of file
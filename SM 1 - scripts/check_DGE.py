@@ -1,13 +1,13 @@
-import pandas as pd
+import stage_metrics
+from dge_matrix import load_dge
 
 
+@stage_metrics.measured()
 def find_expression_frequency(dge_file):
-    dge_df = pd.read_csv(dge_file, delimiter="\t", index_col=0) # the index is the names of the genes
-    num_of_genes = len(dge_df.columns)
+    dge = load_dge(dge_file)  # sparse (genes x cells) counts, parsed once and cached
     # calculate frequency of cells that express each gene:
-    dge_df[">0 freq"] = (dge_df.gt(0).sum(axis=1))/num_of_genes*100
-    dge_df["num of cells"] = dge_df[dge_df.columns[:-1]].gt(0).sum(axis=1)
-    dge_df["num of reads"] = dge_df[dge_df.columns[:-2]].sum(axis=1)
+    dge_df = dge.expression_frequency()
+    stage_metrics.count(len(dge_df), "genes")
     dge_df = dge_df.sort_values(">0 freq") # sort by frequency
     print("All the genes with frequency of cells that express them:")
     print(dge_df.loc[:, dge_df.columns[-3:]])
@@ -16,23 +16,31 @@ def find_expression_frequency(dge_file):
     print(high_exp_df.loc[:, dge_df.columns[-3:]])
 
 
+@stage_metrics.measured()
 def DGE_sanity_check(dge_file, type1_markers, type2_markers):
-    dge_df = pd.read_csv(dge_file, delimiter="\t", index_col=0)
-    num_of_cells = len(dge_df.columns)
-    type1_co = check_coexpression(dge_df, type1_markers)
-    print("Number of cells to co-express the genes {} is: {}".format(type1_markers, len(type1_co.columns)))
-    print("which is {}% of the cells".format(round(len(type1_co.columns)/num_of_cells*100, 2)))
-    type1_and_type2_co = check_coexpression(dge_df, type1_markers+type2_markers)
-    print("Number of cells to co-express the genes {} is: {}".format(type1_markers+type2_markers, len(type1_and_type2_co.columns)))
-    print("which is {}% of the cells".format(round(len(type1_and_type2_co.columns) / num_of_cells * 100), 2))
-    print("and {}% of the cells that co-express the genes {}".format(round(len(type1_and_type2_co.columns)/len(type1_co.columns)*100 , 2), type1_markers))
-
-
-def check_coexpression(dge_df, markers):
-    df_markers = dge_df.loc[markers, :]  # only the rows of the markers
-    filter = (df_markers > 0).all()  # returns a series of bools, that represent if each col contains only values > 0 or not.
-    df_co = df_markers.loc[:, filter] # only the columns of cells that co-express the markers
-    return df_co
+    index = load_dge(dge_file).coexpression_index()  # bitmaps of the cells that express each gene
+    num_of_cells = index.num_of_cells
+    co = index.query([type1_markers, type1_markers+type2_markers])
+    type1_co, type1_and_type2_co = co["num of cells"]
+    print("Number of cells to co-express the genes {} is: {}".format(type1_markers, type1_co))
+    print("which is {}% of the cells".format(round(type1_co/num_of_cells*100, 2)))
+    print("Number of cells to co-express the genes {} is: {}".format(type1_markers+type2_markers, type1_and_type2_co))
+    print("which is {}% of the cells".format(round(type1_and_type2_co / num_of_cells * 100), 2))
+    print("and {}% of the cells that co-express the genes {}".format(round(type1_and_type2_co/type1_co*100 , 2), type1_markers))
+
+
+def check_coexpression(dge, markers):
+    # the indices of the cells that co-express the markers
+    return dge.coexpression_index().query([markers], return_cells=True)["cells"][0]
+
+
+@stage_metrics.measured()
+def screen_marker_sets(dge_file, marker_sets, base_sets=None):
+    # the co-expression of many sets of markers at once, e.g. of all the pairs of markers of a cell type
+    co = load_dge(dge_file).coexpression_index().query(marker_sets, base_sets)
+    stage_metrics.count(len(marker_sets), "marker sets")
+    print(co)
+    return co
 
 
 if __name__ == '__main__':
@@ -1,14 +1,10 @@
-from Bio import SeqIO
+import shutil
+from reference_store import load_reference
 
 def create_gtf(fasta_file, gtf_file_name):
+    # the GTF file is created once with the reference store of the fasta file, and copied from there
     print("Creating GTF file for the fasta file: ", fasta_file)
-    f = open(gtf_file_name, "w")
-    for seq_record in SeqIO.parse(fasta_file, "fasta"):
-        id = seq_record.id
-        record = '''{}\tsmed\texon\t1\t{}\t.\t+\t.\tgene_id "{}"; transcript_id "{}"; exon_number "1"; gene_name "{}"; gene_biotype "{}"; transcript_name "{}"; exon_id "{}";\n'''.format(
-                id, len(seq_record), id, id, id, id, id, id)
-        f.write(record)
-    f.close()
+    shutil.copyfile(load_reference(fasta_file).gtf_file, gtf_file_name)
     print("The GTF file '{}' was created".format(gtf_file_name))
 
 if __name__ == '__main__':
@@ -1,157 +1,171 @@
-import pickle
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
-from Bio import SeqIO
+import os
 import sys
-
-gene_name = sys.argv[1]
-fasta_file = sys.argv[2]  # "dd_Smed_v6.fasta"
-sample = sys.argv[3]  # binary
-log_scale = sys.argv[4]  # binary
-file_prefix = ''
+import matplotlib.pyplot as plt
+import stage_metrics
+from mm_store import load_quality_histogram
+from read_store import ReadTable
+from reference_store import load_reference
+from mm_info import build_mismatch_info, save_info, info_to_dataframe, read_mismatch_info
+from mm_counting import MIN_QUAL, HIST_NUCS, read_coverage, counts_at_quality
+from stage_cache import StageManifest
+from mm_plots import render, save_payload
+
+def get_file_prefix(gene_name):
+    num = gene_name.split('_')[3]
+    return gene_name + "/" + num + "_"
 
 
-def set_file_prefix(gene_name):
-    num = gene_name.split('_')[3]
-    global file_prefix
-    file_prefix = gene_name + "/" + num + "_"
+def get_sample_prefix(sample, cap=None, min_qual=MIN_QUAL):
+    # prefix of the files of the sample (with a cap of 'cap' reads per cell), or of all the reads, and of a quality
+    # cutoff other than the default one
+    prefix = ""
+    if sample:
+        prefix = "sample_" if cap is None else "sample_cap{}_".format(cap)
+    if min_qual != MIN_QUAL:
+        prefix += "q{}_".format(min_qual)
+    return prefix
 
 
-def create_mismatches_info_file(gene_name, fasta_file, sample):
+def create_mismatches_info_file(gene_name, fasta_file, sample, cap=None, min_qual=MIN_QUAL, export_csv=False):
+    # with a cap, the mismatches and the coverage are of the sampled reads with rank < cap within their cell.
+    # the mismatches with quality >= min_qual are counted out of the histograms of the mismatch qualities
+    file_prefix = get_file_prefix(gene_name)
     print("\nStarting creating mismatches info file")
-    mm_col_a = "good quality mismatch amount"
-    mm_col_p = "good quality mismatch %"
-    final_df = pd.DataFrame(columns=['position', 'reference', 'coverage',  mm_col_a, mm_col_p, 'A', 'T', 'C', 'G'])
-
-    if sample:
+    if sample and cap is not None:
+        print("Using sample file with up to {} reads per cell to calculate depth".format(cap))
+        sample_table = ReadTable.load(file_prefix + "bam_sample_reads").up_to_rank(cap)
+        coverage = read_coverage(sample_table, load_reference(fasta_file).gene_length(gene_name))
+        mm_dict_file = file_prefix + "sample_pos_good_quality_mm"
+    elif sample and os.path.exists(file_prefix + "sample_coverage.npy"):
+        print("Using the coverage of the sample computed while counting the mismatches")
+        coverage = np.load(file_prefix + "sample_coverage.npy")
+        mm_dict_file = file_prefix + "sample_pos_good_quality_mm"
+    elif sample:
         print("Using sample file to calculate depth")
         depth_df = pd.read_csv(file_prefix + "sample_depth.tsv", sep='\t', names=['Gene', 'position', 'coverage'])
-        d_file = open(file_prefix + "sample_pos_good_quality_mm_dict.pkl", "rb")
-        output_file_name = file_prefix + "sample_good_quality_mismatch_info.csv"
+        coverage = depth_df['coverage'].to_numpy()
+        mm_dict_file = file_prefix + "sample_pos_good_quality_mm"
     else:
         depth_df = pd.read_csv(file_prefix + "depth.tsv", sep='\t', names=['Gene', 'position', 'coverage'])
-        d_file = open(file_prefix + "pos_good_quality_mm_dict.pkl", "rb")
-        output_file_name = file_prefix + "good_quality_mismatch_info.csv"
-
-    final_df['position'] = depth_df['position']
-    final_df['coverage'] = depth_df['coverage']
-
-    record_dict = SeqIO.index(fasta_file, "fasta")
-    record = record_dict[gene_name]
-    reference_seq = [nuc for nuc in record.seq]
-    final_df['reference'] = reference_seq
-
-    good_dict = pickle.load(d_file)
-    mm_count = [len(tup[1]) for tup in list(good_dict.items())]
-    final_df[mm_col_a] = mm_count
-    final_df[mm_col_p] = final_df[mm_col_a] / final_df['coverage'] * 100
-
-    nucs = ['A', 'T', 'C', 'G']
-    pos_nuc_cnt_dict = {key: [] for key in nucs}
-    for dict_tup in list(good_dict.items()):
-        nuc_list = [tup[0] for tup in dict_tup[1]]  # all nucleotides at the position
-        for nuc in nucs:
-            pos_nuc_cnt_dict[nuc].append(nuc_list.count(nuc)) # count of each nucleotide
-
-    for nuc in nucs:
-        final_df[nuc] = pos_nuc_cnt_dict[nuc]
-    for nuc in nucs:
-        final_df[nuc + " /mismatch amount (%)"] = final_df[nuc] / final_df[mm_col_a] * 100
-    for nuc in nucs:
-        final_df[nuc + " /total reads (%)"] = final_df[nuc] / final_df['coverage'] * 100
-        # if nuc==reference then the value will be 0, because we are looking only at mismatches data
-
-    final_df = final_df.fillna(0) # replace all possible Nan values with 0 (when coverage or mismatch amount is 0)
-    final_df.to_csv(output_file_name, index=False)
-    d_file.close()
+        coverage = depth_df['coverage'].to_numpy()
+        mm_dict_file = file_prefix + "pos_good_quality_mm"
+    output_name = file_prefix + get_sample_prefix(sample, cap, min_qual) + "good_quality_mismatch_info"
+
+    hist_file = file_prefix + "sample_mm_qual_hist.npy"
+    if sample and cap is None and os.path.exists(hist_file):
+        hist = np.load(hist_file, mmap_mode='r')
+    else:
+        if not os.path.isdir(mm_dict_file):
+            mm_dict_file += "_dict.pkl"  # a position dictionary pickle of the old format
+        hist = load_quality_histogram(mm_dict_file, cap, min_qual)
+    qual_counts = counts_at_quality(hist, min_qual)  # count of each nucleotide at each position
+
+    reference_seq = load_reference(fasta_file).gene_sequence(gene_name)
+    info = build_mismatch_info(qual_counts, coverage, reference_seq, HIST_NUCS)
+    save_info(info, output_name)
+    stage_metrics.count(len(coverage), "positions")
     print("Done creating mismatches info file")
-    print("Results were saved to '{}'".format(output_file_name))
+    print("Results were saved to '{}'".format(output_name))
+    if export_csv:
+        info_to_dataframe(info).to_csv(output_name + ".csv", index=False)
+        print("Results were also exported to '{}'".format(output_name + ".csv"))
+
 
+def get_sample_title(cap=None):
+    return "Sample" if cap is None else "Sample (up to {} reads per cell)".format(cap)
 
-def plot_barplot_divided_by_nucleodites(sample, log_scale):
+
+def plot_barplot_divided_by_nucleodites(gene_name, sample, log_scale, cap=None, min_qual=MIN_QUAL, fmt="png"):
+    # the plot is saved as an image file of type fmt (png or svg), and its data as a payload for show_plot.py
+    file_prefix = get_file_prefix(gene_name)
     print("\nCreating barplot of good quality mismatches per position, divided by nucleotides")
     if sample:
         print("Using sample file for ploting")
-        input_file_name = file_prefix + "sample_good_quality_mismatch_info.csv"
-        plot_file_name = file_prefix + 'sample_barplot_mm_by_nucleotides.pkl'
-        plot_title = "Gene {} - Sample - count of good quality mismatches per position, divided by nucleotides".format(gene_name)
+        input_file_name = file_prefix + get_sample_prefix(sample, cap, min_qual) + "good_quality_mismatch_info"
+        plot_file_name = file_prefix + get_sample_prefix(sample, cap, min_qual) + 'barplot_mm_by_nucleotides'
+        plot_title = "Gene {} - {} - count of good quality mismatches per position, divided by nucleotides".format(gene_name, get_sample_title(cap))
     else:
-        input_file_name = file_prefix + "good_quality_mismatch_info.csv"
-        plot_file_name = file_prefix + 'barplot_mm_by_nucleotides.pkl'
+        input_file_name = file_prefix + get_sample_prefix(sample, cap, min_qual) + "good_quality_mismatch_info"
+        plot_file_name = file_prefix + get_sample_prefix(sample, cap, min_qual) + 'barplot_mm_by_nucleotides'
         plot_title = "Gene {} - count of good quality mismatches per position, divided by nucleotides".format(gene_name)
-    mm_df = pd.read_csv(input_file_name)
-    gene_len = len(mm_df)
-    x = range(1, gene_len+1) # all positions in the gene sequence
-    bar_width = 0.65
-    fig, ax = plt.subplots()
-    ax.bar(x, mm_df['A'], bar_width, label='A', color='blue')
-    ax.bar(x, mm_df['T'], bar_width, bottom=mm_df['A'], label='T', color='red')
-    ax.bar(x, mm_df['C'], bar_width, bottom=mm_df['T'], label='C', color='lime')
-    ax.bar(x, mm_df['G'], bar_width, bottom=mm_df['C'], label='G', color='violet')
-    if log_scale:
-        plt.yscale('log', base=10)
-        plt.ylabel("Amount of reads with mismatches (log10 scale)")
-    else:
-        plt.ylabel("Amount of reads with mismatches")
-    plt.xticks(range(1, len(x)+1, 50))
-    plt.xlabel("Position in reference sequence")
-    plt.title(plot_title)
-
-    # add to the barplot the coverage for each position:
-    plt.plot(mm_df['position'], mm_df['coverage'], lw=0.7, color='gray', label='Coverage') # pos x in the reference is pos x-1
-    # because the positions in the reference sequence starts from 1, but in python sequences start from 0.
+    mm_df = read_mismatch_info(input_file_name, ['position', 'coverage', 'A', 'T', 'C', 'G'])
+    payload = {'kind': 'nucleotides', 'title': plot_title, 'log_scale': bool(log_scale)}
+    payload.update({col: mm_df[col].to_numpy() for col in mm_df.columns})
+    save_payload(payload, plot_file_name + ".npz")
+    render(payload, plot_file_name + "." + fmt)
+    print("The plot was saved as '{}', and its data as '{}' for display".format(plot_file_name + "." + fmt,
+                                                                               plot_file_name + ".npz"))
 
-    # reorder the legend:
-    handles, labels = ax.get_legend_handles_labels()
-    ax.legend(handles[::-1], labels[::-1])
 
-    # save the plot as a pkl file:
-    plot_file = open(plot_file_name, 'wb')
-    pickle.dump(ax, plot_file)
-    plot_file.close()
-    plt.clf()
-    print("The plot was saved as '{}'. It needs to be loaded with pickle for display".format(plot_file_name))
-
-
-def plot_barplot_precentage(sample):
+def plot_barplot_precentage(gene_name, sample, cap=None, min_qual=MIN_QUAL, fmt="png"):
+    file_prefix = get_file_prefix(gene_name)
     print("\nCreating barplot of good quality mismatch precentage per position")
     if sample:
         print("Using sample file for ploting")
-        input_file_name = file_prefix + "sample_good_quality_mismatch_info.csv"
-        plot_file_name = file_prefix +'sample_barplot_mm_precentage.pkl'
-        plot_title = "Gene {} - Sample - Precentage of good quality mismatches per position".format(gene_name)
+        input_file_name = file_prefix + get_sample_prefix(sample, cap, min_qual) + "good_quality_mismatch_info"
+        plot_file_name = file_prefix + get_sample_prefix(sample, cap, min_qual) + 'barplot_mm_precentage'
+        plot_title = "Gene {} - {} - Precentage of good quality mismatches per position".format(gene_name, get_sample_title(cap))
     else:
-        input_file_name = file_prefix + "good_quality_mismatch_info.csv"
-        plot_file_name = file_prefix + 'barplot_mm_precentage.pkl'
+        input_file_name = file_prefix + get_sample_prefix(sample, cap, min_qual) + "good_quality_mismatch_info"
+        plot_file_name = file_prefix + get_sample_prefix(sample, cap, min_qual) + 'barplot_mm_precentage'
         plot_title = "Gene {} - Precentage of good quality mismatches per position".format(gene_name)
-    mm_df = pd.read_csv(input_file_name)
-
-    # plotting a bar plot
-    ax = plt.bar(mm_df['position'], mm_df['good quality mismatch %'], width=0.8, color=['dodgerblue', 'magenta'])
-    plt.xticks(range(1, len(mm_df)+1, 50))
-    plt.xlabel("Position in reference sequence")
-    plt.ylabel("Precentage of reads with good quality mismatches")
-    plt.title(plot_title)
-    plt.grid(linewidth=0.5)
-
-    # save the plot as a pkl file:
-    plot_file = open(plot_file_name, 'wb')
-    pickle.dump(ax, plot_file)
-    plot_file.close()
-    print("The plot was saved as '{}'. It needs to be loaded with pickle for display".format(plot_file_name))
-
-
-def do_work_for_gene(gene_name, sample, log_scale):
-    set_file_prefix(gene_name)
-    create_mismatches_info_file(gene_name, fasta_file, sample)
-    plot_barplot_divided_by_nucleodites(sample, log_scale)
-    plot_barplot_precentage(sample)
-    print("\nDone working on gene '{}'. You may use show_plot.py <plot_file.pkl> to see the saved plots".format(gene_name))
+    mm_df = read_mismatch_info(input_file_name, ['position', 'good quality mismatch %'])
+    payload = {'kind': 'precentage', 'title': plot_title, 'log_scale': False,
+               'position': mm_df['position'].to_numpy(), 'mm_precentage': mm_df['good quality mismatch %'].to_numpy()}
+    save_payload(payload, plot_file_name + ".npz")
+    render(payload, plot_file_name + "." + fmt)
+    print("The plot was saved as '{}', and its data as '{}' for display".format(plot_file_name + "." + fmt,
+                                                                               plot_file_name + ".npz"))
+
+
+def info_inputs(gene_name, sample, cap=None):
+    # the files that create_mismatches_info_file reads
+    file_prefix = get_file_prefix(gene_name)
+    if not sample:
+        names = ["depth.tsv", "pos_good_quality_mm", "pos_good_quality_mm_dict.pkl"]
+    elif cap is not None:
+        names = ["bam_sample_reads", "sample_pos_good_quality_mm", "sample_pos_good_quality_mm_dict.pkl"]
+    else:
+        names = ["sample_coverage.npy", "sample_depth.tsv", "sample_mm_qual_hist.npy", "sample_pos_good_quality_mm",
+                 "sample_pos_good_quality_mm_dict.pkl"]
+    return [file_prefix + name for name in names if os.path.exists(file_prefix + name)]
+
+
+def do_work_for_gene(gene_name, fasta_file, sample, log_scale, cap=None, min_qual=MIN_QUAL, export_csv=False, force=False,
+                     fmt="png"):
+    # the stages that are up to date with their inputs and parameters are skipped, unless force is True
+    file_prefix = get_file_prefix(gene_name) + get_sample_prefix(sample, cap, min_qual)
+    stages = StageManifest(get_file_prefix(gene_name) + "stages.json", force)
+    info_name = file_prefix + "good_quality_mismatch_info"
+    stages.run("info_" + get_sample_prefix(sample, cap, min_qual),
+               lambda: create_mismatches_info_file(gene_name, fasta_file, sample, cap, min_qual, export_csv),
+               inputs=info_inputs(gene_name, sample, cap) + [fasta_file],
+               params={'gene_name': gene_name, 'sample': sample, 'cap': cap, 'min_qual': min_qual, 'export_csv': export_csv},
+               outputs=[info_name] + ([info_name + ".csv"] if export_csv else []))
+
+    def plot():
+        plot_barplot_divided_by_nucleodites(gene_name, sample, log_scale, cap, min_qual, fmt)
+        plot_barplot_precentage(gene_name, sample, cap, min_qual, fmt)
+    stages.run("plots_" + get_sample_prefix(sample, cap, min_qual), plot, inputs=[info_name],
+               params={'gene_name': gene_name, 'sample': sample, 'log_scale': log_scale, 'cap': cap, 'fmt': fmt},
+               outputs=[file_prefix + name + ext for name in ("barplot_mm_by_nucleotides", "barplot_mm_precentage")
+                        for ext in (".npz", "." + fmt)])
+    print("\nDone working on gene '{}'. You may use show_plot.py <plot_file.npz> to see the saved plots".format(gene_name))
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 5:
-        print("There should be exactly 4 arguments, but {} were passed. Exiting.".format(len(sys.argv)))
+    plt.switch_backend('Agg')  # the plots are only saved
+    if len(sys.argv) not in (5, 6, 7, 8, 9):
+        print("There should be 4 to 8 arguments, but {} were passed. Exiting.".format(len(sys.argv)))
         exit()
-    do_work_for_gene(gene_name, sample, log_scale)
-
+    gene_name = sys.argv[1]
+    fasta_file = sys.argv[2]  # "dd_Smed_v6.fasta"
+    sample = sys.argv[3] == '1'  # binary
+    log_scale = sys.argv[4] == '1'  # binary
+    cap = int(sys.argv[5]) if len(sys.argv) > 5 and sys.argv[5] != 'all' else None  # optional, cap on the number of sampled reads per cell
+    min_qual = int(sys.argv[6]) if len(sys.argv) > 6 else MIN_QUAL  # optional, quality cutoff of a good quality mismatch
+    export_csv = len(sys.argv) > 7 and sys.argv[7] == '1'  # optional, binary: also export the info table as a csv file
+    fmt = sys.argv[8] if len(sys.argv) > 8 else "png"  # optional, type of the plot files: png or svg
+    do_work_for_gene(gene_name, fasta_file, sample, log_scale, cap, min_qual, export_csv, fmt=fmt)
@@ -0,0 +1,159 @@
+# Sparse loading of the digital gene expression matrix of Drop-seq (e.g. bowtie_gene_exon_tagged.dge.txt), a tab
+# separated text file of genes x cells read counts, with the gene names in the first column and the cell tags in the
+# header line. Most of the counts are 0, so the file is parsed in chunks of rows, each one kept as a sparse matrix.
+# The parsed matrix is cached in a directory next to the file ('<dge_file>.sparse'):
+#   counts.npz - the (genes x cells) counts as a scipy csr matrix
+#   genes.npy, cells.npy - the names of the genes and the cell tags
+#   source.json - the size and modification time of the file the cache was built from
+#   expression_bits.npy - the co-expression index (see CoexpressionIndex), created when it is first needed
+# The cache is rebuilt automatically when the file changes.
+
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from reference_store import building, is_up_to_date
+
+CHUNK_ENTRIES = 1 << 24  # counts per chunk of rows (64MB of int32 counts)
+COUNT_DTYPE = np.int32
+
+
+def parse_dge(dge_file, chunk_size=None):
+    # returns the (genes x cells) csr matrix of the counts, the gene names and the cell tags. each chunk of rows is read
+    # as a dense block before it is made sparse, so by default a chunk has about CHUNK_ENTRIES counts, whatever the
+    # number of cells is
+    with open(dge_file) as f:
+        header = f.readline().rstrip('\n').split('\t')
+    cells = header[1:]
+    if chunk_size is None:
+        chunk_size = max(1, CHUNK_ENTRIES // max(len(cells), 1))
+    dtypes = {name: COUNT_DTYPE for name in cells}
+    dtypes[header[0]] = str
+    genes, chunks = [], []
+    for chunk in pd.read_csv(dge_file, delimiter="\t", index_col=0, chunksize=chunk_size, dtype=dtypes):
+        genes.extend(chunk.index.astype(str))
+        chunks.append(sparse.csr_matrix(chunk.to_numpy()))
+        print("{} genes were parsed".format(len(genes)))
+    counts = sparse.vstack(chunks, format='csr') if chunks else sparse.csr_matrix((0, len(cells)), dtype=COUNT_DTYPE)
+    counts.eliminate_zeros()
+    return counts, genes, cells
+
+
+def build_dge_cache(dge_file, cache_dir):
+    print("Parsing DGE file '{}' into a sparse matrix in '{}'".format(dge_file, cache_dir))
+    counts, genes, cells = parse_dge(dge_file)
+    with building(cache_dir, dge_file) as tmp_dir:
+        sparse.save_npz(os.path.join(tmp_dir, "counts.npz"), counts)
+        np.save(os.path.join(tmp_dir, "genes.npy"), np.array([g.encode() for g in genes], dtype='S'))
+        np.save(os.path.join(tmp_dir, "cells.npy"), np.array([c.encode() for c in cells], dtype='S'))
+    print("The DGE matrix was parsed, it has {} genes and {} cells, {} of the counts are not 0".format(
+        len(genes), len(cells), counts.nnz))
+
+
+class DGEMatrix:
+    def __init__(self, dge_file, cache_dir=None):
+        self.dge_file = dge_file
+        self.cache_dir = dge_file + ".sparse" if cache_dir is None else cache_dir
+        if not is_up_to_date(dge_file, self.cache_dir):
+            build_dge_cache(dge_file, self.cache_dir)
+        self.counts = sparse.load_npz(os.path.join(self.cache_dir, "counts.npz")).tocsr()
+        self.genes = [g.decode() for g in np.load(os.path.join(self.cache_dir, "genes.npy"))]
+        self.cells = [c.decode() for c in np.load(os.path.join(self.cache_dir, "cells.npy"))]
+        self.gene_index = {gene: i for i, gene in enumerate(self.genes)}
+
+    @property
+    def num_of_cells(self):
+        return len(self.cells)
+
+    def gene_rows(self, genes):
+        return [self.gene_index[gene] for gene in genes]
+
+    def coexpression_index(self):
+        # the co-expression index of the matrix, built once and saved in the cache directory
+        bits_file = os.path.join(self.cache_dir, "expression_bits.npy")
+        if os.path.exists(bits_file):
+            bits = np.load(bits_file, mmap_mode='r')
+        else:
+            bits = expression_bits(self.counts)
+            np.save(bits_file, bits)
+        return CoexpressionIndex(bits, self.genes, self.num_of_cells)
+
+    def expression_frequency(self):
+        # for each gene: the percentage of the cells that express it (count > 0), the number of these cells and the
+        # total number of reads of the gene, computed on the sparse counts
+        num_of_cells = np.diff(self.counts.indptr)  # the zeros are not stored
+        df = pd.DataFrame(index=pd.Index(self.genes, name=None))
+        df[">0 freq"] = num_of_cells / self.num_of_cells * 100
+        df["num of cells"] = num_of_cells
+        df["num of reads"] = np.asarray(self.counts.sum(axis=1)).ravel()
+        return df
+
+
+POPCOUNT_TABLE = np.array([bin(b).count('1') for b in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    # number of set bits in each uint64 word
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    return POPCOUNT_TABLE[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1, dtype=np.int64)
+
+
+def expression_bits(counts):
+    # (genes x words) uint64 bitmaps of the cells that express each gene, cell c is bit c % 64 of word c // 64
+    counts = counts.tocsr()
+    counts.sort_indices()
+    n_words = (counts.shape[1] + 63) // 64
+    rows = np.repeat(np.arange(counts.shape[0], dtype=np.int64), np.diff(counts.indptr))
+    cols = counts.indices.astype(np.int64)
+    keys = rows * n_words + (cols >> 6)  # non decreasing, since the cells of each gene are sorted
+    bits = np.left_shift(np.uint64(1), (cols & 63).astype(np.uint64))
+    words = np.zeros(counts.shape[0] * n_words, dtype=np.uint64)
+    if len(keys):
+        starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+        words[keys[starts]] = np.bitwise_or.reduceat(bits, starts)
+    return words.reshape(counts.shape[0], n_words)
+
+
+class CoexpressionIndex:
+    # a bitmap of the cells that express each gene, to find the cells that co-express sets of genes (markers) with
+    # bitwise AND and count them with popcount, for many sets of markers at once
+    def __init__(self, bits, genes, num_of_cells):
+        self.bits = bits
+        self.genes = genes
+        self.gene_index = {gene: i for i, gene in enumerate(genes)}
+        self.num_of_cells = num_of_cells
+
+    def coexpression_bits(self, marker_sets):
+        # (sets x words) bitmaps of the cells that co-express all the markers of each set
+        if any(len(markers) == 0 for markers in marker_sets):
+            raise ValueError("Every set of markers should have at least one gene")
+        rows = [self.gene_index[gene] for markers in marker_sets for gene in markers]
+        starts = np.cumsum([0] + [len(markers) for markers in marker_sets[:-1]])
+        return np.bitwise_and.reduceat(self.bits[rows], starts, axis=0)
+
+    def cells_of(self, bits):
+        # the indices of the cells set in a bitmap
+        return np.flatnonzero(np.unpackbits(bits.view(np.uint8), bitorder='little')[:self.num_of_cells])
+
+    def query(self, marker_sets, base_sets=None, return_cells=False):
+        # for each set of markers: the number and the percentage of the cells that co-express them, and if base_sets
+        # are given (one for each set of markers), the percentage of the cells that co-express the base set that also
+        # co-express the markers. with return_cells, also the indices of the co-expressing cells of each set
+        co_bits = self.coexpression_bits(marker_sets)
+        counts = popcount(co_bits).sum(axis=1)
+        df = pd.DataFrame({"markers": [list(markers) for markers in marker_sets], "num of cells": counts,
+                           "% of cells": counts / self.num_of_cells * 100})
+        if base_sets is not None:
+            base_counts = popcount(self.coexpression_bits(base_sets)).sum(axis=1)
+            both_counts = popcount(co_bits & self.coexpression_bits(base_sets)).sum(axis=1)
+            df["num of base cells"] = base_counts
+            df["% of base cells"] = np.divide(both_counts * 100, base_counts, out=np.full(len(counts), np.nan),
+                                              where=base_counts != 0)
+        if return_cells:
+            df["cells"] = [self.cells_of(bits) for bits in co_bits]
+        return df
+
+
+def load_dge(dge_file):
+    return DGEMatrix(dge_file)
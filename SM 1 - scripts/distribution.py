@@ -1,72 +1,114 @@
+# Combines the mismatches info of all the genes in a genes file, plots the distribution of the mismatch percentage per
+# position and finds positions by their mismatch percentage.
+# Usage: python distribution.py <genes_file> [workers] [export_csv]
+# The combined info is stored as a dataset partitioned by gene (see mm_dataset.py), that is written by several processes
+# and scanned one gene at a time, so the memory used does not grow with the number of genes. The queries on the
+# positions use an index built once over the dataset (see position_index.py). The combined csv file of the older
+# version ('all_genes_mm_per_pos_info.csv') is written only if asked for, and is still read for the plots if there is
+# no dataset.
+
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+import os
 import sys
+import stage_metrics
+from binned_kde import BinnedValues
+from mm_counting import MIN_QUAL
+from mm_dataset import build_dataset, export_dataset_csv, scan_dataset
+from mm_info import MM_COL_P
+from position_index import build_position_index, load_position_index
 pd.options.mode.chained_assignment = None  # default='warn'
 
 output_file = "all_genes_mm_per_pos_info.csv"
-genes_file = sys.argv[1]  # "genes_to_use.txt"
 
 
-def create_mm_info_for_all_genes():
+def get_output_file(min_qual=MIN_QUAL):
+    # the combined file of a quality cutoff other than the default one has the cutoff in its name
+    if min_qual == MIN_QUAL:
+        return output_file
+    return output_file.replace(".csv", "_q{}.csv".format(min_qual))
+
+
+def get_dataset_dir(min_qual=MIN_QUAL):
+    return get_output_file(min_qual)[:-len(".csv")]
+
+
+def scan_all_genes(min_qual=MIN_QUAL, columns=None):
+    # yields the combined info one gene at a time, with only the requested columns (and the gene name)
+    dataset_dir = get_dataset_dir(min_qual)
+    if os.path.isdir(dataset_dir):
+        yield from scan_dataset(dataset_dir, columns)
+    else:  # the combined csv file of the older version
+        yield pd.read_csv(get_output_file(min_qual), header=0,
+                          usecols=None if columns is None else ['gene_name'] + list(columns))
+
+
+@stage_metrics.measured()
+def create_mm_info_for_all_genes(genes_file, min_qual=MIN_QUAL, workers=None, export_csv=False):
     print("Creating mismatches info file for all genes combined.")
     df = pd.read_csv(genes_file, names=['gene_names'])
     print("The genes to use:")
     print(df)
-    mm_p = "good quality mismatch %"
-    cols = ['gene_name', 'position', 'coverage', 'reference', mm_p]
-    nucs = ['A', 'T', 'C', 'G']
-    nucs_p = [nuc + " /total reads (%)" for nuc in nucs]
-    cols = cols + nucs + nucs_p
-    result = pd.DataFrame(columns=cols)
-
-    for gene_name in df['gene_names']:
-        gene_num = gene_name.split('_')[3]
-        info_file_name = gene_name + "/" + gene_num + "_sample_good_quality_mismatch_info.csv"
-        gene_info = pd.read_csv(info_file_name, header=0)
-        tmp = pd.DataFrame(columns=cols)
-        for col in cols[1:]:
-            tmp[col] = gene_info[col]
-        tmp['gene_name'] = gene_name
-        result = pd.concat([result, tmp])
+    dataset_dir = get_dataset_dir(min_qual)
+    total = build_dataset(list(df['gene_names']), dataset_dir, min_qual, workers)
+    build_position_index(dataset_dir)  # for the queries on the positions
 
     print("Head of the created file:")
-    print(result.head())
-    print("total length (number of positions):", len(result))
-    result.to_csv(output_file, index=False)
-    print("Saving file as '{}'".format(output_file))
+    print(next(scan_dataset(dataset_dir)).head())
+    print("total length (number of positions):", total)
+    print("Saving dataset as '{}'".format(dataset_dir))
+    if export_csv:
+        export_dataset_csv(dataset_dir, get_output_file(min_qual))
+        print("Saving file as '{}'".format(get_output_file(min_qual)))
 
 
-def plot_distribution(cutoff=0):
+@stage_metrics.measured()
+def plot_distributions(cutoffs=(0,), min_qual=MIN_QUAL):
+    # one plot for each cutoff, all from one scan of the mismatch % column of the genes (see binned_kde.py)
     print("Creating distribution of good quality mismatch % per position in all of the genes")
-    df = pd.read_csv(output_file, header=0)
-    print("The content of the file 'all_genes_mm_per_pos_info.csv':")
-    print(df)
-    mm_col = "good quality mismatch %"
-    if cutoff: # include only values >= the cutoff
-        df = df.loc[df[mm_col] >= cutoff]
-    mm_precentage = df[mm_col]
-
-    # plot and save as png:
-    sns.set_theme()
-    sns.set(font_scale=1.7)
-    ax = sns.displot(mm_precentage, kind="kde")
-    plt.xlabel("good quality mismatch % per position")
-    plt.title("Distribution of good quality mismatch percentage per position (number of values: {})".format(len(df)))
-    fig = plt.gcf()
-    fig.set_size_inches(18.5, 10.5, forward=True)
-    plot_file_name = 'all genes- distribution of mismatch percentage per position - cutoff {}.png'.format(cutoff)
-    plt.savefig(plot_file_name, dpi=100)
-    print("The plot was saved as '{}'.".format(plot_file_name))
+    values = BinnedValues()
+    num_of_genes = 0
+    for df in scan_all_genes(min_qual, [MM_COL_P]):
+        num_of_genes += df['gene_name'].nunique()
+        values.add(df[MM_COL_P].to_numpy())
+        stage_metrics.count(len(df), "positions")
+    print("Number of genes in '{}': {}, number of values: {}".format(get_dataset_dir(min_qual), num_of_genes,
+                                                                   values.num_of_values()))
+    for cutoff in cutoffs:  # include only values >= the cutoff
+        grid, density = values.kde(cutoff)
+
+        # plot and save as png:
+        sns.set_theme()
+        sns.set(font_scale=1.7)
+        fig, ax = plt.subplots()
+        ax.plot(grid, density)
+        ax.set_ylabel("Density")
+        sns.despine()
+        plt.xlabel("good quality mismatch % per position")
+        plt.title("Distribution of good quality mismatch percentage per position (number of values: {})".format(
+            values.num_of_values(cutoff)))
+        fig.set_size_inches(18.5, 10.5, forward=True)
+        plot_file_name = 'all genes- distribution of mismatch percentage per position - cutoff {}.png'.format(cutoff)
+        if min_qual != MIN_QUAL:
+            plot_file_name = plot_file_name.replace('.png', ' - quality {}.png'.format(min_qual))
+        plt.savefig(plot_file_name, dpi=100)
+        print("The plot was saved as '{}'.".format(plot_file_name))
     plt.show()
 
 
-def get_positions_by_percentage_range(min, max):
+def plot_distribution(cutoff=0, min_qual=MIN_QUAL):
+    plot_distributions((cutoff,), min_qual)
+
+
+@stage_metrics.measured()
+def get_positions_by_percentage_range(min, max, min_qual=MIN_QUAL):
     print("extracting positions with mismatch percentage of {} to {}".format(min, max))
-    df = pd.read_csv(output_file, header=0)
-    range_df = df.loc[(df["good quality mismatch %"] >= min) & (df["good quality mismatch %"] <= max)]
-    range_df = range_df.sort_values(by=["good quality mismatch %"])
+    # the positions in the range are found by binary search on the index, already sorted by the mismatch %:
+    range_df = load_position_index(get_dataset_dir(min_qual)).positions_in_range(min, max)
     file_name = "mm_percentage_range_{}-{}.csv".format(min, max)
+    if min_qual != MIN_QUAL:
+        file_name = file_name.replace(".csv", "_q{}.csv".format(min_qual))
     range_df.to_csv(file_name)
     print("results were saved to '{}'".format(file_name))
     print("The results:")
@@ -76,38 +118,27 @@ def get_positions_by_percentage_range(min, max):
 
 # this function was not used. It meant to find positions where there are at least 2 other nucleotides besides the
 # reference base, each appears with frequency of at least 'thresh'.
-def find_positions_with_3_nucs(thresh):
-    df = pd.read_csv(output_file, header=0)
-    nucs = ['A', 'T', 'C', 'G']
-    nucs_p = [nuc + " /total reads (%)" for nuc in nucs]
-    nucs_thresh = [nuc + ' >= ' + str(thresh) for nuc in nucs]
-    new_df = df.loc[df["good quality mismatch %"] < (100-thresh)] # so at least thresh % is the reference nucleotide
-    new_df.reset_index(inplace=True, drop=True)
-    for i in range(4):
-        new_df[nucs_thresh[i]] = new_df[nucs_p[i]].apply(lambda x: x >= thresh)
-    col = 'how many >= ' + str(thresh)
-    new_df[col] = new_df.iloc[:, -4:].sum(axis=1)
-    relev_df = new_df.loc[new_df[col] >= 2] # in the nuc col that matches the reference will be 0, so having two columns
-                                            # that have mm % >= thresh means we have at lest 3 different nucs
-    relev_df.drop(columns=nucs_thresh, inplace=True)
+@stage_metrics.measured()
+def find_positions_with_3_nucs(thresh, min_qual=MIN_QUAL):
+    relev_df = load_position_index(get_dataset_dir(min_qual)).positions_with_3_nucs(thresh)
     print("The found positions:")
     print(relev_df)
     print("Amount: ", len(relev_df))
     file_name = "positions_with_at_least_3_nucs_thresh_{}.csv".format(thresh)
+    if min_qual != MIN_QUAL:
+        file_name = file_name.replace(".csv", "_q{}.csv".format(min_qual))
     relev_df.to_csv(file_name)
     print("results were saved to '{}'".format(file_name))
 
 
-
 if __name__ == '__main__':
-    create_mm_info_for_all_genes()
-    plot_distribution()  # initially all values
-    plot_distribution(2)  # values >= 2
+    genes_file = sys.argv[1]  # "genes_to_use.txt"
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None  # optional, number of processes
+    export_csv = len(sys.argv) > 3 and sys.argv[3] == '1'  # optional, binary: write also the combined csv file
+    create_mm_info_for_all_genes(genes_file, workers=workers, export_csv=export_csv)
+    plot_distributions((0, 2))  # all values, and values >= 2
     # get_positions_by_percentage_range(93, 100)
     # get_positions_by_percentage_range(40, 60)
     # get_positions_by_percentage_range(15, 35)
     # get_positions_by_percentage_range(75, 82)
     # find_positions_with_3_nucs(5)
-
-
-
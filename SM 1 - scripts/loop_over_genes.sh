@@ -9,6 +9,7 @@ function usage () {
     cat >&2 <<EOF
 USAGE: $progname [options] <bowtie_gene_exon_tagged_clean.bam>
 Process alignment BAM file per genes in <genes_file>, one by one
+(run_genes.py does the same work for all the genes in parallel, see its usage)
 
 -g <genes_file>       : txt file containing the names of the gene to work on. Required.
 -f <reference_fasta>  : Reference fasta file containing all genes. Required.  
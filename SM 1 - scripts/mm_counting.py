@@ -0,0 +1,115 @@
+# Vectorized counting of the mismatches in the reads of a read store (see read_store.py).
+# The reads are processed in batches of encoded arrays instead of one character at a time, and every good quality
+# mismatch is scatter-added into a (gene length x nucleotide) count matrix, where the nucleotide axis is the base
+# code of read_store.BASES.
+# To allow any quality cutoff later on, the mismatches can be found with min_qual=0 and kept with their qualities, and
+# summarized in per-position, per-nucleotide histograms of qualities, so the counts at a cutoff are a cumulative sum.
+
+import numpy as np
+from scipy import sparse
+from read_store import BASES, MATCH_CODE, DECODE_TABLE
+
+N_CODES = len(BASES)
+NUCS = ['A', 'T', 'C', 'G']
+NUC_CODES = [BASES.index(nuc) for nuc in NUCS]  # columns of the count matrix of each nucleotide
+MIN_QUAL = 20  # default quality cutoff of a good quality mismatch
+
+HIST_NUCS = NUCS + ['N']  # nucleotide axis of the quality histograms, the other base codes are counted as 'N'
+HIST_INDEX = np.full(N_CODES, len(NUCS), dtype=np.int64)
+HIST_INDEX[NUC_CODES] = np.arange(len(NUCS))
+QUAL_BINS = 64  # qualities above 63 are counted in the last bin
+
+
+def find_mismatches(table, min_qual=MIN_QUAL, batch_size=100000):
+    # returns the arrays (pos, nuc, qual, cell, rank) of all the mismatches with quality >= min_qual in the reads with
+    # NM > 0, where rank is the rank of the read in its cell if the reads are a ranked sample, otherwise None.
+    # the mismatches are ordered by read and then by position in the read, the same order the reads are iterated in
+    mm_reads = np.flatnonzero(np.asarray(table.NM) > 0)
+    results = []
+    for start in range(0, len(mm_reads), batch_size):
+        reads = mm_reads[start:start + batch_size]
+        starts = table.offsets[reads]
+        lengths = table.offsets[reads + 1] - starts
+        read_of_base = np.repeat(np.arange(len(reads)), lengths)
+        base_offsets = np.arange(len(read_of_base)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        flat = np.repeat(starts, lengths) + base_offsets
+        seq = table.seq[flat]
+        qual = table.qual[flat]
+        good = (seq != MATCH_CODE) & (qual >= min_qual)
+        read_of_mm = reads[read_of_base[good]]
+        rank = np.zeros(len(read_of_mm), dtype=np.int32) if table.rank is None else np.asarray(table.rank)[read_of_mm]
+        results.append((np.asarray(table.pos)[read_of_mm] + base_offsets[good], seq[good], qual[good],
+                        np.asarray(table.cell)[read_of_mm], rank))
+    if not results:
+        results = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint8),
+                    np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))]
+    mismatches = [np.concatenate(arrays) for arrays in zip(*results)]
+    if table.rank is None:
+        mismatches[4] = None
+    return tuple(mismatches)
+
+
+def up_to_rank(mismatches, cap):
+    # only the mismatches of the reads in the sample with a cap of 'cap' reads per cell (cap=None means all)
+    rank = mismatches[4]
+    if cap is None or rank is None:
+        return mismatches
+    keep = rank < cap
+    return tuple(arrays[keep] for arrays in mismatches)
+
+
+def at_quality(mismatches, min_qual=MIN_QUAL):
+    # only the mismatches with quality >= min_qual
+    keep = mismatches[2] >= min_qual
+    return tuple(None if arrays is None else arrays[keep] for arrays in mismatches)
+
+
+def quality_histogram(mismatches, gene_len):
+    # (gene_len x HIST_NUCS x QUAL_BINS) counts of the mismatches by position, nucleotide and quality
+    pos, nuc, qual = mismatches[:3]
+    flat = ((pos - 1) * len(HIST_NUCS) + HIST_INDEX[nuc]) * QUAL_BINS + np.minimum(qual, QUAL_BINS - 1)
+    hist = np.bincount(flat, minlength=gene_len * len(HIST_NUCS) * QUAL_BINS)
+    return hist.reshape(gene_len, len(HIST_NUCS), QUAL_BINS).astype(np.uint32)
+
+
+def counts_at_quality(hist, min_qual=MIN_QUAL):
+    # (gene_len x HIST_NUCS) counts of the mismatches with quality >= min_qual, out of a quality histogram
+    return hist[:, :, min(min_qual, QUAL_BINS):].sum(axis=2, dtype=np.int64)
+
+
+def read_coverage(table, gene_len):
+    # number of reads covering each position of the gene (the reads have no indels), using a difference array over
+    # the first and one after the last position of each read
+    starts = np.asarray(table.pos)
+    ends = np.minimum(starts + table.lengths, gene_len + 1)
+    diff = np.bincount(starts, minlength=gene_len + 2) - np.bincount(ends, minlength=gene_len + 2)
+    return np.cumsum(diff)[1:gene_len + 1]
+
+
+def count_matrix(mismatches, gene_len):
+    # (gene_len x N_CODES) counts of the mismatches, row i is position i+1 in the gene
+    pos, nuc = mismatches[0], mismatches[1]
+    flat = (pos - 1) * N_CODES + nuc
+    return np.bincount(flat, minlength=gene_len * N_CODES).reshape(gene_len, N_CODES)
+
+
+def cell_count_tensor(mismatches, gene_len, n_cells):
+    # sparse (position, cell, nucleotide) counts, flattened into a (gene_len x n_cells*N_CODES) csr matrix:
+    # the count of nucleotide code n in cell c at position p is at [p-1, c*N_CODES + n]
+    pos, nuc, cell = mismatches[0], mismatches[1], mismatches[3]
+    ones = np.ones(len(pos), dtype=np.int64)
+    tensor = sparse.coo_matrix((ones, (pos - 1, cell.astype(np.int64) * N_CODES + nuc)),
+                               shape=(gene_len, n_cells * N_CODES))
+    return tensor.tocsr()  # duplicate entries are summed
+
+
+def mismatches_to_dict(mismatches, cells, gene_len):
+    # the old dictionary format: keys are positions in the gene, values are lists of (char, qual, tag) tuples
+    pos, nuc, qual, cell = mismatches[:4]
+    order = np.argsort(pos, kind='stable')  # keeps the read order within each position
+    bounds = np.searchsorted(pos[order], np.arange(1, gene_len + 2))
+    chars = DECODE_TABLE[nuc[order]].tobytes().decode()
+    quals = qual[order].tolist()
+    tags = [cells[c] for c in cell[order].tolist()]
+    return {p: list(zip(chars[bounds[p-1]:bounds[p]], quals[bounds[p-1]:bounds[p]], tags[bounds[p-1]:bounds[p]]))
+            for p in range(1, gene_len + 1)}
@@ -0,0 +1,100 @@
+# The mismatches info of all the genes combined ('all_genes_mm_per_pos_info'), stored as a dataset partitioned by gene:
+# a directory with one sub directory per gene ('gene_name=<gene>'), each one a columnar info table as saved by
+# mm_info.save_info, and 'genes.json' with the genes and their number of positions, in the order of the genes file.
+# The partitions are written in parallel, one gene at a time by each process, so the memory used does not depend on
+# the number of genes, and the dataset is scanned one gene at a time, reading only the needed columns (memory-mapped).
+
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import stage_metrics
+from mm_counting import MIN_QUAL, HIST_NUCS, counts_at_quality
+from mm_info import MM_COL_P, NUCS, build_mismatch_info, info_to_dataframe, read_mismatch_info, save_info, load_info
+
+NUCS_P = [nuc + " /total reads (%)" for nuc in NUCS]
+COLUMNS = ['position', 'coverage', 'reference', MM_COL_P] + NUCS + NUCS_P  # the columns of every gene
+GENE_COL = 'gene_name'
+
+
+def read_gene_info(gene_name, min_qual=MIN_QUAL):
+    # the mismatches info of the gene's sample. for a quality cutoff other than the default one, the info is rebuilt
+    # out of the gene's histogram of mismatch qualities, unless it was already created for the cutoff
+    gene_num = gene_name.split('_')[3]
+    info_file_name = gene_name + "/" + gene_num + "_sample_good_quality_mismatch_info"
+    q_info_file_name = gene_name + "/" + gene_num + "_sample_q{}_good_quality_mismatch_info".format(min_qual)
+    if min_qual == MIN_QUAL:
+        return read_mismatch_info(info_file_name)
+    if os.path.isdir(q_info_file_name) or os.path.exists(q_info_file_name + ".csv"):
+        return read_mismatch_info(q_info_file_name)
+    gene_info = read_mismatch_info(info_file_name, ['reference', 'coverage'])
+    qual_counts = counts_at_quality(np.load(gene_name + "/" + gene_num + "_sample_mm_qual_hist.npy", mmap_mode='r'), min_qual)
+    info = build_mismatch_info(qual_counts, gene_info['coverage'], ''.join(gene_info['reference']), HIST_NUCS)
+    return info_to_dataframe(info)
+
+
+def partition_dir(dataset_dir, gene_name):
+    return os.path.join(dataset_dir, "{}={}".format(GENE_COL, gene_name))
+
+
+def write_gene_partition(dataset_dir, gene_name, min_qual=MIN_QUAL):
+    # writes the partition of the gene, returns its number of positions
+    gene_info = read_gene_info(gene_name, min_qual)
+    columns = {col: gene_info[col].to_numpy() for col in COLUMNS}
+    columns['reference'] = columns['reference'].astype('S1')
+    out_dir = partition_dir(dataset_dir, gene_name)
+    tmp_dir = "{}.tmp{}".format(out_dir, os.getpid())
+    save_info(columns, tmp_dir)
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+    return len(gene_info)
+
+
+def build_dataset(genes, dataset_dir, min_qual=MIN_QUAL, workers=None):
+    # the partitions of the genes are written by a pool of 'workers' processes (default is the number of CPUs)
+    os.makedirs(dataset_dir, exist_ok=True)
+    lengths = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i, (gene_name, length) in enumerate(zip(genes, pool.map(write_gene_partition, [dataset_dir] * len(genes),
+                                                                     genes, [min_qual] * len(genes), chunksize=8)), 1):
+            lengths.append(length)
+            stage_metrics.count(length, "positions")
+            if i % 100 == 0 or i == len(genes):
+                print("{} of {} genes were added to '{}'".format(i, len(genes), dataset_dir))
+    with open(os.path.join(dataset_dir, "genes.json"), "w") as f:
+        json.dump([[gene_name, length] for gene_name, length in zip(genes, lengths)], f)
+    return sum(lengths)
+
+
+def dataset_genes(dataset_dir):
+    # list of (gene name, number of positions) of the genes in the dataset, in their order
+    with open(os.path.join(dataset_dir, "genes.json")) as f:
+        return [tuple(gene) for gene in json.load(f)]
+
+
+def scan_dataset(dataset_dir, columns=None):
+    # yields the info of the genes one gene at a time, as DataFrames with the gene name as the first column. only the
+    # requested columns are read. the rows are numbered over all the genes, as the rows of the old combined csv file
+    start = 0
+    for gene_name, length in dataset_genes(dataset_dir):
+        df = info_to_dataframe(load_info(partition_dir(dataset_dir, gene_name), columns))
+        df.insert(0, GENE_COL, gene_name)
+        df.index = pd.RangeIndex(start, start + length)
+        start += length
+        yield df
+
+
+def read_dataset(dataset_dir, columns=None):
+    # all the genes in one DataFrame
+    return pd.concat(scan_dataset(dataset_dir, columns))
+
+
+def export_dataset_csv(dataset_dir, csv_file):
+    # the dataset in the layout of the old combined csv file, written one gene at a time
+    header = True
+    for df in scan_dataset(dataset_dir):
+        df.to_csv(csv_file, index=False, header=header, mode='w' if header else 'a')
+        header = False
@@ -0,0 +1,77 @@
+# Builds the good quality mismatch info table of a gene out of its (position x nucleotide) mismatch count matrix and
+# its coverage vector, computing all the derived columns at once.
+# The table is saved in a columnar directory: one .npy file per column, and 'columns.json' with the column names in
+# their order. Exporting it to csv is optional.
+
+import json
+import os
+import numpy as np
+import pandas as pd
+
+MM_COL_A = "good quality mismatch amount"
+MM_COL_P = "good quality mismatch %"
+NUCS = ['A', 'T', 'C', 'G']
+
+
+def percent(numerator, denominator):
+    # numerator / denominator * 100, and 0 where the denominator is 0 (no coverage or no mismatches)
+    numerator = np.asarray(numerator, dtype=np.float64)
+    ratio = np.divide(numerator, denominator, out=np.zeros_like(numerator), where=np.asarray(denominator) != 0)
+    return ratio * 100
+
+
+def build_mismatch_info(counts, coverage, reference, count_nucs):
+    # counts - (gene_len x len(count_nucs)) counts of the mismatches of each nucleotide at each position,
+    # coverage - number of reads covering each position, reference - the reference sequence of the gene.
+    # returns the columns of the table, in their order
+    counts = np.asarray(counts, dtype=np.int64)
+    coverage = np.asarray(coverage, dtype=np.int64)
+    mm_amount = counts.sum(axis=1)
+    nuc_counts = counts[:, [count_nucs.index(nuc) for nuc in NUCS]]
+    info = {'position': np.arange(1, len(coverage) + 1),
+            'reference': np.frombuffer(reference.encode(), dtype='S1'),
+            'coverage': coverage,
+            MM_COL_A: mm_amount,
+            MM_COL_P: percent(mm_amount, coverage)}
+    for i, nuc in enumerate(NUCS):
+        info[nuc] = nuc_counts[:, i]
+    mm_percent = percent(nuc_counts, mm_amount[:, None])
+    for i, nuc in enumerate(NUCS):
+        info[nuc + " /mismatch amount (%)"] = mm_percent[:, i]
+    # if nuc==reference then the value will be 0, because we are looking only at mismatches data:
+    total_percent = percent(nuc_counts, coverage[:, None])
+    for i, nuc in enumerate(NUCS):
+        info[nuc + " /total reads (%)"] = total_percent[:, i]
+    return info
+
+
+def save_info(info, info_dir):
+    os.makedirs(info_dir, exist_ok=True)
+    names = list(info)
+    for i, name in enumerate(names):
+        np.save(os.path.join(info_dir, "{}.npy".format(i)), np.ascontiguousarray(info[name]))
+    with open(os.path.join(info_dir, "columns.json"), "w") as f:
+        json.dump(names, f)
+
+
+def load_info(info_dir, columns=None, mmap=True):
+    # the table as a dict of columns, only the requested columns are read
+    with open(os.path.join(info_dir, "columns.json")) as f:
+        names = json.load(f)
+    mode = 'r' if mmap else None
+    return {name: np.load(os.path.join(info_dir, "{}.npy".format(i)), mmap_mode=mode)
+            for i, name in enumerate(names) if columns is None or name in columns}
+
+
+def info_to_dataframe(info):
+    df = pd.DataFrame({name: np.asarray(values) for name, values in info.items()})
+    if 'reference' in df:
+        df['reference'] = df['reference'].str.decode('ascii')
+    return df
+
+
+def read_mismatch_info(file_name, columns=None):
+    # reads an info table saved either as a columnar directory or as a csv file. file_name is given without '.csv'
+    if os.path.isdir(file_name):
+        return info_to_dataframe(load_info(file_name, columns))
+    return pd.read_csv(file_name + ".csv", header=0, usecols=columns)
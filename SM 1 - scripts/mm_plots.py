@@ -0,0 +1,151 @@
+# Rendering of the per-gene mismatch barplots (see create_mismatches_info_and_barplots.py) as image files.
+# Each series of bars (a nucleotide, or the mismatch %) is drawn as one filled step path, with the bars of the original
+# widths and the gaps between them, instead of a patch per bar, so a gene of several kb is drawn from a few paths.
+# Genes with more positions than the pixels of the plot are downsampled first: the bars are grouped into one bin per
+# pixel, with the maximum value of each bin.
+# With every plot a small payload of its data ('.npz') is saved, so it can be shown interactively (show_plot.py)
+# without pickling the matplotlib objects.
+# Usage (creating the plots of many genes out of their mismatches info files):
+#   python mm_plots.py <genes_file> [workers] [png/svg]
+
+import contextlib
+import io
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib.pyplot as plt
+import numpy as np
+from mm_counting import MIN_QUAL
+
+NUC_COLORS = {'A': 'blue', 'T': 'red', 'C': 'lime', 'G': 'violet'}
+PRECENTAGE_COLORS = ['dodgerblue', 'magenta']  # the colors of the bars alternate
+FIG_SIZE = (18.5, 10.5)
+DPI = 100
+MAX_TICKS = 20  # the positions are marked every 50 positions, or every multiple of 50 for long genes
+
+
+def save_payload(payload, file_name):
+    # payload: a dict of the arrays of the plot, and of its 'kind', 'title' and 'log_scale'
+    meta = {key: payload[key] for key in ('kind', 'title', 'log_scale')}
+    arrays = {key: np.asarray(value) for key, value in payload.items() if key not in meta}
+    np.savez_compressed(file_name, meta=json.dumps(meta), **arrays)
+
+
+def load_payload(file_name):
+    with np.load(file_name) as data:
+        payload = json.loads(str(data['meta']))
+        payload.update({key: data[key] for key in data.files if key != 'meta'})
+    return payload
+
+
+def downsample(position, values, max_bins):
+    # the edges of the bins and the maximum of each series in each bin, when there are more positions than max_bins
+    bin_starts = np.linspace(0, len(position), max_bins + 1).astype(np.int64)[:-1]
+    bin_starts = np.unique(bin_starts)
+    edges = np.append(np.asarray(position)[bin_starts] - 0.5, position[-1] + 0.5)
+    return edges, [np.maximum.reduceat(np.asarray(v), bin_starts) for v in values]
+
+
+def step_arrays(position, width, values, bottom, max_bins):
+    # x, bottom and top of one filled step path of the bars of a series (values on top of bottom)
+    if len(position) > max_bins:
+        edges, (values, bottom) = downsample(position, [values, bottom], max_bins)
+        return edges, np.append(bottom, bottom[-1]), np.append(values + bottom, bottom[-1])
+    position = np.asarray(position, dtype=np.float64)
+    x = np.column_stack([position - width / 2, position + width / 2]).ravel()
+    bottom = np.repeat(np.asarray(bottom, dtype=np.float64), 2)
+    top = bottom.copy()
+    top[::2] += values  # between the bars (from the right edge of a bar to the next bar) the path has no height
+    return x, bottom, top
+
+
+def draw_bars(ax, position, values, width, bottom=0, max_bins=None, **kwargs):
+    values = np.asarray(values, dtype=np.float64)
+    bottom = np.broadcast_to(np.asarray(bottom, dtype=np.float64), values.shape)
+    if len(values) == 0:
+        return
+    x, y1, y2 = step_arrays(position, width, values, bottom, max_bins or len(values))
+    ax.fill_between(x, y1, y2, step='post', linewidth=0, **kwargs)
+
+
+def set_position_ticks(ax, gene_len):
+    step = 50 * max(1, int(np.ceil(gene_len / (50 * MAX_TICKS))))
+    ax.set_xticks(range(1, gene_len + 1, step))
+
+
+def draw_nucleotides(ax, payload, max_bins):
+    position = payload['position']
+    # each nucleotide is on top of the previous one:
+    bottom = 0
+    for nuc in NUC_COLORS:
+        draw_bars(ax, position, payload[nuc], 0.65, bottom, max_bins, label=nuc, color=NUC_COLORS[nuc])
+        bottom = payload[nuc]
+    if payload['log_scale']:
+        ax.set_yscale('log', base=10)
+        ax.set_ylabel("Amount of reads with mismatches (log10 scale)")
+    else:
+        ax.set_ylabel("Amount of reads with mismatches")
+    set_position_ticks(ax, len(position))
+    ax.set_xlabel("Position in reference sequence")
+    ax.set_title(payload['title'])
+    # the coverage for each position:
+    ax.plot(position, payload['coverage'], lw=0.7, color='gray', label='Coverage')
+    handles, labels = ax.get_legend_handles_labels()
+    ax.legend(handles[::-1], labels[::-1])
+
+
+def draw_precentage(ax, payload, max_bins):
+    position, mm_p = payload['position'], payload['mm_precentage']
+    if len(position) > max_bins:  # the colors do not alternate between bins
+        draw_bars(ax, position, mm_p, 0.8, 0, max_bins, color=PRECENTAGE_COLORS[0])
+    else:
+        for i, color in enumerate(PRECENTAGE_COLORS):
+            draw_bars(ax, position[i::2], mm_p[i::2], 0.8, color=color)
+    set_position_ticks(ax, len(position))
+    ax.set_xlabel("Position in reference sequence")
+    ax.set_ylabel("Precentage of reads with good quality mismatches")
+    ax.set_title(payload['title'])
+    ax.grid(linewidth=0.5)
+
+
+def draw(ax, payload, max_bins=None):
+    if payload['kind'] == 'nucleotides':
+        draw_nucleotides(ax, payload, max_bins)
+    else:
+        draw_precentage(ax, payload, max_bins)
+
+
+def render(payload, plot_file_name):
+    # the plot saved as an image file, of the type of the file extension (.png or .svg)
+    fig, ax = plt.subplots(figsize=FIG_SIZE)
+    draw(ax, payload, max_bins=int(FIG_SIZE[0] * DPI))  # not more bars than pixels
+    fig.savefig(plot_file_name, dpi=DPI)
+    plt.close(fig)
+
+
+def render_gene(gene_name, fmt="png", sample=True, log_scale=True, cap=None, min_qual=MIN_QUAL):
+    # the plots of a gene (and their payloads) created from its mismatches info
+    import create_mismatches_info_and_barplots as barplots  # that module imports this one
+    with contextlib.redirect_stdout(io.StringIO()):
+        barplots.plot_barplot_divided_by_nucleodites(gene_name, sample, log_scale, cap, min_qual, fmt)
+        barplots.plot_barplot_precentage(gene_name, sample, cap, min_qual, fmt)
+    prefix = barplots.get_file_prefix(gene_name) + barplots.get_sample_prefix(sample, cap, min_qual)
+    return [prefix + name + "." + fmt for name in ('barplot_mm_by_nucleotides', 'barplot_mm_precentage')]
+
+
+def render_genes(genes, fmt="png", workers=None, sample=True, log_scale=True, cap=None, min_qual=MIN_QUAL):
+    # the plots of all the genes, by a pool of 'workers' processes (default is the number of CPUs)
+    n = len(genes)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i, files in enumerate(pool.map(render_gene, genes, [fmt] * n, [sample] * n, [log_scale] * n, [cap] * n,
+                                           [min_qual] * n), 1):
+            print("[{}/{}] Saved {}".format(i, n, ", ".join("'{}'".format(f) for f in files)))
+
+
+if __name__ == '__main__':
+    plt.switch_backend('Agg')  # the plots are only saved
+    genes_file = sys.argv[1]  # txt file containing the names of the genes
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None  # optional, number of processes
+    fmt = sys.argv[3] if len(sys.argv) > 3 else "png"  # optional, png or svg
+    with open(genes_file) as f:
+        render_genes([line.strip() for line in f if line.strip()], fmt, workers)
@@ -0,0 +1,200 @@
+# Compact indexed storage of the good quality mismatches of a gene, replacing the position dictionary pickle.
+# The mismatches are sorted by position (CSR layout): the mismatches at position p are entries offsets[p-1]:offsets[p]
+# of the parallel arrays 'nuc' (base code), 'qual' and 'cell' (id of the cell tag in the 'cells' dictionary).
+# All the files are .npy files that are memory-mapped, so reading one position does not load the other positions.
+# When the reads were a ranked sample (see read_sampling.py), the rank of the read of each mismatch is kept in 'rank',
+# and a store opened with a cap holds only the mismatches of the reads with rank < cap. The cap of the sample that the
+# counts of the gene are of (the first of the sampled amounts) is kept in 'sample_cap.json', and a store opened without
+# a cap holds that sample, as the old pickle did. ALL_READS opens the store with all the sampled reads. The cap the
+# reads were sampled with is kept there too, and a store can not be opened with a larger cap.
+# The store can keep the mismatches of all qualities (written from mm_counting.find_mismatches(table, min_qual=0)),
+# the quality cutoff is then chosen when the store is opened.
+
+import json
+import os
+import pickle
+import numpy as np
+from read_store import BASES, DECODE_TABLE, check_cap
+from mm_counting import MIN_QUAL, quality_histogram
+
+COLUMNS = ['offsets', 'nuc', 'qual', 'cell']
+ALL_READS = 'all'  # the cap that keeps the mismatches of all the sampled reads
+
+
+def write_mm_store(mismatches, cells, gene_len, store_dir, sample_cap=None, sampling_cap=None):
+    # mismatches are the (pos, nuc, qual, cell, rank) arrays returned by mm_counting.find_mismatches, sample_cap is the
+    # cap of the default sample of the store and sampling_cap the cap the reads were sampled with (None means all the
+    # reads)
+    pos, nuc, qual, cell, rank = mismatches
+    order = np.argsort(pos, kind='stable')  # keeps the read order within each position
+    offsets = np.searchsorted(pos[order], np.arange(1, gene_len + 2)).astype(np.int64)
+    os.makedirs(store_dir, exist_ok=True)
+    np.save(os.path.join(store_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(store_dir, "nuc.npy"), nuc[order].astype(np.uint8))
+    np.save(os.path.join(store_dir, "qual.npy"), qual[order].astype(np.uint8))
+    np.save(os.path.join(store_dir, "cell.npy"), cell[order].astype(np.int32))
+    if rank is not None:
+        np.save(os.path.join(store_dir, "rank.npy"), rank[order].astype(np.int32))
+    cells = np.array([c.encode() for c in cells], dtype='S') if len(cells) else np.zeros(0, dtype='S1')
+    np.save(os.path.join(store_dir, "cells.npy"), cells)
+    with open(os.path.join(store_dir, "sample_cap.json"), "w") as f:
+        json.dump({'sample_cap': sample_cap, 'sampling_cap': sampling_cap}, f)
+
+
+def read_cap_record(store_dir):
+    # the caps kept in 'sample_cap.json', None for a store written before they were kept
+    cap_file = os.path.join(store_dir, "sample_cap.json")
+    if not os.path.exists(cap_file):
+        return None
+    with open(cap_file) as f:
+        return json.load(f)
+
+
+def read_sample_cap(store_dir):
+    # the cap of the default sample of the store, None if it is of all the reads. a store written before the cap was
+    # kept has no record, and all of its reads are used
+    record = read_cap_record(store_dir)
+    if record is None:
+        if os.path.exists(os.path.join(store_dir, "rank.npy")):
+            print("Warning: the sample cap of '{}' is not known, all the sampled reads are used. Count the mismatches "
+                  "again (sample_reads_from_BAM.py) or pass the cap".format(store_dir))
+        return None
+    return record['sample_cap']
+
+
+def resolve_cap(store_dir, cap=None):
+    # the cap to open the store with: None is the default sample of the store, ALL_READS is all the sampled reads.
+    # raises ValueError when the cap is larger than the cap the reads were sampled with
+    if cap is None:
+        return read_sample_cap(store_dir)
+    if cap == ALL_READS:
+        return None
+    check_cap(cap, (read_cap_record(store_dir) or {}).get('sampling_cap'), "The reads of '{}'".format(store_dir))
+    return cap
+
+
+class MismatchStore:
+    # behaves like the old dictionary: keys are positions in the gene (starting from 1), values are lists of
+    # (char, qual, tag) tuples. get_arrays() gives the raw arrays of a position without creating the tuples.
+    # the store keeps the mismatches of all qualities, and only the ones with quality >= min_qual (and of reads with
+    # rank < cap) are returned. the filters are applied to each position when it is read. without a cap, the store is of
+    # its default sample (see resolve_cap), self.cap is the cap that is used (None if all the reads are used)
+    def __init__(self, store_dir, cap=None, min_qual=MIN_QUAL):
+        self.store_dir = store_dir
+        cap = resolve_cap(store_dir, cap)
+        self.cap = cap
+        self.min_qual = min_qual
+        for col in COLUMNS:
+            setattr(self, col, np.load(os.path.join(store_dir, col + ".npy"), mmap_mode='r'))
+        rank_file = os.path.join(store_dir, "rank.npy")
+        self.rank = np.load(rank_file, mmap_mode='r') if cap is not None and os.path.exists(rank_file) else None
+        self._cells = np.load(os.path.join(store_dir, "cells.npy"), mmap_mode='r')
+        self._cell_tags = None
+
+    def _keep(self, start, end, min_qual=None):
+        # mask of the mismatches start:end that pass the filters, min_qual overrides the quality cutoff of the store
+        keep = self.qual[start:end] >= (self.min_qual if min_qual is None else min_qual)
+        if self.rank is not None:
+            keep &= self.rank[start:end] < self.cap
+        return keep
+
+    @property
+    def cells(self):
+        # the cell tags dictionary is decoded only when the tags are needed
+        if self._cell_tags is None:
+            self._cell_tags = [c.decode() for c in self._cells]
+        return self._cell_tags
+
+    def cell_tags_of(self, cell):
+        # the cell tags (as bytes) of an array of cell ids
+        return np.asarray(self._cells)[cell]
+
+    @property
+    def gene_len(self):
+        return len(self.offsets) - 1
+
+    def __len__(self):
+        return self.gene_len
+
+    def __contains__(self, pos):
+        return 1 <= pos <= self.gene_len
+
+    def __iter__(self):
+        return iter(range(1, self.gene_len + 1))
+
+    def keys(self):
+        return range(1, self.gene_len + 1)
+
+    def get_arrays(self, pos):
+        start, end = self.offsets[pos - 1], self.offsets[pos]
+        keep = self._keep(start, end)
+        return self.nuc[start:end][keep], self.qual[start:end][keep], self.cell[start:end][keep]
+
+    def gather(self, positions):
+        # the mismatches at several positions at once, as (index in positions, nuc, cell) arrays, ordered by the
+        # positions as given and by the order of the reads within each position
+        positions = np.asarray(positions, dtype=np.int64)
+        starts = np.asarray(self.offsets[positions - 1])
+        lengths = np.asarray(self.offsets[positions]) - starts
+        ends = np.cumsum(lengths)
+        idx = np.repeat(starts - (ends - lengths), lengths) + np.arange(ends[-1] if len(ends) else 0)
+        keep = self.qual[idx] >= self.min_qual
+        if self.rank is not None:
+            keep &= self.rank[idx] < self.cap
+        idx = idx[keep]
+        return np.repeat(np.arange(len(positions)), lengths)[keep], self.nuc[idx], self.cell[idx]
+
+    def positions(self):
+        # the position of every entry of the store
+        return np.repeat(np.arange(1, self.gene_len + 1), np.diff(self.offsets))
+
+    def all_arrays(self, min_qual=None):
+        # (pos, nuc, qual, cell) of all the mismatches that pass the filters, like mm_counting.find_mismatches.
+        # min_qual overrides the quality cutoff of the store
+        keep = self._keep(0, len(self.nuc), min_qual)
+        return self.positions()[keep], self.nuc[keep], self.qual[keep], self.cell[keep]
+
+    def quality_histogram(self):
+        # histogram of the qualities of all the mismatches of the reads that pass the cap, ignoring min_qual
+        return quality_histogram(self.all_arrays(min_qual=0), self.gene_len)
+
+    def __getitem__(self, pos):
+        if pos not in self:
+            raise KeyError(pos)
+        nuc, qual, cell = self.get_arrays(pos)
+        cells = self.cells
+        return [(chr(DECODE_TABLE[n]), q, cells[c]) for n, q, c in zip(nuc.tolist(), qual.tolist(), cell.tolist())]
+
+    def values(self):
+        return (self[pos] for pos in self.keys())
+
+    def items(self):
+        return ((pos, self[pos]) for pos in self.keys())
+
+    def mm_count(self):
+        # number of mismatches at each position
+        kept_before = np.concatenate([[0], np.cumsum(self._keep(0, len(self.nuc)))])
+        return np.diff(kept_before[self.offsets])
+
+
+def load_mm_dict(file_name, cap=None, min_qual=MIN_QUAL):
+    # loads either an old position dictionary pickle or a mismatch store directory
+    if os.path.isdir(file_name):
+        return MismatchStore(file_name, cap, min_qual)
+    with open(file_name, "rb") as file:
+        return pickle.load(file)
+
+
+def load_quality_histogram(file_name, cap=None, min_qual=MIN_QUAL):
+    # the quality histogram of a mismatch store directory or of an old position dictionary pickle, where the old
+    # pickle has only the mismatches that passed its quality cutoff (MIN_QUAL), so it can not be used for counting the
+    # mismatches with quality >= min_qual of a lower cutoff
+    if not os.path.isdir(file_name) and min_qual < MIN_QUAL:
+        raise ValueError("'{}' has only the mismatches with quality >= {}, it can not be used for a quality cutoff of {}."
+                         " Count the mismatches again into a mismatch store".format(file_name, MIN_QUAL, min_qual))
+    good_dict = load_mm_dict(file_name, cap)
+    if isinstance(good_dict, MismatchStore):
+        return good_dict.quality_histogram()
+    mismatches = [(pos, BASES.index(tup[0]), tup[1]) for pos, tups in good_dict.items() for tup in tups]
+    mismatches = np.array(mismatches, dtype=np.int64).reshape(-1, 3)
+    return quality_histogram(mismatches.T, len(good_dict))
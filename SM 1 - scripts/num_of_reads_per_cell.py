@@ -1,25 +1,96 @@
+import os
 import pickle
-import bamnostic as bs
+import sys
+import numpy as np
+import pandas as pd
+from scipy import sparse
 import matplotlib.pyplot as plt
+import stage_metrics
+from bam_reader import open_bam, intern_cells
 
 
-def count_reads_per_cell(gene_name, bam_file):
-    bam = bs.AlignmentFile(bam_file, 'rb')
-    # create dictionary where keys are cell tags and values are the number of reads found in each cell
-    reads_per_cell_count = dict()
-    i = 0
-    for read in bam:
-        cell_tag = read.tags['XC'][1]
-        if cell_tag in reads_per_cell_count.keys():
-            reads_per_cell_count[cell_tag] += 1
-        else:
-            reads_per_cell_count[cell_tag] = 1
-        i += 1
-        if i % 100000 == 0:
-            print("done {} reads".format(i))
-
-    reads_per_cell_count = list(reads_per_cell_count.items()) # convert dict to list of tuples to sort it
-    reads_per_cell_count_sorted = sorted(reads_per_cell_count, key=lambda x: x[1])  # sort by number of reads per cell
+@stage_metrics.measured()
+def count_reads_per_gene_and_cell(bam_file, output_dir="reads_per_cell_counts", no_indels=True):
+    # one pass over the full BAM file, that reads only the gene and the cell tag of each read, and counts the reads of
+    # every gene in every cell (only the reads without indels if no_indels is True, as the reads that are sampled).
+    # the counts are saved as a sparse (genes x cells) matrix in output_dir, with the names of the genes and the cells
+    bam = open_bam(bam_file)
+    cell_ids = {}
+    keys, counts = [], []
+    n_reads = 0
+    for batch in bam.batches(no_indels=no_indels, cell_tags_only=True):
+        mapped = batch.ref_id >= 0
+        cell = intern_cells(batch.cell_tags[mapped], cell_ids).astype(np.int64)
+        # count the reads of each (gene, cell) pair of the batch:
+        batch_keys, batch_counts = np.unique(batch.ref_id[mapped].astype(np.int64) << 32 | cell, return_counts=True)
+        keys.append(batch_keys)
+        counts.append(batch_counts)
+        n_reads += len(batch)
+        stage_metrics.count(len(batch))
+        print("done {} reads".format(n_reads))
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+    matrix = sparse.coo_matrix((counts, (keys >> 32, keys & 0xFFFFFFFF)),
+                               shape=(len(bam.references), len(cell_ids))).tocsr()  # duplicate entries are summed
+    os.makedirs(output_dir, exist_ok=True)
+    sparse.save_npz(os.path.join(output_dir, "counts.npz"), matrix)
+    np.save(os.path.join(output_dir, "genes.npy"), np.array([g.encode() for g in bam.references], dtype='S'))
+    np.save(os.path.join(output_dir, "cells.npy"), np.array([c.encode() for c in cell_ids], dtype='S'))
+    print("The number of reads of {} genes in {} cells was saved to '{}'".format(matrix.shape[0], matrix.shape[1], output_dir))
+    return matrix
+
+
+def load_read_counts(counts_dir="reads_per_cell_counts"):
+    # the (genes x cells) csr matrix of the read counts, and the names of the genes and the cells
+    matrix = sparse.load_npz(os.path.join(counts_dir, "counts.npz"))
+    genes = [g.decode() for g in np.load(os.path.join(counts_dir, "genes.npy"))]
+    cells = [c.decode() for c in np.load(os.path.join(counts_dir, "cells.npy"))]
+    return matrix, genes, cells
+
+
+def gene_reads_per_cell(counts_dir, gene_name):
+    # list of (cell tag, number of reads) of the cells that have reads of the gene, sorted by the number of reads
+    matrix, genes, cells = load_read_counts(counts_dir)
+    row = matrix.getrow(genes.index(gene_name))
+    order = np.argsort(row.data, kind='stable')
+    return [(cells[c], int(n)) for c, n in zip(row.indices[order], row.data[order])]
+
+
+def sampling_summary(counts_dir, amount):
+    # for every gene, the cells that have up to 'amount' reads and are taken whole, and the cells that have more reads
+    # and are sampled from, as written in BAM_file_stats.txt by sample_reads_from_BAM.py
+    matrix, genes, cells = load_read_counts(counts_dir)
+    matrix = matrix.tocsr()
+    gene_of_entry = np.repeat(np.arange(len(genes)), np.diff(matrix.indptr))
+    small = matrix.data <= amount
+    summary = pd.DataFrame(index=genes)
+    summary.index.name = "gene"
+    summary["reads"] = np.bincount(gene_of_entry, matrix.data, minlength=len(genes)).astype(np.int64)
+    summary["cells"] = np.diff(matrix.indptr)
+    summary["cells with up to {} reads".format(amount)] = np.bincount(gene_of_entry[small], minlength=len(genes))
+    summary["reads in these cells"] = np.bincount(gene_of_entry[small], matrix.data[small], minlength=len(genes)).astype(np.int64)
+    summary["cells to sample from"] = summary["cells"] - summary["cells with up to {} reads".format(amount)]
+    summary["reads sampled"] = summary["cells to sample from"] * amount
+    summary["reads in sample"] = summary["reads in these cells"] + summary["reads sampled"]
+    return summary
+
+
+def count_reads_per_cell(gene_name, bam_file, counts_dir=None):
+    # the count of reads of the gene in each cell, taken from the counts of all the genes if counts_dir is given,
+    # otherwise counted from the BAM file (the full BAM file with its index, or the BAM file of the gene)
+    if counts_dir is None:
+        cell_ids = {}
+        cell_counts = np.zeros(0, dtype=np.int64)
+        for batch in open_bam(bam_file).batches(gene_name, no_indels=True, cell_tags_only=True):
+            cell = intern_cells(batch.cell_tags, cell_ids)
+            cell_counts = np.bincount(cell, minlength=len(cell_ids)) + np.pad(cell_counts, (0, len(cell_ids) - len(cell_counts)))
+        print("done {} reads".format(cell_counts.sum()))
+        # list of tuples (cell tag, number of reads in the cell):
+        cells = list(cell_ids)
+        order = np.argsort(cell_counts, kind='stable')  # sort by number of reads per cell
+        reads_per_cell_count_sorted = [(cells[c], int(cell_counts[c])) for c in order]
+    else:
+        reads_per_cell_count_sorted = gene_reads_per_cell(counts_dir, gene_name)
     print("number of cells:", len(reads_per_cell_count_sorted))
 
     # save list reads_per_cell_count_sorted in a file:
@@ -32,9 +103,14 @@ def count_reads_per_cell(gene_name, bam_file):
     print(reads_per_cell_count_sorted[:20])
 
 
-def plot_reads_per_cell(gene_name):
-    count_file = open(gene_name+"/reads_per_cell_count_sorted.pkl", "rb")
-    reads_per_cell_count_sorted = pickle.load(count_file)
+def plot_reads_per_cell(gene_name, counts_dir=None):
+    # the counts are taken from the counts of all the genes if counts_dir is given, otherwise from the file saved by
+    # count_reads_per_cell
+    if counts_dir is None:
+        count_file = open(gene_name+"_reads_per_cell_count_sorted.pkl", "rb")
+        reads_per_cell_count_sorted = pickle.load(count_file)
+    else:
+        reads_per_cell_count_sorted = gene_reads_per_cell(counts_dir, gene_name)
     # plot read per cell:
     fig = plt.gcf()
     fig.set_size_inches(18.5, 10.5, forward=True)
@@ -62,6 +138,16 @@ def plot_reads_per_cell(gene_name):
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # python num_of_reads_per_cell.py <bowtie_gene_exon_tagged_clean.bam> [amount]: count the reads of all the
+        # genes in all the cells in one pass, and summarize the sampling of each gene with a cap of 'amount' reads
+        bam_file = sys.argv[1]
+        amount = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+        count_reads_per_gene_and_cell(bam_file)
+        summary_file_name = "sampling_summary_{}_reads_per_cell.csv".format(amount)
+        sampling_summary("reads_per_cell_counts", amount).to_csv(summary_file_name)
+        print("The sampling summary of all the genes was saved to '{}'".format(summary_file_name))
+        exit()
     gene_name = 'dd_Smed_v6_332_0_1'
     bam_file = '332_no_indels_mm_sorted.bam'
     count_reads_per_cell(gene_name, bam_file)
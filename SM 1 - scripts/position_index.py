@@ -0,0 +1,115 @@
+# Index of the positions of all the genes for the queries of distribution.py, built once over the combined dataset
+# (see mm_dataset.py) in its directory ('<dataset_dir>/index'):
+#   table - the rows of all the genes in one columnar table (as saved by mm_info.save_info), with the gene of each row
+#           in 'gene_id' (its number in genes.json), read memory-mapped
+#   mm_order.npy, mm_sorted.npy - the rows sorted by the mismatch %, and the mismatch % in this order, so the positions
+#                                 in a range of mismatch % are found by binary search
+#   second_nuc.npy - the second highest of the 4 'X /total reads (%)' values of each row. the nucleotide of the
+#                    reference is 0 there, so a position has at least 2 nucleotides other than the reference with
+#                    frequency >= thresh exactly when this value is >= thresh, for every thresh
+#   source.json - the size and modification time of the genes.json of the dataset the index was built from
+# The index is rebuilt automatically when the dataset is written again.
+
+import json
+import os
+import numpy as np
+from mm_dataset import COLUMNS, GENE_COL, NUCS_P, dataset_genes, partition_dir
+from mm_info import MM_COL_P, info_to_dataframe, load_info
+from reference_store import building, is_up_to_date
+
+_indexes = {}
+
+
+def index_dir(dataset_dir):
+    return os.path.join(dataset_dir, "index")
+
+
+def build_position_index(dataset_dir):
+    out_dir = index_dir(dataset_dir)
+    print("Building the positions index of '{}' in '{}'".format(dataset_dir, out_dir))
+    genes = dataset_genes(dataset_dir)
+    total = sum(length for _, length in genes)
+    with building(out_dir, os.path.join(dataset_dir, "genes.json")) as tmp_dir:
+        table_dir = os.path.join(tmp_dir, "table")
+        os.makedirs(table_dir, exist_ok=True)
+        names = ['gene_id'] + COLUMNS
+        # the columns have the types of the columns of the genes:
+        dtypes = {name: values.dtype for name, values in load_info(partition_dir(dataset_dir, genes[0][0])).items()} if genes else {}
+        dtypes['gene_id'] = np.int32
+        table = {name: np.lib.format.open_memmap(os.path.join(table_dir, "{}.npy".format(i)), 'w+',
+                                                 dtypes.get(name, np.float64), (total,)) for i, name in enumerate(names)}
+        second_nuc = np.lib.format.open_memmap(os.path.join(tmp_dir, "second_nuc.npy"), 'w+', np.float64, (total,))
+        start = 0
+        for gene_id, (gene_name, length) in enumerate(genes):  # one gene at a time, into the memory-mapped columns
+            info = load_info(partition_dir(dataset_dir, gene_name))
+            table['gene_id'][start:start + length] = gene_id
+            for name in COLUMNS:
+                table[name][start:start + length] = info[name]
+            second_nuc[start:start + length] = np.sort(np.column_stack([info[col] for col in NUCS_P]), axis=1)[:, -2]
+            start += length
+        with open(os.path.join(table_dir, "columns.json"), "w") as f:
+            json.dump(names, f)
+        order = np.argsort(table[MM_COL_P], kind='stable')
+        np.save(os.path.join(tmp_dir, "mm_order.npy"), order)
+        np.save(os.path.join(tmp_dir, "mm_sorted.npy"), table[MM_COL_P][order])
+        for column in list(table.values()) + [second_nuc]:
+            column.flush()
+        del table, second_nuc
+    print("The index was built, it has {} positions of {} genes".format(total, len(genes)))
+
+
+def index_is_up_to_date(dataset_dir):
+    return is_up_to_date(os.path.join(dataset_dir, "genes.json"), index_dir(dataset_dir))
+
+
+class PositionIndex:
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+        if not index_is_up_to_date(dataset_dir):
+            build_position_index(dataset_dir)
+        self.dir = index_dir(dataset_dir)
+        self.genes = [gene_name for gene_name, _ in dataset_genes(dataset_dir)]
+        self.table = load_info(os.path.join(self.dir, "table"))
+        self.mm_order = np.load(os.path.join(self.dir, "mm_order.npy"), mmap_mode='r')
+        self.mm_sorted = np.load(os.path.join(self.dir, "mm_sorted.npy"), mmap_mode='r')
+        self.second_nuc = np.load(os.path.join(self.dir, "second_nuc.npy"), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.mm_order)
+
+    def rows(self, rows):
+        # the rows (numbers over all the genes, as in the old combined csv file) as a DataFrame in the layout of the
+        # combined file, indexed by their numbers
+        rows = np.asarray(rows, dtype=np.int64)
+        df = info_to_dataframe({name: self.table[name][rows] for name in COLUMNS})
+        df.insert(0, GENE_COL, np.array(self.genes + [''], dtype=object)[self.table['gene_id'][rows]])
+        df.index = rows
+        return df
+
+    def mm_range(self, min, max):
+        # numbers of the rows with min <= mismatch % <= max, ordered by the mismatch %
+        start = np.searchsorted(self.mm_sorted, min, side='left')
+        stop = np.searchsorted(self.mm_sorted, max, side='right')
+        return self.mm_order[start:stop]
+
+    def positions_in_range(self, min, max):
+        return self.rows(self.mm_range(min, max))
+
+    def positions_with_3_nucs(self, thresh):
+        # positions with at least thresh % of the reference nucleotide and at least 2 other nucleotides with frequency
+        # of at least thresh %. as in the older version, the rows are numbered among the positions with enough of the
+        # reference nucleotide
+        enough_ref = np.asarray(self.table[MM_COL_P]) < (100 - thresh)
+        rows = np.flatnonzero(enough_ref & (np.asarray(self.second_nuc) >= thresh))
+        df = self.rows(rows)
+        df['how many >= ' + str(thresh)] = (df[NUCS_P].to_numpy() >= thresh).sum(axis=1)
+        df.index = np.cumsum(enough_ref)[rows] - 1
+        return df
+
+
+def load_position_index(dataset_dir):
+    # the index is opened once per process
+    key = os.path.abspath(dataset_dir)
+    if key not in _indexes or not index_is_up_to_date(dataset_dir):
+        _indexes[key] = PositionIndex(dataset_dir)
+    return _indexes[key]
@@ -15,7 +15,7 @@ Perform processing of the cleaned alignment BAM file per selected gene
 -f <reference_fasta>  : Reference fasta file containing all genes. Required. 
 -n <gene_number>      : The first number appearing in the gene name. Required. 
 
-Data files required: cleaned bowtie alignment bam file (bowtie_gene_exon_tagged_clean.bam), reference fasta file
+Data files required: cleaned bowtie alignment bam file (bowtie_gene_exon_tagged_clean.bam) and its index, reference fasta file
 Loaded modules required: samtools/samtools-1.14, python/python-anaconda3.2019.10
 EOF
 }
@@ -74,30 +74,17 @@ file_prefix=${outdir}/${gene_name}/${gene_number}
 
 mkdir ${gene_name} # create directory named as the gene, and all files related to the gene will be saved there
 
-echo -e "\nPerforming first stage of samtools processing"
-
-samtools view -b ${bam_file} ${gene_name} -o ${dir_prefix}/${gene_name}.bam
-
-samtools view -b -e "ncigar==1" ${dir_prefix}/${gene_name}.bam -o ${file_prefix}_no_indels.bam
-
-samtools calmd -eb ${file_prefix}_no_indels.bam ${reference_fasta} > ${file_prefix}_no_indels_mm.bam
-
-samtools sort ${file_prefix}_no_indels_mm.bam -o ${file_prefix}_no_indels_mm_sorted.bam
-
-echo -e "\nDone performing first stage of samtools processing"
+# the reads of the gene are fetched from the full BAM file through its index (${bam_file}.bai, created with
+# samtools index), and filtered and compared to the reference while they are read (see bam_reader.py), in place of
+# the samtools view / calmd / sort stage that wrote the BAM files of the gene
 echo "Executing sample_reads_from_BAM.py"
 
-python sample_reads_from_BAM.py ${gene_name} ${file_prefix}_no_indels_mm_sorted.bam ${reference_fasta} 
+python sample_reads_from_BAM.py ${gene_name} ${bam_file} ${reference_fasta} 
 
 
 echo -e "\nDone executing sample_reads_from_BAM.py"
-echo "Performing second stage of samtools processing"
-
-samtools view -b -N ${file_prefix}_read_names_to_use.csv ${file_prefix}_no_indels_mm_sorted.bam -o ${file_prefix}_no_indels_mm_sorted_sample.bam
-
-samtools depth -a ${file_prefix}_no_indels_mm_sorted_sample.bam -o ${file_prefix}_sample_depth.tsv
-
-echo -e "\nDone performing second stage of samtools processing"
+# the coverage of the sampled reads is computed by sample_reads_from_BAM.py (${file_prefix}_sample_coverage.npy),
+# so there is no need to filter the BAM file by the sampled read names and run samtools depth on it
 echo "Executing create_mismatches_info_and_barplots.py"
 
 python create_mismatches_info_and_barplots.py ${gene_name} ${reference_fasta} 1 1
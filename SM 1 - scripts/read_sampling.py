@@ -0,0 +1,95 @@
+# Streaming per-cell sampling of reads, done while the BAM file is decoded.
+# Every read gets a random key that depends only on its cell tag (and a global seed) and on its ordinal among the reads
+# of the cell, and each cell keeps the 'amount' reads with the smallest keys seen so far (a bottom-k reservoir).
+# The sample is therefore uniform within each cell, reproducible, and independent of how the reads are batched, and
+# no more than 'amount' reads per cell are ever kept in memory.
+# The sampled reads are also ranked by their keys within each cell, and since the keys do not depend on the amount,
+# the reads with rank < k are exactly the sample with an amount of k, for every k <= amount. So one sample with the
+# largest amount (or amount=None, meaning all the reads) holds the samples of all the smaller amounts.
+
+import zlib
+import numpy as np
+from read_store import ReadTable, ReadTableBuilder
+
+GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+
+def mix64(z):
+    # the splitmix64 finalizer, z is a uint64 array (the multiplications are modulo 2**64)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def cell_seeds(tags, seed=1):
+    crc = np.array([zlib.crc32(tag.encode()) for tag in tags], dtype=np.uint64)
+    return mix64(crc | (np.uint64(seed) << np.uint64(32)))
+
+
+def read_keys(seeds, ordinals):
+    # the random key of the read with the given ordinal (0 for the first read of the cell) in the cell of the seed
+    return mix64(seeds + (ordinals.astype(np.uint64) + np.uint64(1)) * GAMMA)
+
+
+def group_ranks(groups):
+    # rank of each item within its group, in the order the items appear. groups are sorted and non negative ints
+    starts = np.searchsorted(groups, groups, side='left')
+    return np.arange(len(groups)) - starts
+
+
+def bottom_k(cells, keys, k):
+    # indices of the k items with the smallest keys in each cell, and their rank (0 for the smallest key)
+    order = np.lexsort((keys, cells))
+    ranks = group_ranks(cells[order])
+    if k is not None:
+        order, ranks = order[ranks < k], ranks[ranks < k]
+    return order, ranks
+
+
+class CellReservoirSampler:
+    # add() takes consecutive batches (ReadTables) of the BAM file, with the cell ids of one shared dictionary
+    def __init__(self, amount, seed=1):
+        self.amount = amount
+        self.seed = seed
+        self.cell_counts = np.zeros(0, dtype=np.int64)  # number of reads seen in each cell
+        self.seeds = np.zeros(0, dtype=np.uint64)
+        self.n_reads = 0
+        self.kept = None
+        self.kept_keys = np.zeros(0, dtype=np.uint64)
+        self.kept_index = np.zeros(0, dtype=np.int64)  # index of each kept read in the BAM file
+
+    def add(self, batch):
+        n_cells = len(batch.cells)
+        if n_cells > len(self.seeds):  # new cells appeared in this batch
+            self.seeds = np.concatenate([self.seeds, cell_seeds(batch.cells[len(self.seeds):], self.seed)])
+            self.cell_counts = np.concatenate([self.cell_counts, np.zeros(n_cells - len(self.cell_counts), dtype=np.int64)])
+        cell = np.asarray(batch.cell, dtype=np.int64)
+        order = np.argsort(cell, kind='stable')
+        ordinals = np.empty(len(cell), dtype=np.int64)
+        ordinals[order] = group_ranks(cell[order]) + self.cell_counts[cell[order]]
+        keys = read_keys(self.seeds[cell], ordinals)
+        self.cell_counts += np.bincount(cell, minlength=n_cells)
+        index = self.n_reads + np.arange(len(batch))
+        self.n_reads += len(batch)
+
+        # merge the batch with the reads kept so far, and keep the reads with the smallest keys in each cell:
+        candidates = ReadTable.concat([self.kept, batch])
+        keys = np.concatenate([self.kept_keys, keys])
+        index = np.concatenate([self.kept_index, index])
+        keep, _ = bottom_k(np.asarray(candidates.cell, dtype=np.int64), keys, self.amount)
+        keep.sort()
+        self.kept = candidates.take(keep)
+        self.kept_keys = keys[keep]
+        self.kept_index = index[keep]
+
+    def result(self):
+        # the sampled reads in the order of the BAM file, with their rank within their cell
+        if self.kept is None:
+            self.kept = ReadTableBuilder().build()
+            self.kept_keys = np.zeros(0, dtype=np.uint64)
+        order, ranks = bottom_k(np.asarray(self.kept.cell, dtype=np.int64), self.kept_keys, None)
+        self.kept.rank = np.empty(len(ranks), dtype=np.int32)
+        self.kept.rank[order] = ranks
+        self.kept.sampling_cap = self.amount
+        order = np.argsort(self.kept_index)
+        return self.kept.take(order)
@@ -0,0 +1,208 @@
+# Columnar, memory-mappable storage of the reads parsed from a gene's BAM file.
+# A store is a directory of .npy files: the bases and qualities of all the reads are concatenated into two uint8
+# buffers that share one offsets array, and the cell tags are kept once in a separate dictionary ('cells.npy'),
+# with every read holding only the id of its cell.
+# A ranked sample (see read_sampling.py) also keeps the rank of each read in 'rank.npy', and the cap it was sampled with
+# in 'sampling_cap.json', since only the samples of caps up to that cap can be taken out of it.
+
+import json
+import os
+from array import array
+import numpy as np
+import pandas as pd
+
+# the 4-bit base alphabet of the BAM format. '=' marks a base that matches the reference (after samtools calmd -e)
+BASES = "=ACMGRSVTWYHKDBN"
+# translation table from ascii to base code, any unknown character is encoded as 'N'
+ENCODE_TABLE = bytes(BASES.index(chr(c).upper()) if chr(c).upper() in BASES else BASES.index('N') for c in range(256))
+DECODE_TABLE = np.frombuffer(BASES.encode(), dtype=np.uint8)
+MATCH_CODE = BASES.index('=')
+
+COLUMNS = ['pos', 'NM', 'cell', 'offsets', 'seq', 'qual', 'name_offsets', 'names', 'cells']
+
+
+def encode_seq(seq):
+    return np.frombuffer(seq.encode().translate(ENCODE_TABLE), dtype=np.uint8)
+
+
+def decode_seq(codes):
+    return DECODE_TABLE[codes].tobytes().decode()
+
+
+def check_cap(cap, sampling_cap, source="The reads"):
+    # a sample with a cap of 'cap' reads per cell can be taken out of a sample of sampling_cap reads per cell only when
+    # cap <= sampling_cap (None is no cap)
+    if cap is not None and sampling_cap is not None and cap > sampling_cap:
+        raise ValueError("{} were sampled with up to {} reads per cell, a cap of {} reads per cell can not be taken out "
+                         "of them. Sample the reads again with a larger cap (sample_reads_from_BAM.py)".format(
+                             source, sampling_cap, cap))
+
+
+def ragged_take(buffer, offsets, idx):
+    # gather the variable length items 'idx' out of a buffer of concatenated items, returns (new_buffer, new_offsets)
+    starts = offsets[idx]
+    lengths = offsets[np.asarray(idx) + 1] - starts
+    new_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    flat = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return np.asarray(buffer)[flat], new_offsets
+
+
+class ReadTable:
+    # pos - 1-based position of the read, NM - number of mismatches, cell - id of the cell tag in 'cells',
+    # seq / qual - base codes / sequencing qualities of all the reads, read i is at offsets[i]:offsets[i+1],
+    # names - read names as bytes, read i is at name_offsets[i]:name_offsets[i+1]
+    # rank - optional, rank of the read within its cell in a sample (see read_sampling.py)
+    # sampling_cap - the cap the sample was taken with, None if it is not capped (or not known)
+    def __init__(self, pos, NM, cell, cells, offsets, seq, qual, name_offsets, names, rank=None, sampling_cap=None):
+        self.pos = pos
+        self.NM = NM
+        self.cell = cell
+        self.cells = cells
+        self.offsets = offsets
+        self.seq = seq
+        self.qual = qual
+        self.name_offsets = name_offsets
+        self.names = names
+        self.rank = rank
+        self.sampling_cap = sampling_cap
+
+    def __len__(self):
+        return len(self.pos)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def get_seq(self, i):
+        return decode_seq(self.seq[self.offsets[i]:self.offsets[i+1]])
+
+    def get_qual(self, i):
+        return self.qual[self.offsets[i]:self.offsets[i+1]]
+
+    def get_name(self, i):
+        return bytes(self.names[self.name_offsets[i]:self.name_offsets[i+1]]).decode()
+
+    def get_tag(self, i):
+        return self.cells[self.cell[i]]
+
+    def read_names(self):
+        return [self.get_name(i) for i in range(len(self))]
+
+    def tags(self):
+        return np.asarray(self.cells, dtype=object)[self.cell]
+
+    def take(self, idx):
+        # a new table with only the reads 'idx', in the given order. the cells dictionary is shared
+        idx = np.asarray(idx, dtype=np.int64)
+        seq, offsets = ragged_take(self.seq, self.offsets, idx)
+        qual, _ = ragged_take(self.qual, self.offsets, idx)
+        names, name_offsets = ragged_take(self.names, self.name_offsets, idx)
+        rank = None if self.rank is None else np.asarray(self.rank)[idx]
+        return ReadTable(np.asarray(self.pos)[idx], np.asarray(self.NM)[idx], np.asarray(self.cell)[idx], self.cells,
+                         offsets, seq, qual, name_offsets, names, rank, self.sampling_cap)
+
+    def up_to_rank(self, cap):
+        # the reads of a sample with a cap of 'cap' reads per cell, cap=None means all the reads. raises ValueError
+        # when the cap is larger than the cap the reads were sampled with
+        check_cap(cap, self.sampling_cap)
+        if cap is None or self.rank is None:
+            return self
+        return self.take(np.flatnonzero(np.asarray(self.rank) < cap))
+
+    @staticmethod
+    def concat(tables):
+        # the tables must share one cells dictionary, that may only grow from table to table (see ReadTableBuilder)
+        tables = [t for t in tables if t is not None]
+        offsets = [np.zeros(1, dtype=np.int64)]
+        name_offsets = [np.zeros(1, dtype=np.int64)]
+        for t in tables:
+            offsets.append(np.asarray(t.offsets[1:]) + offsets[-1][-1])
+            name_offsets.append(np.asarray(t.name_offsets[1:]) + name_offsets[-1][-1])
+        ranked = all(t.rank is not None for t in tables)
+        return ReadTable(*[np.concatenate([getattr(t, col) for t in tables]) for col in ['pos', 'NM', 'cell']],
+                         tables[-1].cells, np.concatenate(offsets),
+                         *[np.concatenate([getattr(t, col) for t in tables]) for col in ['seq', 'qual']],
+                         np.concatenate(name_offsets), np.concatenate([t.names for t in tables]),
+                         np.concatenate([t.rank for t in tables]) if ranked else None,
+                         tables[-1].sampling_cap if ranked else None)
+
+    def to_dataframe(self):
+        # the reads in the layout of the old 'bam_as_df.csv.gz' file
+        df = pd.DataFrame(columns=['name', 'pos', 'seq', 'qual', 'tag', 'NM'])
+        df['name'] = self.read_names()
+        df['pos'] = np.asarray(self.pos)
+        df['seq'] = [self.get_seq(i) for i in range(len(self))]
+        df['qual'] = [self.get_qual(i).tolist() for i in range(len(self))]
+        df['tag'] = self.tags()
+        df['NM'] = np.asarray(self.NM)
+        return df
+
+    def to_csv(self, file_name):
+        self.to_dataframe().to_csv(file_name, index=False, compression="gzip")
+
+    def save(self, store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+        for col in COLUMNS:
+            values = self.cells if col == 'cells' else getattr(self, col)
+            if col == 'cells':
+                values = np.array([c.encode() for c in values], dtype='S') if len(values) else np.zeros(0, dtype='S1')
+            np.save(os.path.join(store_dir, col + ".npy"), np.asarray(values))
+        if self.rank is not None:
+            np.save(os.path.join(store_dir, "rank.npy"), np.asarray(self.rank))
+            with open(os.path.join(store_dir, "sampling_cap.json"), "w") as f:
+                json.dump({'sampling_cap': self.sampling_cap}, f)
+
+    @staticmethod
+    def load(store_dir, mmap=True):
+        # with mmap=True the columns are memory-mapped and nothing is read until it is accessed
+        mode = 'r' if mmap else None
+        cols = {col: np.load(os.path.join(store_dir, col + ".npy"), mmap_mode=mode) for col in COLUMNS}
+        cols['cells'] = [c.decode() for c in cols['cells']]
+        if os.path.exists(os.path.join(store_dir, "rank.npy")):
+            cols['rank'] = np.load(os.path.join(store_dir, "rank.npy"), mmap_mode=mode)
+        if os.path.exists(os.path.join(store_dir, "sampling_cap.json")):  # not kept by stores of older versions
+            with open(os.path.join(store_dir, "sampling_cap.json")) as f:
+                cols['sampling_cap'] = json.load(f)['sampling_cap']
+        return ReadTable(**cols)
+
+
+class ReadTableBuilder:
+    # collects reads one by one into compact buffers, without keeping a python object per read.
+    # builders of consecutive batches of the same BAM file can share the cell_ids dictionary
+    def __init__(self, cell_ids=None):
+        self.cell_ids = {} if cell_ids is None else cell_ids  # keys are cell tags, values are their ids
+        self.pos = array('i')
+        self.NM = array('i')
+        self.cell = array('i')
+        self.lengths = array('q')
+        self.seq = bytearray()
+        self.qual = bytearray()
+        self.name_lengths = array('q')
+        self.names = bytearray()
+
+    def __len__(self):
+        return len(self.pos)
+
+    def add(self, name, pos, seq, qual, tag, nm):
+        cell_id = self.cell_ids.setdefault(tag, len(self.cell_ids))
+        self.pos.append(pos)
+        self.NM.append(nm)
+        self.cell.append(cell_id)
+        self.lengths.append(len(seq))
+        self.seq += seq.encode().translate(ENCODE_TABLE)
+        self.qual += bytes(qual)
+        name = name.encode()
+        self.name_lengths.append(len(name))
+        self.names += name
+
+    def build(self):
+        offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum(np.frombuffer(self.lengths, dtype=np.int64), out=offsets[1:])
+        name_offsets = np.zeros(len(self.name_lengths) + 1, dtype=np.int64)
+        np.cumsum(np.frombuffer(self.name_lengths, dtype=np.int64), out=name_offsets[1:])
+        return ReadTable(np.frombuffer(self.pos, dtype=np.int32), np.frombuffer(self.NM, dtype=np.int32),
+                         np.frombuffer(self.cell, dtype=np.int32), list(self.cell_ids),
+                         offsets, np.frombuffer(bytes(self.seq), dtype=np.uint8),
+                         np.frombuffer(bytes(self.qual), dtype=np.uint8), name_offsets,
+                         np.frombuffer(bytes(self.names), dtype=np.uint8))
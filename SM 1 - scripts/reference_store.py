@@ -0,0 +1,125 @@
+# Persistent store of the reference fasta file (e.g. dd_Smed_v6.fasta), built once and reused by all the genes.
+# The store is a directory next to the fasta file ('<fasta_file>.refcache') that holds:
+#   names.npy, lengths.npy - the gene names and the length of each gene sequence
+#   seq.npy, seq_offsets.npy - all the gene sequences concatenated as uint8 (ascii) values, memory-mapped on load
+#   genes.gtf - a GTF file with one exon per gene, as created by create_gtf.py
+#   source.json - the size and modification time of the fasta file the store was built from
+# The store is rebuilt automatically when the fasta file changes.
+
+import contextlib
+import json
+import os
+import shutil
+import numpy as np
+from read_store import ENCODE_TABLE
+
+
+def write_gtf(names, lengths, gtf_file_name):
+    f = open(gtf_file_name, "w")
+    for id, length in zip(names, lengths):
+        record = '''{}\tsmed\texon\t1\t{}\t.\t+\t.\tgene_id "{}"; transcript_id "{}"; exon_number "1"; gene_name "{}"; gene_biotype "{}"; transcript_name "{}"; exon_id "{}";\n'''.format(
+                id, length, id, id, id, id, id, id)
+        f.write(record)
+    f.close()
+
+
+def file_signature(file_name):
+    # identifies the version of a source file that a cache was built from
+    stat = os.stat(file_name)
+    return {'file': os.path.abspath(file_name), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_up_to_date(source_file, cache_dir):
+    # a cache directory is up to date when it was built from the current version of its source file
+    signature_file = os.path.join(cache_dir, "source.json")
+    if not os.path.exists(signature_file):
+        return False
+    with open(signature_file) as f:
+        return json.load(f) == file_signature(source_file)
+
+
+@contextlib.contextmanager
+def building(cache_dir, source_file):
+    # the block writes the cache into the yielded temporary directory, that is then moved into place with the signature
+    # of the source file, so a cache that is being built is never read
+    tmp_dir = "{}.tmp{}".format(cache_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        yield tmp_dir
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    with open(os.path.join(tmp_dir, "source.json"), "w") as f:
+        json.dump(file_signature(source_file), f)
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:  # another process has just built the same cache
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def build_reference_store(fasta_file, cache_dir):
+    print("Building the reference store of '{}' in '{}'".format(fasta_file, cache_dir))
+    names, lengths = [], []
+    seq = bytearray()
+    with open(fasta_file, "rb") as f:
+        for line in f:
+            if line.startswith(b'>'):
+                names.append(line[1:].split()[0].decode())  # the record id, as in Bio.SeqIO
+                lengths.append(0)
+            elif names:
+                bases = line.rstrip(b'\r\n')
+                lengths[-1] += len(bases)
+                seq += bases
+
+    with building(cache_dir, fasta_file) as tmp_dir:
+        np.save(os.path.join(tmp_dir, "names.npy"), np.array([n.encode() for n in names], dtype='S'))
+        np.save(os.path.join(tmp_dir, "lengths.npy"), np.array(lengths, dtype=np.int64))
+        np.save(os.path.join(tmp_dir, "seq_offsets.npy"), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+        np.save(os.path.join(tmp_dir, "seq.npy"), np.frombuffer(bytes(seq), dtype=np.uint8))
+        write_gtf(names, lengths, os.path.join(tmp_dir, "genes.gtf"))
+    print("The reference store was built, it contains {} genes".format(len(names)))
+
+
+class ReferenceStore:
+    def __init__(self, fasta_file, cache_dir=None):
+        self.fasta_file = fasta_file
+        self.cache_dir = fasta_file + ".refcache" if cache_dir is None else cache_dir
+        if not is_up_to_date(fasta_file, self.cache_dir):
+            build_reference_store(fasta_file, self.cache_dir)
+        self.names = [n.decode() for n in np.load(os.path.join(self.cache_dir, "names.npy"))]
+        self.lengths = np.load(os.path.join(self.cache_dir, "lengths.npy"))
+        self.seq_offsets = np.load(os.path.join(self.cache_dir, "seq_offsets.npy"))
+        self.seq = np.load(os.path.join(self.cache_dir, "seq.npy"), mmap_mode='r')
+        self.gtf_file = os.path.join(self.cache_dir, "genes.gtf")
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def __contains__(self, gene_name):
+        return gene_name in self.index
+
+    def gene_length(self, gene_name):
+        return int(self.lengths[self.index[gene_name]])
+
+    def gene_array(self, gene_name):
+        # the sequence of the gene as uint8 ascii values
+        i = self.index[gene_name]
+        return self.seq[self.seq_offsets[i]:self.seq_offsets[i+1]]
+
+    def gene_sequence(self, gene_name):
+        return self.gene_array(gene_name).tobytes().decode()
+
+    def gene_codes(self, gene_name):
+        # the sequence of the gene as base codes of read_store.BASES
+        return np.frombuffer(self.gene_array(gene_name).tobytes().translate(ENCODE_TABLE), dtype=np.uint8)
+
+
+_stores = {}
+
+
+def load_reference(fasta_file):
+    # the reference store of the fasta file, loaded once per process
+    key = os.path.abspath(fasta_file)
+    if key not in _stores:
+        _stores[key] = ReferenceStore(fasta_file)
+    return _stores[key]
@@ -0,0 +1,107 @@
+# Runs the per-gene pipeline of process_BAM_for_gene.sh for all the genes in a genes file, in parallel.
+# Usage: python run_genes.py <genes_file> <bowtie_gene_exon_tagged_clean.bam> <reference_fasta> [workers] [amounts] [force]
+# Each gene is worked on by one process of a pool of 'workers' processes (default is the number of CPUs), and the
+# genes are scheduled from the gene with the most reads to the gene with the least reads (counted from the index of
+# the BAM file), so the long genes do not end up running alone at the end.
+# The files of each gene are created in the gene directory exactly as process_BAM_for_gene.sh creates them, and the
+# output of the work on each gene is written to '<gene dir>/<num>_run_log.txt' instead of the screen.
+# The reads of each gene are fetched from the BAM file through its index, so the BAM file needs to be indexed
+# (samtools index), and each worker process keeps the BAM file open for all the genes it works on.
+# The stages of a gene that are up to date are skipped (see stage_cache.py), so running again after a stop continues
+# the work where it stopped.
+# Each stage of each gene, and the whole work on the gene, are measured (see stage_metrics.py): the records are written
+# to '<gene dir>/<num>_metrics.jsonl', or to one file for all the genes if MM_METRICS_FILE is set.
+
+import contextlib
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib
+matplotlib.use('Agg')  # the plots are only saved, the worker processes have no display
+import sample_reads_from_BAM
+import stage_metrics
+import create_mismatches_info_and_barplots
+from sample_reads_from_BAM import get_file_prefix
+from reference_store import load_reference
+from bam_reader import open_bam
+
+
+def read_genes_file(genes_file):
+    with open(genes_file) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def gene_read_counts(bam_file):
+    # number of reads mapped to each reference in the BAM file, as written in its index
+    bam = open_bam(bam_file)
+    return {name: stats[0] for name, stats in zip(bam.references, bam.get_index_stats())}
+
+
+def order_genes(genes, bam_file):
+    # the genes ordered from the one with the most reads to the one with the least reads
+    try:
+        counts = gene_read_counts(bam_file)
+    except Exception as e:  # no index, all the genes are considered the same size
+        print("Could not read the index of '{}' ({}), the genes are not ordered by size".format(bam_file, e))
+        counts = {}
+    return sorted(genes, key=lambda gene: counts.get(gene, 0), reverse=True), counts
+
+
+def run_gene(gene_name, bam_file, fasta_file, amounts, force=False):
+    # the work on one gene, in a worker process. returns the gene name, the error (None if the work was done) and the
+    # time it took
+    start = time.time()
+    os.makedirs(gene_name, exist_ok=True)
+    log_file_name = get_file_prefix(gene_name) + "run_log.txt"
+    error = None
+    with open(log_file_name, "w") as log, contextlib.redirect_stdout(log):
+        try:
+            with stage_metrics.stage("gene", gene_name, get_file_prefix(gene_name) + "metrics.jsonl"):
+                print("Executing sample_reads_from_BAM.py")
+                sample_reads_from_BAM.do_work_for_gene(gene_name, bam_file, fasta_file, amounts, force=force)
+                print("Executing create_mismatches_info_and_barplots.py")
+                create_mismatches_info_and_barplots.do_work_for_gene(gene_name, fasta_file, True, True, force=force)
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+    return gene_name, error, time.time() - start
+
+
+def run_genes(genes, bam_file, fasta_file, workers=None, amounts=None, force=False):
+    genes, counts = order_genes(genes, bam_file)
+    load_reference(fasta_file)  # the reference store is built once, before the workers use it
+    print("Working on {} genes with {} processes".format(len(genes), workers or os.cpu_count()))
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_gene, gene, bam_file, fasta_file, amounts, force) for gene in genes]
+        for done, future in enumerate(as_completed(futures), 1):
+            gene_name, error, seconds = future.result()
+            if error is None:
+                print("[{}/{}] Done working on gene '{}' ({} reads) in {:.1f} seconds".format(
+                    done, len(genes), gene_name, counts.get(gene_name, '?'), seconds))
+            else:
+                failed.append(gene_name)
+                print("[{}/{}] FAILED working on gene '{}', see '{}':\n{}".format(
+                    done, len(genes), gene_name, get_file_prefix(gene_name) + "run_log.txt",
+                    error.strip().splitlines()[-1]))
+    if failed:
+        print("Failed on {} of {} genes: {}".format(len(failed), len(genes), ", ".join(failed)))
+    else:
+        print("Completed successfully for all {} genes!".format(len(genes)))
+    return failed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5, 6, 7):
+        print("There should be 3 to 6 arguments, but {} were passed. Exiting.".format(len(sys.argv)))
+        exit()
+    genes_file = sys.argv[1]  # txt file containing the names of the genes to work on
+    bam_file = sys.argv[2]  # bowtie_gene_exon_tagged_clean.bam
+    fasta_file = sys.argv[3]  # "dd_Smed_v6.fasta"
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else None  # optional, number of processes
+    amounts = sample_reads_from_BAM.parse_amounts(sys.argv[5]) if len(sys.argv) > 5 else None  # optional, as in sample_reads_from_BAM.py
+    force = len(sys.argv) > 6 and sys.argv[6] == '1'  # optional, binary: run all the stages, even the up to date ones
+    failed = run_genes(read_genes_file(genes_file), bam_file, fasta_file, workers, amounts, force)
+    exit(1 if failed else 0)
@@ -1,159 +1,219 @@
-import bamnostic as bs
+import numpy as np
+import os
 import pandas as pd
-from Bio import SeqIO
 import pickle
-from ast import literal_eval
 import sys
+from scipy import sparse
+import stage_metrics
+from read_store import ReadTable
+from bam_reader import read_bam_batches
+from read_sampling import CellReservoirSampler
+from mm_counting import MIN_QUAL, find_mismatches, up_to_rank, at_quality, quality_histogram, count_matrix, read_coverage, cell_count_tensor, mismatches_to_dict
+from mm_store import write_mm_store, MismatchStore
+from reference_store import load_reference
+from stage_cache import StageManifest
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
-gene_name = sys.argv[1]
-bam_file = sys.argv[2]  # X_no_indels_mm_sorted.bam
-fasta_file = sys.argv[3]  # "dd_Smed_v6.fasta"
-file_prefix = ''
-
-
-def set_file_prefix(gene_name):
+def get_file_prefix(gene_name):
     num = gene_name.split('_')[3]
-    global file_prefix
-    file_prefix = gene_name + "/" + num + "_"
-
-
-def parse_bam_into_df(bam_file):
-    print("Parsing BAM file '{}' into a dataframe".format(bam_file))
-    bam = bs.AlignmentFile(bam_file, 'rb')
-    df = pd.DataFrame(columns=['name', 'pos', 'seq', 'qual', 'tag', 'NM'])
-    name_list, pos_list, seq_list, qual_list, tag_list, NM_list = [], [], [], [], [], []
-    i = 0
-    for read in bam:
-        name_list.append(read.read_name)
-        pos_list.append(read.pos + 1)  # as written in the read
-        seq_list.append(read.query_sequence)  # sequence of the read that was aligned
-        qual_list.append(list(read.query_qualities))  # an array of sequencing quality per base
-        tag_list.append(read.tags['XC'][1])  # cell tag
-        NM_list.append(read.tags['NM'][1])  # number of mismatches
-        i += 1
-        if i % 100000 == 0:
-            print("{} reads were processed".format(i))
-    print("Done processing the reads, the dataframe was created")
-    df['name'] = name_list
-    df['pos'] = pos_list
-    df['seq'] = seq_list
-    df['qual'] = qual_list
-    df['tag'] = tag_list
-    df['NM'] = NM_list
-    print("Head of the created dataframe:")
-    print(df.head())
-    output_file_name = file_prefix + "bam_as_df.csv.gz"
-    df.to_csv(output_file_name, index=False, compression="gzip")
-    print("The dataframe was saved to '{}'".format(output_file_name))
-
-
-def sample_reads(gene_name, bam_file, amount):
-    print("Starting sampling reads")
-    df = pd.read_csv(file_prefix + "bam_as_df.csv.gz", compression='gzip', header=0)
-    cnt = df['tag'].value_counts() # count number of distinct cell tags
-    cnt = cnt.reset_index()  # converts from series to dataframe
-    cnt.rename(columns={'index': 'tag', 'tag': 'count'}, inplace=True)
-
-    # divide the dataframe to cells that have up to 'amount' reads, and cells that have more reads:
-    cells_no_sampling = cnt.loc[cnt['count'] <= amount]['tag']
-    cells_to_sample = cnt.loc[cnt['count'] > amount]['tag']
-    reduced_df = df.loc[df['tag'].isin(cells_no_sampling)]  # all reads from cells that have reads up to 'amount'
-
-    # sample 'amount' reads from cells that have more reads this that:
-    df_for_sampling = df.loc[df['tag'].isin(cells_to_sample)]
-    result = df_for_sampling.groupby('tag').sample(n=amount, random_state=1)
-
-    reduced_df = pd.concat([result, reduced_df]) # combine all selected reads
-    output_csv = "bam_as_df_sample.csv.gz"
-    reduced_df.to_csv(file_prefix + output_csv, index=False, compression="gzip")
+    return gene_name + "/" + num + "_"
+
+
+def gene_batches(gene_name, bam_file, fasta_file):
+    # the reads of the gene without indels, with the matches to the reference replaced by '=' (see bam_reader.py).
+    # bam_file is either the full alignment BAM file (with its index) or the BAM file of the gene
+    return read_bam_batches(bam_file, gene_name, load_reference(fasta_file).gene_codes(gene_name))
+
+
+def parse_bam_into_store(gene_name, bam_file, fasta_file, export_csv=False):
+    file_prefix = get_file_prefix(gene_name)
+    print("Parsing BAM file '{}' into a read store".format(bam_file))
+    table = ReadTable.concat(list(gene_batches(gene_name, bam_file, fasta_file)))
+    print("Done processing the reads, the read store was created")
+    print("Head of the created read store:")
+    print(table.take(range(min(5, len(table)))).to_dataframe())
+    output_dir_name = file_prefix + "bam_reads"
+    table.save(output_dir_name)
+    print("The read store was saved to '{}'".format(output_dir_name))
+    if export_csv:
+        output_file_name = file_prefix + "bam_as_df.csv.gz"
+        table.to_csv(output_file_name)
+        print("The reads were also exported to '{}'".format(output_file_name))
+
+
+def sample_reads(gene_name, bam_file, fasta_file, amounts, export_csv=False):
+    # the reads are sampled while the BAM file is parsed, keeping at most max(amounts) reads of each cell in memory.
+    # amounts is a list of caps on the number of reads per cell (None means all the reads), the sample of the largest
+    # cap is saved, and the sample of each smaller cap k are its reads with rank < k
+    file_prefix = get_file_prefix(gene_name)
+    if not isinstance(amounts, list):
+        amounts = [amounts]
+    max_amount = None if None in amounts else max(amounts)
+    print("Starting sampling reads while parsing BAM file '{}'".format(bam_file))
+    sampler = CellReservoirSampler(max_amount)
+    for batch in gene_batches(gene_name, bam_file, fasta_file):
+        sampler.add(batch)
+    sample = sampler.result()
+    output_dir = "bam_sample_reads"
+    sample.save(file_prefix + output_dir)
     print("Done sampling")
-    print("The sampled reads were saved to '{}'".format(file_prefix + output_csv))
+    print("The sampled reads were saved to '{}'".format(file_prefix + output_dir))
+    if export_csv:
+        sample.up_to_rank(amounts[0]).to_csv(file_prefix + "bam_as_df_sample.csv.gz")
+        print("The sampled reads were also exported to '{}'".format(file_prefix + "bam_as_df_sample.csv.gz"))
 
     # save statistics of the gene in a file:
+    cnt = sampler.cell_counts
     txt_output_file_name = file_prefix + "BAM_file_stats.txt"
     f = open(txt_output_file_name, "w")
     f.write("Gene '{}' STATS, in BAM file '{}':\n".format(gene_name, bam_file))
-    f.write("number of reads (w/o indels, only matches or mismatches) in BAM file: {}\n".format(len(df)))
+    f.write("number of reads (w/o indels, only matches or mismatches) in BAM file: {}\n".format(sampler.n_reads))
     f.write("number of distinct cells in BAM file: {}\n".format(len(cnt)))
-    f.write("number of cells that have up to {} reads: {}\n".format(amount, len(cells_no_sampling)))
-    num = sum(cnt.loc[cnt['count'] <= amount]['count'])
-    f.write("number of reads in these cells: {}\n".format(num))
-    f.write("number of cells that have more then {} reads and need to be sampled from: {}\n".format(amount, len(cells_to_sample)))
-    f.write("number of reads in these cells: {}\n".format(len(df_for_sampling)))
-    f.write("number of reads sampled from these cells: {}\n".format(len(result)))
-    f.write("total number of reads in '{}': {}\n".format(output_csv, len(reduced_df)))
+    for amount in amounts:
+        if amount is None:
+            f.write("total number of reads in '{}' with no cap on reads per cell: {}\n".format(output_dir, len(sample)))
+            continue
+        # divide the cells to cells that have up to 'amount' reads, and cells that have more reads:
+        cells_no_sampling = cnt[cnt <= amount]
+        cells_to_sample = cnt[cnt > amount]
+        f.write("number of cells that have up to {} reads: {}\n".format(amount, len(cells_no_sampling)))
+        f.write("number of reads in these cells: {}\n".format(cells_no_sampling.sum()))
+        f.write("number of cells that have more then {} reads and need to be sampled from: {}\n".format(amount, len(cells_to_sample)))
+        f.write("number of reads in these cells: {}\n".format(cells_to_sample.sum()))
+        f.write("number of reads sampled from these cells: {}\n".format(amount * len(cells_to_sample)))
+        f.write("total number of reads in '{}' with up to {} reads per cell: {}\n".format(
+            output_dir, amount, len(sample.up_to_rank(amount))))
     f.close()
+    # the stats of the sample that is counted (amounts[0]), so the file is complete even if the count is skipped:
+    write_sample_stats(txt_output_file_name, sample.up_to_rank(amounts[0]))
     print("Created stat file for the gene named '{}', that reads:".format(txt_output_file_name))
     print(open(txt_output_file_name, "r").read())
 
 
-def count_mm_per_pos(gene_name, fasta_file):
+def write_sample_stats(txt_output_file_name, table):
+    # adds the information of the sample to the gene stat file, in place of the information of a previous sample
+    mm_reads = np.flatnonzero(np.asarray(table.NM) > 0)
+    stats = open(txt_output_file_name, "r").read().split("In the sample file:\n")[0]
+    f = open(txt_output_file_name, 'w')
+    f.write(stats)
+    f.write("In the sample file:\n")
+    f.write("number of reads with mismatches: {}\n".format(len(mm_reads)))
+    f.write("contained within {} distinct cells.\n".format(len(np.unique(np.asarray(table.cell)[mm_reads]))))
+    f.close()
+    return mm_reads
+
+
+def count_mm_per_pos(gene_name, fasta_file, amount=None, per_cell=False, export_pkl=False):
+    # the mismatch store is written for all the sampled reads, so it can be queried with any cap up to the sampling
+    # cap. the stats, counts and pkl file are of the sample with a cap of 'amount' reads per cell, which is also the
+    # sample the store holds when it is opened without a cap
+    file_prefix = get_file_prefix(gene_name)
     print("Starting to count mismatches per position, including only good quality mismatches")
-    df = pd.read_csv(file_prefix + "bam_as_df_sample.csv.gz", compression='gzip', header=0)
-    mm_df = df.loc[df['NM'] > 0]
-    # the 'seq_qual' column supposed to be list but read as str, so we convert it:
-    mm_df['qual'] = mm_df['qual'].apply(literal_eval)
+    all_table = ReadTable.load(file_prefix + "bam_sample_reads")
+    table = all_table.up_to_rank(amount)
+    stage_metrics.count(len(all_table))
 
-    # add some more information to the gene stat file:
+    # add some more information to the gene stat file, in place of the information of a previous count:
     txt_output_file_name = file_prefix + "BAM_file_stats.txt"
-    f = open(txt_output_file_name, 'a')
-    f.write("In the sample file:\n")
-    f.write("number of reads with mismatches: {}\n".format(len(mm_df)))
-    f.write("contained within {} distinct cells.\n".format(mm_df.tag.nunique()))
-    f.close()
+    mm_reads = write_sample_stats(txt_output_file_name, table)
     print("Updated stat file for the gene named {}, that now reads:".format(txt_output_file_name))
     print(open(txt_output_file_name, "r").read())
 
     # find the length of the gene sequence:
-    record_dict = SeqIO.index(fasta_file, "fasta")
-    gene_record = record_dict[gene_name]
-    gene_seq_len = len(gene_record.seq)
-
-    # create a dictionary where keys are positions in the gene reference sequence, values are data of good quality mismatches at each position
-    d = {key: [] for key in range(1, gene_seq_len+1)}
-    print("Number of reads to process:", len(mm_df))
-    for index, read in mm_df.iterrows():
-        seq = read['seq']
-        qual = read['qual']
-        for char_pos, char in enumerate(seq):
-            if char != '=' and qual[char_pos] >= 20:
-                d[char_pos + read['pos']].append((char, qual[char_pos], read['tag']))
-    print("Done processing the reads")
-
-    # save dict d to a pkl file:
-    dict_file_name = file_prefix + "sample_pos_good_quality_mm_dict.pkl"
-    d_file = open(dict_file_name, "wb")
-    pickle.dump(d, d_file)
-    d_file.close()
-    print("The results were saved to '{}'".format(dict_file_name))
+    gene_seq_len = load_reference(fasta_file).gene_length(gene_name)
+
+    # find the mismatches of all qualities in the reads, and count the good quality ones per position and nucleotide:
+    print("Number of reads to process:", len(mm_reads))
+    all_mismatches = find_mismatches(all_table, min_qual=0)
+    mismatches = up_to_rank(all_mismatches, amount)
+    hist_file_name = file_prefix + "sample_mm_qual_hist.npy"
+    np.save(hist_file_name, quality_histogram(mismatches, gene_seq_len))
+    print("The histogram of mismatch qualities per position and nucleotide was saved to '{}'".format(hist_file_name))
+    mismatches = at_quality(mismatches, MIN_QUAL)
+    counts = count_matrix(mismatches, gene_seq_len)
+    counts_file_name = file_prefix + "sample_mm_counts.npy"
+    np.save(counts_file_name, counts)
+    if per_cell:
+        cell_counts_file_name = file_prefix + "sample_mm_cell_counts.npz"
+        sparse.save_npz(cell_counts_file_name, cell_count_tensor(mismatches, gene_seq_len, len(table.cells)))
+        print("The per cell counts were saved to '{}'".format(cell_counts_file_name))
+    print("Done processing the reads, the counts were saved to '{}'".format(counts_file_name))
+
+    # the number of sampled reads covering each position, in place of samtools depth over the sampled reads:
+    coverage_file_name = file_prefix + "sample_coverage.npy"
+    np.save(coverage_file_name, read_coverage(table, gene_seq_len))
+    print("The coverage of each position was saved to '{}'".format(coverage_file_name))
+
+    # save the mismatches of each position in an indexed mismatch store, that is read with any quality cutoff:
+    store_dir_name = file_prefix + "sample_pos_good_quality_mm"
+    write_mm_store(all_mismatches, table.cells, gene_seq_len, store_dir_name, sample_cap=amount,
+                   sampling_cap=all_table.sampling_cap)
+    print("The results were saved to '{}'".format(store_dir_name))
+    if export_pkl:
+        # the old format: a dictionary where keys are positions in the gene reference sequence, values are data of
+        # good quality mismatches at each position
+        d = mismatches_to_dict(mismatches, table.cells, gene_seq_len)
+        dict_file_name = file_prefix + "sample_pos_good_quality_mm_dict.pkl"
+        d_file = open(dict_file_name, "wb")
+        pickle.dump(d, d_file)
+        d_file.close()
+        print("The results were also saved to '{}'".format(dict_file_name))
 
     print("Checking results:")
-    file = open(dict_file_name, "rb")
-    dict = pickle.load(file)
-    print("first 50 positions: ", list(dict.items())[:50])
-    file.close()
+    store = MismatchStore(store_dir_name)
+    print("first 50 positions: ", [(pos, store[pos]) for pos in range(1, min(50, gene_seq_len) + 1)])
 
 
-def save_sample_read_names_to_file():
-    df = pd.read_csv(file_prefix + "bam_as_df_sample.csv.gz", compression='gzip', header=0)
-    names = df['name']
+def save_sample_read_names_to_file(gene_name, amount=None):
+    file_prefix = get_file_prefix(gene_name)
+    table = ReadTable.load(file_prefix + "bam_sample_reads").up_to_rank(amount)
+    names = pd.Series(table.read_names())
     output_file_name = file_prefix + "read_names_to_use.csv"
     names.to_csv(output_file_name, index=False, header=False)
     print("Names of reads that were sampled were saved to '{}'".format(output_file_name))
 
 
-def do_work_for_gene(gene_name):
-    if len(sys.argv) != 4:
-        print("There should be exactly 3 arguments, but {} were passed. Exiting.".format(len(sys.argv)))
-        exit()
-    set_file_prefix(gene_name)
-    parse_bam_into_df(bam_file)
-    sample_reads(gene_name, bam_file, 10)
-    count_mm_per_pos(gene_name, fasta_file)
-    save_sample_read_names_to_file()
+def do_work_for_gene(gene_name, bam_file, fasta_file, amounts=None, export_old=False, force=False):
+    # the stages that are up to date with their inputs and parameters are skipped, unless force is True
+    amounts = [10] if amounts is None else amounts
+    os.makedirs(gene_name, exist_ok=True)  # all files related to the gene are saved in a directory named as the gene
+    file_prefix = get_file_prefix(gene_name)
+    stages = StageManifest(file_prefix + "stages.json", force)
+    if export_old:
+        stages.run("parse", lambda: parse_bam_into_store(gene_name, bam_file, fasta_file, export_csv=True),
+                   inputs=[bam_file, fasta_file], params={'gene_name': gene_name},
+                   outputs=[file_prefix + "bam_reads", file_prefix + "bam_as_df.csv.gz"])
+    stages.run("sample", lambda: sample_reads(gene_name, bam_file, fasta_file, amounts, export_old),
+               inputs=[bam_file, fasta_file], params={'gene_name': gene_name, 'amounts': amounts, 'export_csv': export_old},
+               outputs=[file_prefix + "bam_sample_reads", file_prefix + "bam_sample_reads/sampling_cap.json",
+                        file_prefix + "BAM_file_stats.txt"] +
+                       ([file_prefix + "bam_as_df_sample.csv.gz"] if export_old else []))
+    stages.run("count", lambda: count_mm_per_pos(gene_name, fasta_file, amounts[0], export_pkl=export_old),
+               inputs=[file_prefix + "bam_sample_reads", fasta_file],
+               params={'gene_name': gene_name, 'amount': amounts[0], 'export_pkl': export_old},
+               outputs=[file_prefix + name for name in ["sample_mm_qual_hist.npy", "sample_mm_counts.npy",
+                                                        "sample_coverage.npy", "sample_pos_good_quality_mm",
+                                                        "sample_pos_good_quality_mm/sample_cap.json"]] +
+                       ([file_prefix + "sample_pos_good_quality_mm_dict.pkl"] if export_old else []))
+    if export_old:  # the coverage is computed by count_mm_per_pos, the names are only needed for samtools depth
+        stages.run("read_names", lambda: save_sample_read_names_to_file(gene_name, amounts[0]),
+                   inputs=[file_prefix + "bam_sample_reads"], params={'amount': amounts[0]},
+                   outputs=[file_prefix + "read_names_to_use.csv"])
+
+
+def parse_amounts(arg):
+    # comma separated caps on the number of reads sampled per cell, e.g. "5,10,20,50,all"
+    return [None if a == 'all' else int(a) for a in arg.split(',')]
 
 
 if __name__ == '__main__':
-    do_work_for_gene(gene_name)
+    if len(sys.argv) not in (4, 5, 6):
+        print("There should be 3 to 5 arguments, but {} were passed. Exiting.".format(len(sys.argv)))
+        exit()
+    gene_name = sys.argv[1]
+    bam_file = sys.argv[2]  # bowtie_gene_exon_tagged_clean.bam (with its index), or X_no_indels_mm_sorted.bam
+    fasta_file = sys.argv[3]  # "dd_Smed_v6.fasta"
+    export_old = len(sys.argv) > 4 and sys.argv[4] == '1'  # optional, binary: also export the csv.gz and pkl files of the old format
+    amounts = parse_amounts(sys.argv[5]) if len(sys.argv) > 5 else [10]  # optional, default is 10
+    do_work_for_gene(gene_name, bam_file, fasta_file, amounts, export_old)
@@ -1,13 +1,19 @@
 # This script can be run from the terminal inside IDE, since plt.show() does not work from the regular terminal
-# Argument to pass: the pkl file name of the plot to show
+# Argument to pass: the npz file name of the plot to show (the data of the plot, see mm_plots.py), or the pkl file
+# name of a plot saved by the older version
 
 import pickle
 import matplotlib.pyplot as plt
 import sys
+from mm_plots import draw, load_payload
 
 plot_file_name = sys.argv[1]
 
-plot_file = open(plot_file_name, 'rb')
-ax = pickle.load(plot_file)
+if plot_file_name.endswith(".npz"):
+    fig, ax = plt.subplots()
+    draw(ax, load_payload(plot_file_name))  # all the bars, zooming in shows every position
+else:
+    plot_file = open(plot_file_name, 'rb')
+    ax = pickle.load(plot_file)
 plt.show()
-print("done")
\ No newline at end of file
+print("done")
@@ -0,0 +1,89 @@
+# Incremental running of the stages of the per-gene pipeline (parse -> sample -> count -> read names -> info -> plots).
+# Every stage that was completed is recorded in the manifest file of the gene ('<gene dir>/<num>_stages.json') with a
+# key: a hash of the contents of its input files and of its parameters. A stage is skipped when its key did not change
+# and its output files exist, so changing only a downstream option (e.g. the plots) does not decode the BAM file
+# again, and a run that was stopped continues from the first stage that was not completed.
+# The manifest is written after every stage, through a temporary file, so it always describes completed stages only.
+# Every stage, run or skipped, is measured (see stage_metrics.py), and its record is appended to
+# '<gene dir>/<num>_metrics.jsonl'.
+
+import hashlib
+import json
+import os
+import stage_metrics
+
+FULL_HASH_LIMIT = 1 << 28  # files up to 256MB are hashed entirely
+SAMPLE_SIZE = 1 << 24  # of bigger files (e.g. the full BAM file), only the first and last 16MB are hashed, with the size
+_digests = {}
+
+
+def file_digest(path):
+    # hash of the contents of a file, or of all the files in a directory. the hashes are kept for the process, as long
+    # as the size and the modification time of the file do not change
+    if os.path.isdir(path):
+        h = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                h.update(os.path.relpath(file_path, path).encode())
+                h.update(file_digest(file_path).encode())
+        return h.hexdigest()
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _digests:
+        h = hashlib.sha1(str(stat.st_size).encode())
+        with open(path, "rb") as f:
+            if stat.st_size <= FULL_HASH_LIMIT:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            else:
+                h.update(f.read(SAMPLE_SIZE))
+                f.seek(stat.st_size - SAMPLE_SIZE)
+                h.update(f.read(SAMPLE_SIZE))
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def stage_key(inputs, params):
+    # inputs are paths of files or directories, params are the parameters of the stage (json serializable)
+    content = {'inputs': {os.path.basename(path): file_digest(path) for path in inputs}, 'params': params}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+class StageManifest:
+    def __init__(self, manifest_file, force=False):
+        self.manifest_file = manifest_file
+        self.force = force  # run all the stages, even the ones that are up to date
+        self.gene_name = os.path.basename(os.path.dirname(os.path.abspath(manifest_file)))
+        self.metrics_file = manifest_file.replace("stages.json", "metrics.jsonl")
+        self.stages = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                self.stages = json.load(f)
+
+    def is_up_to_date(self, stage, key, outputs):
+        record = self.stages.get(stage)
+        return (not self.force and record is not None and record['key'] == key and
+                all(os.path.exists(output) for output in outputs))
+
+    def record(self, stage, key, outputs):
+        self.stages[stage] = {'key': key, 'outputs': list(outputs)}
+        tmp_file = "{}.tmp{}".format(self.manifest_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump(self.stages, f, indent=1)
+        os.replace(tmp_file, self.manifest_file)
+
+    def run(self, stage, func, inputs=(), params=None, outputs=()):
+        # runs func() unless the stage is up to date. returns True if the stage was run
+        with stage_metrics.stage(stage, self.gene_name, self.metrics_file) as metrics:
+            key = stage_key(inputs, params)
+            if self.is_up_to_date(stage, key, outputs):
+                print("Stage '{}' is up to date, skipping it".format(stage))
+                metrics['skipped'] = True
+                return False
+            self.stages.pop(stage, None)  # the stage is not completed until func() returns
+            func()
+            self.record(stage, key, outputs)
+            metrics['skipped'] = False
+            return True
@@ -0,0 +1,199 @@
+# Instrumentation of the stages of the pipeline. Each stage (of a gene, see stage_cache.py, or over all the genes, as in
+# distribution.py and check_DGE.py) writes one JSON line with its wall and CPU time, the number of items it processed
+# (reads, positions, genes) and their rate, the bytes it read and wrote, and its peak memory (resident set size).
+# The records are appended to '<gene dir>/<num>_metrics.jsonl' for the stages of a gene and to 'pipeline_metrics.jsonl'
+# for the other stages, or all of them to the file named by the environment variable MM_METRICS_FILE (e.g. for all the
+# genes of run_genes.py, the processes append whole lines to it). MM_METRICS_FILE=off writes no records.
+# The hot loops report what they processed with count(), that only adds to the counters of the running stages, and the
+# other measures are read once at the start and once at the end of a stage (from /proc/self on linux), so the metrics
+# can be left on.
+# Profiling, off by default: with MM_PROFILE=cprofile each stage is run under cProfile ('.prof' files, see pstats), and
+# with MM_PROFILE=sample the stack is sampled every SAMPLE_INTERVAL seconds of CPU time ('.folded' files of collapsed
+# stacks, for flame graphs), which is cheap enough for a production run. The profiles are written next to the metrics
+# file, as '<metrics file>.<gene>.<stage>.prof' or '.folded'.
+
+import collections
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import resource
+import signal
+import threading
+import time
+
+METRICS_ENV = "MM_METRICS_FILE"
+PROFILE_ENV = "MM_PROFILE"
+DEFAULT_METRICS_FILE = "pipeline_metrics.jsonl"
+SAMPLE_INTERVAL = 0.005
+_running = []  # the stages running in this process, the innermost last
+_profiling = []  # only the outermost stage is profiled
+
+
+def metrics_file_for(default_file=DEFAULT_METRICS_FILE):
+    # the file of the records, None if they are not written
+    metrics_file = os.environ.get(METRICS_ENV, default_file)
+    return None if metrics_file in ("", "off") else metrics_file
+
+
+def read_proc_fields(file_name):
+    # the "name: value" fields of a /proc file as a dictionary, empty where there is no /proc
+    try:
+        with open(file_name) as f:
+            fields = (line.split(":", 1) for line in f if ":" in line)
+            return {name: value.split()[0] for name, value in fields if value.strip()}
+    except OSError:
+        return {}
+
+
+def peak_rss_mb():
+    # the peak resident set size since the start of the process, or since the last reset_peak_rss()
+    hwm = read_proc_fields("/proc/self/status").get('VmHWM')
+    if hwm is not None:
+        return int(hwm) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on linux
+
+
+def reset_peak_rss():
+    # the peak of the process is set to its current size (linux >= 4.0), so the peak of each stage is measured on its
+    # own. returns False where it is not possible, the peak is then the one of the process
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def snapshot():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)  # e.g. the pools of processes, once they were joined
+    io = read_proc_fields("/proc/self/io")
+    return {'time': time.perf_counter(), 'cpu': usage.ru_utime + usage.ru_stime,
+            'children_cpu': children.ru_utime + children.ru_stime,
+            'read_bytes': int(io.get('rchar', 0)), 'written_bytes': int(io.get('wchar', 0)),
+            'disk_read_bytes': int(io.get('read_bytes', 0)), 'disk_written_bytes': int(io.get('write_bytes', 0))}
+
+
+def write_record(record, metrics_file):
+    # one line, appended with a single write, so records of several processes are not mixed
+    line = (json.dumps(record) + "\n").encode()
+    directory = os.path.dirname(metrics_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd = os.open(metrics_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def count(n, unit="reads"):
+    # adds n processed items to all the running stages
+    for running in _running:
+        running['items'][unit] = running['items'].get(unit, 0) + int(n)
+
+
+class StackSampler:
+    # samples the stack of the main thread every 'interval' seconds of CPU time of the process
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append("{}:{}".format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous)
+
+    def save(self, file_name):
+        with open(file_name + ".folded", "w") as f:
+            for stack, n in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, n))
+
+
+class CProfiler:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def save(self, file_name):
+        self.profile.dump_stats(file_name + ".prof")
+
+
+def start_profiler(metrics_file):
+    # the profiler asked for in MM_PROFILE, if no stage is profiled already and profiling is possible
+    kind = os.environ.get(PROFILE_ENV, "")
+    if metrics_file is None or _profiling or kind not in ("cprofile", "sample"):
+        return None
+    if kind == "sample" and threading.current_thread() is not threading.main_thread():
+        return None  # signals are handled only by the main thread
+    profiler = CProfiler() if kind == "cprofile" else StackSampler()
+    profiler.start()
+    _profiling.append(profiler)
+    return profiler
+
+
+@contextlib.contextmanager
+def stage(name, gene=None, default_file=DEFAULT_METRICS_FILE, **fields):
+    # measures the block as the stage 'name' (of the gene, if given), fields are added to its record as they are
+    metrics_file = metrics_file_for(default_file)
+    record = {'stage': name, 'gene': gene, 'pid': os.getpid(),
+              'start': time.strftime("%Y-%m-%dT%H:%M:%S"), 'items': {}, **fields}
+    if _running:  # the peak of the outer stage so far, before it is reset
+        _running[-1]['peak_rss_mb'] = max(_running[-1]['peak_rss_mb'], peak_rss_mb())
+    record['peak_reset'] = reset_peak_rss()
+    record['peak_rss_mb'] = 0
+    _running.append(record)
+    profiler = start_profiler(metrics_file)
+    start = snapshot()
+    record['status'] = 'failed'
+    try:
+        yield record
+        record['status'] = 'done'
+    finally:
+        end = snapshot()
+        if profiler is not None:
+            profiler.stop()
+            _profiling.remove(profiler)
+            profiler.save("{}.{}.{}".format(metrics_file, gene or "all", name))
+        _running.remove(record)
+        record['peak_rss_mb'] = round(max(record['peak_rss_mb'], peak_rss_mb()), 1)
+        if _running:  # the peak of the inner stage is a peak of the outer one too
+            _running[-1]['peak_rss_mb'] = max(_running[-1]['peak_rss_mb'], record['peak_rss_mb'])
+        seconds = end['time'] - start['time']
+        record['seconds'] = round(seconds, 6)
+        record['cpu_seconds'] = round(end['cpu'] - start['cpu'], 6)
+        record['children_cpu_seconds'] = round(end['children_cpu'] - start['children_cpu'], 6)
+        for key in ('read_bytes', 'written_bytes', 'disk_read_bytes', 'disk_written_bytes'):
+            record[key] = end[key] - start[key]
+        record['per_second'] = {unit: round(n / seconds, 1) if seconds > 0 else None
+                                for unit, n in record['items'].items()}
+        if metrics_file is not None:
+            write_record(record, metrics_file)
+
+
+def measured(name=None):
+    # decorator: every call of the function is measured as a stage (named as the function, unless a name is given)
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,213 @@
+# Synthetic Drop-seq like input files, for benchmarking the scripts (see benchmark.py) without the real data:
+#   ref.fasta - random gene sequences, named like the genes of dd_Smed_v6 ('dd_Smed_v6_<num>_0_1')
+#   full.bam, full.bam.bai - coordinate sorted reads of the genes, with the matches to the reference as '=' and the
+#                            cell tag (XC) and number of mismatches (NM) tags, as after samtools calmd -e. some of the
+#                            reads have an insertion, so the indel filter has reads to filter out
+#   dge.txt - a digital gene expression matrix (genes x cells) of the same genes and cells
+# The cells have a skewed number of reads, as in real data, so the sampling caps have cells to sample from.
+# All the records of the BAM file are encoded at once with numpy (each kind of record has a fixed size), and the BGZF
+# blocks and the index are written without samtools or pysam.
+# Usage: python synthetic_data.py <out_dir> [reads_per_gene] [cells] [gene_len] [genes]
+
+import os
+import struct
+import sys
+import zlib
+import numpy as np
+from bgzf_reader import META_BIN, SEQ_CHARS
+
+READ_LEN = 60
+NUCS = np.array(list("ACGT"))
+BLOCK_SIZE = 0xff00  # uncompressed bytes per BGZF block, as in htslib
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+SEQ_CODES = np.zeros(256, dtype=np.uint8)
+for code, char in enumerate(SEQ_CHARS):
+    SEQ_CODES[ord(char)] = code
+
+
+def gene_names(genes):
+    return ["dd_Smed_v6_{}_0_1".format(i) for i in range(1, genes + 1)]
+
+
+def write_fasta(file_name, names, seqs):
+    with open(file_name, "w") as f:
+        for name, seq in zip(names, seqs):
+            f.write(">" + name + "\n")
+            for i in range(0, len(seq), 60):
+                f.write(seq[i:i + 60] + "\n")
+
+
+def reg2bin(beg, end):
+    # the bin of the index of the reads at [beg, end) (0-based), for arrays of reads
+    end = end - 1
+    return np.select([beg >> 14 == end >> 14, beg >> 17 == end >> 17, beg >> 20 == end >> 20, beg >> 23 == end >> 23,
+                      beg >> 26 == end >> 26],
+                     [4681 + (beg >> 14), 585 + (beg >> 17), 73 + (beg >> 20), 9 + (beg >> 23), 1 + (beg >> 26)], 0)
+
+
+def encode_records(ref_id, pos, seqs, quals, cigar, cells, nm, read_numbers):
+    # the records of reads with the same CIGAR (a list of (length, op code)) as a (reads x record size) byte matrix.
+    # seqs are the ASCII codes of the bases, a (reads x READ_LEN) matrix
+    n = len(pos)
+    names = np.char.encode(np.char.add("r", np.char.zfill(np.asarray(read_numbers).astype(str), 9)))
+    cells = np.asarray(cells, dtype='S12')
+    fields = np.zeros(n, dtype=[('block_size', '<i4'), ('ref_id', '<i4'), ('pos', '<i4'), ('l_read_name', 'u1'),
+                                ('mapq', 'u1'), ('bin', '<u2'), ('n_cigar', '<u2'), ('flag', '<u2'), ('l_seq', '<i4'),
+                                ('next_ref_id', '<i4'), ('next_pos', '<i4'), ('tlen', '<i4'), ('name', 'S11'),
+                                ('cigar', '<u4', (len(cigar),)), ('seq', 'u1', (READ_LEN // 2,)),
+                                ('qual', 'u1', (READ_LEN,)), ('xc', 'S3'), ('cell', 'S13'), ('nm', 'S3'), ('nm_value', 'u1')])
+    ref_len = sum(length for length, op in cigar if op == 0)
+    fields['block_size'] = fields.dtype.itemsize - 4
+    fields['ref_id'] = ref_id
+    fields['pos'] = pos
+    fields['l_read_name'] = 11
+    fields['mapq'] = 255
+    fields['bin'] = reg2bin(pos, pos + ref_len)
+    fields['n_cigar'] = len(cigar)
+    fields['l_seq'] = READ_LEN
+    fields['next_ref_id'] = -1
+    fields['next_pos'] = -1
+    fields['name'] = names
+    fields['cigar'] = [length << 4 | op for length, op in cigar]
+    codes = SEQ_CODES[seqs]
+    fields['seq'] = codes[:, ::2] << 4 | codes[:, 1::2]
+    fields['qual'] = quals
+    fields['xc'] = b"XCZ"
+    fields['cell'] = cells
+    fields['nm'] = b"NMC"
+    fields['nm_value'] = nm
+    return fields.view(np.uint8).reshape(n, fields.dtype.itemsize)
+
+
+def write_bgzf(file_name, data):
+    # data compressed into BGZF blocks. returns the offsets of the blocks in the file, and of the end of file block
+    offsets = []
+    with open(file_name, "wb") as f:
+        for start in range(0, len(data), BLOCK_SIZE):
+            block = data[start:start + BLOCK_SIZE]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = compressor.compress(block) + compressor.flush()
+            offsets.append(f.tell())
+            f.write(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25))
+            f.write(cdata)
+            f.write(struct.pack('<II', zlib.crc32(block), len(block)))
+        offsets.append(f.tell())
+        f.write(BGZF_EOF)
+    return np.array(offsets, dtype=np.uint64)
+
+
+def write_index(file_name, ref_ids, pos, ends, starts, sizes, block_offsets, num_of_refs):
+    # the .bai index of the records (sorted by position) that start at 'starts' of the uncompressed data
+    def virtual(offset):
+        offset = np.asarray(offset, dtype=np.uint64)
+        return block_offsets[offset // BLOCK_SIZE] << np.uint64(16) | offset % BLOCK_SIZE
+
+    begins, record_ends = virtual(starts), virtual(starts + sizes)
+    bins = reg2bin(pos, ends)
+    with open(file_name, "wb") as f:
+        f.write(b"BAI\x01" + struct.pack('<i', num_of_refs))
+        for tid in range(num_of_refs):
+            reads = np.flatnonzero(ref_ids == tid)
+            if len(reads) == 0:
+                f.write(struct.pack('<ii', 0, 0))
+                continue
+            # the reads of a bin that are consecutive in the file are one chunk:
+            order = reads[np.lexsort((reads, bins[reads]))]
+            new_chunk = np.ones(len(order), dtype=bool)
+            new_chunk[1:] = (np.diff(order) != 1) | (np.diff(bins[order]) != 0)
+            firsts = np.flatnonzero(new_chunk)
+            lasts = np.append(firsts[1:], len(order)) - 1
+            chunk_bins = bins[order[firsts]]
+            f.write(struct.pack('<i', len(np.unique(chunk_bins)) + 1))
+            for b in np.unique(chunk_bins):
+                in_bin = chunk_bins == b
+                f.write(struct.pack('<Ii', b, in_bin.sum()))
+                pairs = np.column_stack([begins[order[firsts[in_bin]]], record_ends[order[lasts[in_bin]]]])
+                f.write(pairs.astype('<u8').tobytes())
+            f.write(struct.pack('<Ii', META_BIN, 2))
+            f.write(struct.pack('<4Q', int(begins[reads[0]]), int(record_ends[reads[-1]]), len(reads), 0))
+            # linear index: the first read that overlaps each 16kb window
+            windows = np.full((ends[reads].max() - 1 >> 14) + 1, np.iinfo(np.uint64).max, dtype=np.uint64)
+            np.minimum.at(windows, pos[reads] >> 14, begins[reads])
+            np.minimum.at(windows, (ends[reads] - 1) >> 14, begins[reads])
+            windows[windows == np.iinfo(np.uint64).max] = 0
+            f.write(struct.pack('<i', len(windows)) + windows.astype('<u8').tobytes())
+        f.write(struct.pack('<Q', 0))
+
+
+def write_bam(file_name, names, seqs, reads_per_gene, cells, cell_weights, rng, mm_rate=0.01, indel_rate=0.05):
+    header_text = "@HD\tVN:1.6\tSO:coordinate\n" + "".join(
+        "@SQ\tSN:{}\tLN:{}\n".format(name, len(seq)) for name, seq in zip(names, seqs))
+    header = bytearray(b"BAM\x01" + struct.pack('<i', len(header_text)) + header_text.encode())
+    header += struct.pack('<i', len(names))
+    for name, seq in zip(names, seqs):
+        header += struct.pack('<i', len(name) + 1) + name.encode() + b"\x00" + struct.pack('<i', len(seq))
+    genes_data, ref_ids, positions, ends, sizes = [], [], [], [], []
+    for tid, seq in enumerate(seqs):
+        n = reads_per_gene
+        pos = np.sort(rng.integers(0, len(seq) - READ_LEN + 1, n))
+        ref = np.frombuffer(seq.encode(), dtype=np.uint8)[pos[:, None] + np.arange(READ_LEN)]
+        other = np.frombuffer(b"ACGT", dtype=np.uint8)[rng.integers(0, 4, (n, READ_LEN))]
+        mismatch = (rng.random((n, READ_LEN)) < mm_rate) & (other != ref)
+        read = np.where(mismatch, other, ord("="))
+        quals = rng.integers(2, 42, (n, READ_LEN), dtype=np.uint8)
+        read_cells = rng.choice(cells, n, p=cell_weights)
+        indel = rng.random(n) < indel_rate
+        # the two kinds of records are encoded separately, and placed in the order of the reads:
+        groups = []
+        for has_indel, cigar in ((False, [(READ_LEN, 0)]), (True, [(20, 0), (1, 1), (READ_LEN - 21, 0)])):
+            group = np.flatnonzero(indel == has_indel)
+            groups.append((group, encode_records(tid, pos[group], read[group], quals[group], cigar, read_cells[group],
+                                                mismatch[group].sum(axis=1), tid * n + group)))
+        gene_sizes = np.zeros(n, dtype=np.int64)
+        for group, encoded in groups:
+            gene_sizes[group] = encoded.shape[1]
+        gene_starts = np.cumsum(gene_sizes) - gene_sizes
+        data = np.empty(gene_sizes.sum(), dtype=np.uint8)
+        for group, encoded in groups:
+            data[gene_starts[group][:, None] + np.arange(encoded.shape[1])] = encoded
+        genes_data.append(data)
+        ref_ids.append(np.full(n, tid))
+        positions.append(pos)
+        ends.append(pos + np.where(indel, READ_LEN - 1, READ_LEN))
+        sizes.append(gene_sizes)
+    sizes = np.concatenate(sizes)
+    starts = len(header) + np.cumsum(sizes) - sizes
+    block_offsets = write_bgzf(file_name, bytes(header) + np.concatenate(genes_data).tobytes())
+    write_index(file_name + ".bai", np.concatenate(ref_ids), np.concatenate(positions), np.concatenate(ends), starts,
+                sizes, block_offsets, len(names))
+
+
+def write_dge(file_name, names, cells, cell_weights, rng, expressed=0.3):
+    # counts of the genes in the cells, each gene expressed in about 'expressed' of the cells
+    counts = rng.poisson(3 * np.asarray(cell_weights) * len(cells), (len(names), len(cells)))
+    counts[rng.random(counts.shape) > expressed] = 0
+    with open(file_name, "w") as f:
+        f.write("GENE\t" + "\t".join(cells) + "\n")
+        for name, row in zip(names, counts):
+            f.write(name + "\t" + "\t".join(map(str, row)) + "\n")
+
+
+def generate(out_dir, reads_per_gene=20000, num_of_cells=500, gene_len=2000, genes=3, seed=0):
+    # returns the names of the genes
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    names = gene_names(genes)
+    seqs = ["".join(NUCS[rng.integers(0, 4, gene_len)]) for _ in names]
+    cells = np.array(["".join(c) for c in NUCS[rng.integers(0, 4, (num_of_cells, 12))]])
+    cell_weights = 1 / np.arange(1, num_of_cells + 1)  # a few cells have most of the reads
+    cell_weights /= cell_weights.sum()
+    write_fasta(os.path.join(out_dir, "ref.fasta"), names, seqs)
+    write_bam(os.path.join(out_dir, "full.bam"), names, seqs, reads_per_gene, cells, cell_weights, rng)
+    write_dge(os.path.join(out_dir, "dge.txt"), names, cells, cell_weights, rng)
+    with open(os.path.join(out_dir, "genes.txt"), "w") as f:
+        f.write("\n".join(names) + "\n")
+    print("Synthetic data of {} genes of length {}, {} reads per gene and {} cells was written to '{}'".format(
+        genes, gene_len, reads_per_gene, num_of_cells, out_dir))
+    return names
+
+
+if __name__ == '__main__':
+    out_dir = sys.argv[1]
+    args = [int(arg) for arg in sys.argv[2:6]]  # optional: reads_per_gene, cells, gene_len, genes
+    generate(out_dir, *args)